@@ -0,0 +1,49 @@
+-- -----------------------------------------------------
+-- Update to Table `schedule`
+-- -----------------------------------------------------
+
+ALTER TABLE `schedule`
+  ADD `dirty` BOOLEAN NOT NULL DEFAULT TRUE,
+  ADD INDEX `schedule_dirty_idx` (`dirty` ASC);
+
+-- -----------------------------------------------------
+-- Update to Table `event`
+-- -----------------------------------------------------
+
+ALTER TABLE `event`
+  ADD INDEX `event_user_start_end_idx` (`user_id` ASC, `start` ASC, `end` ASC);
+
+-- -----------------------------------------------------
+-- Update to Table `team`
+-- -----------------------------------------------------
+
+ALTER TABLE `team`
+  ADD `version` BIGINT(20) UNSIGNED NOT NULL DEFAULT 0,
+  ADD `last_modified` BIGINT(20) NOT NULL DEFAULT 0;
+
+-- -----------------------------------------------------
+-- Update to Table `notification_queue`
+-- -----------------------------------------------------
+
+ALTER TABLE `notification_queue`
+  ADD `claimed_by` VARCHAR(255),
+  ADD `claimed_until` BIGINT(20) UNSIGNED,
+  ADD INDEX `notification_queue_claimed_by_idx` (`claimed_by` ASC),
+  ADD INDEX `notification_queue_active_send_time_idx` (`active` ASC, `send_time` ASC);
+
+-- -----------------------------------------------------
+-- Table `notification_queue_archive`
+-- -----------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS `notification_queue_archive` (
+  `id` BIGINT(20) UNSIGNED NOT NULL,
+  `user_id` BIGINT(20) UNSIGNED NOT NULL,
+  `send_time` BIGINT(20) UNSIGNED NOT NULL,
+  `mode_id` INT(11) NOT NULL,
+  `context` TEXT NOT NULL,
+  `type_id` BIGINT(20) UNSIGNED NOT NULL,
+  `active` BOOL,
+  `sent` BOOL,
+  PRIMARY KEY (`id`),
+  INDEX `notification_queue_archive_user_id_idx` (`user_id` ASC)
+);
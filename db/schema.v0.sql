@@ -17,6 +17,8 @@ CREATE TABLE IF NOT EXISTS `team` (
   `iris_enabled` BOOLEAN NOT NULL DEFAULT FALSE,
   `override_phone_number` VARCHAR(255),
   `api_managed_roster` BOOLEAN NOT NULL DEFAULT FALSE,
+  `version` BIGINT(20) UNSIGNED NOT NULL DEFAULT 0,
+  `last_modified` BIGINT(20) NOT NULL DEFAULT 0,
   PRIMARY KEY (`id`),
   UNIQUE INDEX `name_unique` (`name` ASC));
 
@@ -170,10 +172,13 @@ CREATE TABLE IF NOT EXISTS `schedule` (
   `last_epoch_scheduled` BIGINT(20) UNSIGNED,
   `last_scheduled_user_id` BIGINT(20) UNSIGNED,
   `scheduler_id` INT(11) UNSIGNED NOT NULL,
+  -- set on writes that affect scheduling, cleared when the scheduler picks the schedule up
+  `dirty` BOOLEAN NOT NULL DEFAULT TRUE,
   PRIMARY KEY (`id`),
   INDEX `schedule_roster_id_idx` (`roster_id` ASC),
   INDEX `schedule_role_id_idx` (`role_id` ASC),
   INDEX `schedule_team_id_idx` (`team_id` ASC),
+  INDEX `schedule_dirty_idx` (`dirty` ASC),
   CONSTRAINT `schedule_roster_id_fk`
     FOREIGN KEY (`roster_id`)
     REFERENCES `roster` (`id`)
@@ -239,6 +244,7 @@ CREATE TABLE IF NOT EXISTS `event` (
   INDEX `event_user_id_fk_idx` (`user_id` ASC),
   INDEX `event_team_id_fk_idx` (`team_id` ASC),
   INDEX `event_link_id_idx` (`link_id` ASC),
+  INDEX `event_user_start_end_idx` (`user_id` ASC, `start` ASC, `end` ASC),
   CONSTRAINT `event_user_id_fk`
     FOREIGN KEY (`user_id`)
     REFERENCES `user` (`id`)
@@ -413,12 +419,32 @@ CREATE TABLE IF NOT EXISTS `notification_queue` (
   `type_id` BIGINT(20) UNSIGNED NOT NULL,
   `active` BOOL,
   `sent` BOOL,
+  `claimed_by` VARCHAR(255),
+  `claimed_until` BIGINT(20) UNSIGNED,
   PRIMARY KEY (`id`),
+  INDEX `notification_queue_claimed_by_idx` (`claimed_by` ASC),
+  INDEX `notification_queue_active_send_time_idx` (`active` ASC, `send_time` ASC),
   CONSTRAINT `notification_queue_user_id_fk` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`)
     ON DELETE CASCADE,
   CONSTRAINT `notification_queue_type_id_fk` FOREIGN KEY (`type_id`) REFERENCES `notification_type` (`id`)
 );
 
+-- -----------------------------------------------------
+-- Table `notification_queue_archive`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `notification_queue_archive` (
+  `id` BIGINT(20) UNSIGNED NOT NULL,
+  `user_id` BIGINT(20) UNSIGNED NOT NULL,
+  `send_time` BIGINT(20) UNSIGNED NOT NULL,
+  `mode_id` INT(11) NOT NULL,
+  `context` TEXT NOT NULL,
+  `type_id` BIGINT(20) UNSIGNED NOT NULL,
+  `active` BOOL,
+  `sent` BOOL,
+  PRIMARY KEY (`id`),
+  INDEX `notification_queue_archive_user_id_idx` (`user_id` ASC)
+);
+
 -- -----------------------------------------------------
 -- Table `notifier_state`
 -- -----------------------------------------------------
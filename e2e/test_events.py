@@ -356,3 +356,39 @@ def test_events_link(team, user, role):
     assert all(evs)
 
     clean_up()
+
+
+@prefix('test_events_pagination')
+def test_events_pagination(event, team, user, role):
+    team_name = team.create()
+    user_name = user.create()
+    role_name = role.create()
+    user.add_to_team(user_name, team_name)
+
+    start = int(time.time()) + 1000
+    ev_ids = [event.create({'start': start + i * 100,
+                            'end': start + (i + 1) * 100,
+                            'user': user_name,
+                            'team': team_name,
+                            'role': role_name}) for i in range(5)]
+
+    pages = []
+    cursor = None
+    while True:
+        params = {'team': team_name, 'limit': 2, 'fields': 'start'}
+        if cursor:
+            params['cursor'] = cursor
+        re = requests.get(api_v0('events'), params=params)
+        assert re.status_code == 200
+        pages.append([ev['id'] for ev in re.json()])
+        cursor = re.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert pages == [ev_ids[:2], ev_ids[2:4], ev_ids[4:]]
+
+    re = requests.get(api_v0('events'), params={'team': team_name, 'stream': 'true'})
+    assert re.status_code == 200
+    assert sorted(ev['id'] for ev in re.json()) == ev_ids
+
+    re = requests.get(api_v0('events'), params={'team': team_name, 'limit': 0})
+    assert re.status_code == 400
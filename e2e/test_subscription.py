@@ -159,3 +159,54 @@ def test_v0_subscription_summary(user, role, team, event):
     assert all(results['current'][role_name_2][0][key] == event_data_2[key] for key in keys)
     assert all(results['next'][role_name][0][key] == event_data_3[key] for key in keys)
     assert all(results['next'][role_name_2][0][key] == event_data_4[key] for key in keys)
+
+
+@prefix('test_v0_oncall_batch')
+def test_v0_oncall_batch(user, role, team, service, event):
+    team_name = team.create()
+    team_name_2 = team.create()
+    service_name = service.create()
+    service.associate_team(service_name, team_name_2)
+    user_name = user.create()
+    user_name_2 = user.create()
+    role_name = role.create()
+    role_name_2 = role.create()
+    user.add_to_team(user_name, team_name)
+    user.add_to_team(user_name_2, team_name_2)
+    re = requests.post(api_v0('teams/%s/subscriptions' % team_name), json={'role': role_name_2, 'subscription': team_name_2})
+    assert re.status_code == 201
+
+    start, end = int(time.time()), int(time.time() + 36000)
+    for ev_start, ev_end, user_name_, team_name_, role_name_ in (
+            (start, end, user_name, team_name, role_name),
+            (start - 5, end - 5, user_name_2, team_name_2, role_name_2),
+            (start + 50000, end + 50000, user_name, team_name, role_name),
+            (start + 50005, end + 50005, user_name_2, team_name_2, role_name_2)):
+        event.create({'start': ev_start,
+                      'end': ev_end,
+                      'user': user_name_,
+                      'team': team_name_,
+                      'role': role_name_})
+
+    re = requests.post(api_v0('oncall/batch'), json={'teams': [team_name, 'nonexistent-team'],
+                                                     'services': [service_name]})
+    assert re.status_code == 200
+    results = re.json()
+    assert set(results['teams']) == {team_name, team_name_2}
+    assert results['services'] == {service_name: [team_name_2]}
+    for name in (team_name, team_name_2):
+        summary = requests.get(api_v0('teams/%s/summary' % name)).json()
+        for part in ('current', 'next'):
+            assert set(results['teams'][name][part]) == set(summary[part])
+            for role_events in results['teams'][name][part].values():
+                for ev in role_events:
+                    assert any(ev['user'] == other['user'] and ev['start'] == other['start']
+                               for other in summary[part][ev['role']])
+
+    re = requests.post(api_v0('oncall/batch'), json={'teams': team_name})
+    assert re.status_code == 400
+    re = requests.post(api_v0('oncall/batch'), json={'teams': [[team_name]]})
+    assert re.status_code == 400
+    for body in ([team_name], team_name, 1):
+        re = requests.post(api_v0('oncall/batch'), json=body)
+        assert re.status_code == 400
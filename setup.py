@@ -71,6 +71,7 @@ setuptools.setup(
             'oncall-user-sync = oncall.bin.user_sync:main',
             'build_assets = oncall.bin.build_assets:main',
             'oncall-scheduler = oncall.bin.scheduler:main',
+            'oncall-scheduler-bench = oncall.bin.scheduler_bench:main',
             'oncall-notifier = oncall.bin.notifier:main'
         ]
     }
@@ -45,6 +45,9 @@ def init(application, config):
     application.add_route('/api/v0/services/{service}/oncall', service_oncall)
     application.add_route('/api/v0/services/{service}/oncall/{role}', service_oncall)
 
+    from . import oncall_batch
+    application.add_route('/api/v0/oncall/batch', oncall_batch)
+
     from . import team_services, team_service, service_teams
     application.add_route('/api/v0/team_services', team_service)
     application.add_route('/api/v0/teams/{team}/services', team_services)
@@ -3,13 +3,16 @@
 
 from ujson import dumps as json_dumps
 from ... import db
+from ...query import QueryBuilder
 
 
-filters = {'owner': '`owner_name` = %(owner)s',
-           'team': '`team_name` = %(team)s',
-           'action': '`action_name` IN %(action)s',
-           'start': '`timestamp` >= %(start)s',
-           'end': '`timestamp` <= %(end)s'}
+filters = {'owner': '`owner_name` = %s',
+           'team': '`team_name` = %s',
+           'action': '`action_name` IN %s',
+           'start': '`timestamp` >= %s',
+           'end': '`timestamp` <= %s'}
+
+query_builder = QueryBuilder(filters)
 
 
 def on_get(req, resp):
@@ -75,14 +78,10 @@ def on_get(req, resp):
     if 'action' in req.params:
         req.params['action'] = req.get_param_as_list('action')
 
-    query = '''SELECT `owner_name` AS `owner`, `team_name` AS `team`,
-                   `action_name` AS `action`, `timestamp`, `context`
-               FROM `audit`'''
-    where = ' AND '.join(filters[field] for field in req.params if field in filters)
-    if where:
-        query = '%s WHERE %s' % (query, where)
-
-    cursor.execute(query, req.params)
+    query, query_params = query_builder.build('''`owner_name` AS `owner`, `team_name` AS `team`,
+                                                 `action_name` AS `action`, `timestamp`, `context`''',
+                                              '`audit`', req.params)
+    cursor.execute(query, query_params)
     results = cursor.fetchall()
     cursor.close()
     connection.close()
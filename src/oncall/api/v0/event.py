@@ -6,9 +6,9 @@ from ujson import dumps as json_dumps
 from falcon import HTTPNotFound, HTTPBadRequest, HTTPUnauthorized
 
 from ...auth import login_required, check_calendar_auth, check_team_auth
-from ... import db, constants
+from ... import db, constants, cache
 from ...utils import (
-    load_json_body, user_in_team_by_name, create_notification, create_audit
+    load_json_body, user_in_team_by_name, create_notification, create_audit, mark_schedules_dirty
 )
 from ...constants import EVENT_DELETED, EVENT_EDITED
 
@@ -166,10 +166,12 @@ def on_put(req, resp, event_id):
         create_notification(context, event_data['team_id'], {event_data['role_id'], new_ev_data['role_id']},
                             EVENT_EDITED, {event_data['user_id'], new_ev_data['user_id']}, cursor,
                             start_time=event_data['start'])
+        mark_schedules_dirty(cursor, team_id=event_data['team_id'])
     except:
         raise
     else:
         connection.commit()
+        cache.invalidate_teams([event_data['team']])
     finally:
         cursor.close()
         connection.close()
@@ -217,8 +219,10 @@ def on_delete(req, resp, event_id):
         create_notification(context, ev['team_id'], [ev['role_id']], EVENT_DELETED, [ev['user_id']], cursor,
                             start_time=ev['start'])
         create_audit({'old_event': ev}, ev['team'], EVENT_DELETED, req, cursor)
+        mark_schedules_dirty(cursor, team_id=ev['team_id'])
 
         connection.commit()
+        cache.invalidate_teams([ev['team']])
     finally:
         cursor.close()
         connection.close()
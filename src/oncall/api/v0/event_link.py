@@ -4,9 +4,9 @@
 import time
 from operator import itemgetter
 from falcon import HTTPNotFound, HTTPBadRequest, HTTP_204
-from ... import db, constants
+from ... import db, constants, cache
 from ...utils import (
-    create_notification, create_audit, load_json_body, user_in_team_by_name
+    create_notification, create_audit, load_json_body, user_in_team_by_name, mark_schedules_dirty
 )
 from ...auth import login_required, check_calendar_auth
 from ...constants import EVENT_DELETED, EVENT_EDITED
@@ -60,7 +60,9 @@ def on_delete(req, resp, link_id):
         create_notification(context, ev['team_id'], [ev['role_id']], EVENT_DELETED, [ev['user_id']], cursor,
                             start_time=ev['start'])
         create_audit({'old_event': data}, ev['team'], EVENT_DELETED, req, cursor)
+        mark_schedules_dirty(cursor, team_id=ev['team_id'])
         connection.commit()
+        cache.invalidate_teams([ev['team']])
     finally:
         cursor.close()
         connection.close()
@@ -142,7 +144,9 @@ def on_put(req, resp, link_id):
         create_notification(context, event_summary['team_id'], {event_summary['role_id'], new_ev['role_id']},
                             EVENT_EDITED, {event_summary['user_id'], new_ev['user_id']}, cursor,
                             start_time=event_summary['start'])
+        mark_schedules_dirty(cursor, team_id=event_summary['team_id'])
         connection.commit()
+        cache.invalidate_teams([event_summary['team']])
     finally:
         cursor.close()
         connection.close()
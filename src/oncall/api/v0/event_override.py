@@ -6,8 +6,8 @@ from ujson import dumps as json_dumps
 import time
 
 from ...auth import login_required, check_calendar_auth_by_id
-from ... import db, constants
-from ...utils import load_json_body, user_in_team, create_notification, create_audit
+from ... import db, constants, cache
+from ...utils import load_json_body, user_in_team, create_notification, create_audit, mark_schedules_dirty
 from ...constants import EVENT_SUBSTITUTED
 
 
@@ -189,11 +189,13 @@ def on_post(req, resp):
                             [user_id, events[0]['user_id']], cursor, start_time=start, end_time=end)
         create_audit({'new_events': ret_data, 'request_body': data}, ret_data[0]['team'],
                      EVENT_SUBSTITUTED, req, cursor)
+        mark_schedules_dirty(cursor, team_id=team_id)
         resp.body = json_dumps(ret_data)
     except HTTPError:
         raise
     else:
         connection.commit()
+        cache.invalidate_teams([ret_data[0]['team']])
     finally:
         cursor.close()
         connection.close()
@@ -4,8 +4,8 @@
 from falcon import HTTPError, HTTPBadRequest, HTTPNotFound
 import time
 
-from ... import db, constants
-from ...utils import load_json_body, create_notification, create_audit
+from ... import db, constants, cache
+from ...utils import load_json_body, create_notification, create_audit, mark_schedules_dirty
 from ...auth import login_required, check_calendar_auth_by_id
 from ...constants import EVENT_SWAPPED
 
@@ -127,12 +127,14 @@ def on_post(req, resp):
         create_audit({'request_body': data,
                       'events_swapped': (events_0, events_1)},
                      team_name, EVENT_SWAPPED, req, cursor)
+        mark_schedules_dirty(cursor, team_id=events[0]['team_id'])
         connection.commit()
 
     except HTTPError:
         raise
     else:
         connection.commit()
+        cache.invalidate_teams([team_name])
     finally:
         cursor.close()
         connection.close()
@@ -5,9 +5,10 @@ import time
 from falcon import HTTP_201, HTTPError, HTTPBadRequest
 from ujson import dumps as json_dumps
 from ...auth import login_required, check_calendar_auth
-from ... import db, constants
+from ... import db, constants, cache
+from ...query import QueryBuilder
 from ...utils import (
-    load_json_body, user_in_team_by_name, create_notification, create_audit
+    load_json_body, user_in_team_by_name, create_notification, create_audit, mark_schedules_dirty
 )
 from ...constants import EVENT_CREATED
 
@@ -68,6 +69,56 @@ constraints = {
 
 TEAM_PARAMS = {'team', 'team__eq', 'team__contains', 'team__startswith', 'team_endswith', 'team_id'}
 
+query_builder = QueryBuilder(constraints)
+
+# Rows per chunk written by streamed responses
+STREAM_CHUNK_SIZE = 500
+
+
+def stream_rows(connection, cursor):
+    '''
+    Yield a JSON array of the rows of an executed unbuffered cursor, a chunk at a time, closing the
+    cursor and connection once done (or when the client goes away).
+    '''
+    try:
+        yield b'['
+        separator = b''
+        while True:
+            rows = cursor.fetchmany(STREAM_CHUNK_SIZE)
+            if not rows:
+                break
+            yield separator + json_dumps(rows)[1:-1].encode('utf-8')
+            separator = b','
+        yield b']'
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def get_versions(req, params):
+    '''
+    Versions of the team named by a team/team__eq filter and, unless include_subscribed is false, of
+    the teams it subscribes to. Used for conditional GETs, see ConditionalGetMiddleware. Returns None
+    for queries not scoped to a single team by name.
+    '''
+    team = req.get_param('team') or req.get_param('team__eq')
+    if team is None:
+        return None
+    connection = db.connect()
+    cursor = connection.cursor()
+    if req.get_param_as_bool('include_subscribed') is False:
+        cursor.execute('SELECT `id`, `version`, `last_modified` FROM `team` WHERE `name` = %s', team)
+    else:
+        cursor.execute('''SELECT `id`, `version`, `last_modified` FROM `team`
+                          WHERE `name` = %s OR `id` IN (SELECT `subscription_id` FROM `team_subscription`
+                                                        JOIN `team` ON `team`.`id` = `team_subscription`.`team_id`
+                                                        WHERE `team`.`name` = %s)''',
+                       (team, team))
+    versions = cursor.fetchall()
+    cursor.close()
+    connection.close()
+    return versions
+
 
 def on_get(req, resp):
     """
@@ -140,6 +191,13 @@ def on_get(req, resp):
     :query user__contains: user name contains param
     :query user__startswith: user name starts with param
     :query user__endswith: user name ends with param
+    :query limit: return at most this many events, ordered by id. If the page is full, the
+        ``X-Next-Cursor`` response header holds the cursor for the next page. Event ids are always
+        included in paginated results.
+    :query cursor: return events after this cursor, taken from ``X-Next-Cursor`` of the previous page
+    :query stream: if true, rows are streamed from the database and written as they are read, so
+        memory use doesn't grow with the size of the result. Streamed pages don't set ``X-Next-Cursor``;
+        the id of the last event is the next cursor.
 
     :statuscode 200: no error
     :statuscode 400: bad request
@@ -152,56 +210,72 @@ def on_get(req, resp):
     if include_sub is None:
         include_sub = True
     req.params.pop('include_subscribed', None)
+    limit = req.get_param_as_int('limit', min_value=1)
+    after = req.get_param_as_int('cursor')
+    stream = req.get_param_as_bool('stream')
+    for key in ('limit', 'cursor', 'stream'):
+        req.params.pop(key, None)
+    if limit is not None and fields and columns['id'] not in fields:
+        fields.append(columns['id'])
     cols = ', '.join(fields) if fields else all_columns
     if any(key not in constraints for key in req.params):
         raise HTTPBadRequest('Bad constraint param')
-    query = '''SELECT %s FROM `event`
-               JOIN `user` ON `user`.`id` = `event`.`user_id`
-               JOIN `team` ON `team`.`id` = `event`.`team_id`
-               JOIN `role` ON `role`.`id` = `event`.`role_id`''' % cols
+    from_clause = '''`event`
+                     JOIN `user` ON `user`.`id` = `event`.`user_id`
+                     JOIN `team` ON `team`.`id` = `event`.`team_id`
+                     JOIN `role` ON `role`.`id` = `event`.`role_id`'''
 
-    where_params = []
-    where_vals = []
-    connection = db.connect()
+    # Streamed rows are read after the request's connection has been returned
+    connection = db.connect(scoped=not stream)
     cursor = connection.cursor(db.DictCursor)
 
-    # Build where clause. If including subscriptions, deal with team parameters later
-    params = req.params.keys() - TEAM_PARAMS if include_sub else req.params
-    for key in params:
-        val = req.get_param(key)
-        if key in constraints:
-            where_params.append(constraints[key])
-            where_vals.append(val)
-
-    # Deal with team subscriptions and team parameters
-    team_where = []
-    subs_vals = []
-    team_params = req.params.keys() & TEAM_PARAMS
+    # If including subscriptions, team parameters are dealt with separately
+    filter_params = {key: req.get_param(key) for key in req.params}
+    extra_where = []
+    extra_vals = []
+    team_params = sorted(req.params.keys() & TEAM_PARAMS)
     if include_sub and team_params:
-
-        for key in team_params:
-            val = req.get_param(key)
-            team_where.append(constraints[key])
-            subs_vals.append(val)
-        subs_and = ' AND '.join(team_where)
+        subs_vals = [filter_params.pop(key) for key in team_params]
+        subs_and = ' AND '.join(constraints[key] for key in team_params)
         cursor.execute('''SELECT `subscription_id`, `role_id` FROM `team_subscription`
                           JOIN `team` ON `team_id` = `team`.`id`
                           WHERE %s''' % subs_and,
                        subs_vals)
+        extra_vals += subs_vals
         if cursor.rowcount != 0:
             # Build where clause based on team params and subscriptions
-            subs_and = '(%s OR (%s))' % (subs_and, ' OR '.join(['`team`.`id` = %s AND `role`.`id` = %s' %
-                                                                (row['subscription_id'], row['role_id']) for row in cursor]))
-        where_params.append(subs_and)
-        where_vals += subs_vals
-
-    where_query = ' AND '.join(where_params)
-    if where_query:
-        query = '%s WHERE %s' % (query, where_query)
+            subscriptions = cursor.fetchall()
+            subs_and = '(%s OR (%s))' % (subs_and, ' OR '.join(['`team`.`id` = %s AND `role`.`id` = %s'] *
+                                                               len(subscriptions)))
+            for row in subscriptions:
+                extra_vals += [row['subscription_id'], row['role_id']]
+        extra_where.append(subs_and)
+
+    if after is not None:
+        extra_where.append('`event`.`id` > %s')
+        extra_vals.append(after)
+    suffix = ''
+    if limit is not None:
+        suffix = ' ORDER BY `event`.`id` LIMIT %s'
+        extra_vals.append(limit)
+
+    query, where_vals = query_builder.build(cols, from_clause, filter_params, extra_where, suffix)
+    where_vals += extra_vals
+
+    if stream:
+        cursor.close()
+        cursor = connection.cursor(db.SSDictCursor)
+        cursor.execute(query, where_vals)
+        resp.content_type = 'application/json'
+        resp.stream = stream_rows(connection, cursor)
+        return
+
     cursor.execute(query, where_vals)
     data = cursor.fetchall()
     cursor.close()
     connection.close()
+    if limit is not None and len(data) == limit:
+        resp.set_header('X-Next-Cursor', str(data[-1]['id']))
     resp.body = json_dumps(data)
 
 
@@ -300,7 +374,9 @@ def on_post(req, resp):
                      EVENT_CREATED,
                      req,
                      cursor)
+        mark_schedules_dirty(cursor, team_id=ev_info['team_id'])
         connection.commit()
+        cache.invalidate_teams([data['team']])
     except db.IntegrityError as e:
         err_msg = str(e.args[1])
         if err_msg == 'Column \'role_id\' cannot be null':
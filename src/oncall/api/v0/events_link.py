@@ -5,9 +5,9 @@ from falcon import HTTP_201, HTTPError, HTTPBadRequest
 import time
 
 from ujson import dumps as json_dumps
-from ... import db, constants
+from ... import db, constants, cache
 from ...utils import (
-    load_json_body, gen_link_id, user_in_team_by_name
+    load_json_body, gen_link_id, user_in_team_by_name, mark_schedules_dirty, mark_team_modified
 )
 from ...auth import login_required, check_calendar_auth
 
@@ -122,7 +122,10 @@ def on_post(req, resp):
 
         insert_query = 'INSERT INTO `event` (%s) VALUES (%s)' % (','.join(columns), ','.join(values))
         cursor.executemany(insert_query, event_values)
+        mark_schedules_dirty(cursor, team=team)
+        mark_team_modified(cursor, team=team)
         connection.commit()
+        cache.invalidate_teams([team])
         cursor.execute('SELECT `id` FROM `event` WHERE `link_id`=%s ORDER BY `start`', link_id)
         ev_ids = [row[0] for row in cursor]
     except db.IntegrityError as e:
@@ -2,74 +2,98 @@
 # See LICENSE in the project root for license information.
 
 from datetime import datetime as dt
+from functools import lru_cache
 from ... import db
 from icalendar import Calendar, Event, vCalAddress, vText
 from pytz import utc
 
+END_CALENDAR = b'END:VCALENDAR\r\n'
+
+
+@lru_cache(maxsize=20000)
+def event_to_ical(event_id, start, end, team, role, full_name, contacts, contact, modified):
+    '''
+    Serialized VEVENT for an event. Everything the component depends on is an argument, so cached
+    entries never go stale: an edited event or user simply maps to a new entry. DTSTAMP is the last
+    modification time of the event's team, which every event write bumps, so edits get a newer stamp
+    and every worker serializes the same event to the same bytes.
+    '''
+    contacts = dict(contacts)
+    cal_event = Event()
+    cal_event.add('uid', 'event-%s@oncall' % event_id)
+    cal_event.add('dtstart', dt.fromtimestamp(start, utc))
+    cal_event.add('dtend', dt.fromtimestamp(end, utc))
+    cal_event.add('dtstamp', dt.fromtimestamp(modified, utc))
+    cal_event.add('summary',
+                  '%s %s shift: %s' % (team, role, full_name))
+    cal_event.add('description',
+                  '%s\n' % full_name +
+                  ('\n'.join(['%s: %s' % (mode, dest) for mode, dest in contacts.items()]) if contact else ''))
+    cal_event.add('TRANSP', 'TRANSPARENT')
+
+    # Attach info about the user oncall
+    attendee = vCalAddress('MAILTO:%s' % (contacts.get('email') if contact else ''))
+    attendee.params['cn'] = vText(full_name)
+    attendee.params['ROLE'] = vText('REQ-PARTICIPANT')
+    cal_event.add('attendee', attendee, encode=0)
+    return cal_event.to_ical()
 
-def events_to_ical(events, identifier, contact=True):
-    connection = db.connect()
-    cursor = connection.cursor(db.DictCursor)
 
+@lru_cache(maxsize=1024)
+def calendar_header(identifier):
     ical = Calendar()
     ical.add('calscale', 'GREGORIAN')
     ical.add('prodid', '-//Oncall//Oncall calendar feed//EN')
     ical.add('version', '2.0')
     ical.add('x-wr-calname', '%s Oncall Calendar' % identifier)
+    return ical.to_ical()[:-len(END_CALENDAR)]
 
-    users = {}
-
-    for event in events:
-        username = event['user']
-        if username not in users:
-            if contact:
-                cursor.execute('''
-                    SELECT
-                        `user`.`full_name` AS full_name,
-                        `contact_mode`.`name` AS contact_mode,
-                        `user_contact`.`destination` AS destination
-                    FROM `user_contact`
-                    JOIN `contact_mode` ON `contact_mode`.`id` = `user_contact`.`mode_id`
-                    JOIN `user` ON `user`.`id` = `user_contact`.`user_id`
-                    WHERE `user`.`name` = %s
-                ''', username)
-            else:
-                cursor.execute('''
-                    SELECT `user`.`full_name` AS full_name
-                    FROM `user`
-                    WHERE `user`.`name` = %s
-                ''', username)
-
-            info = {'username': username, 'contacts': {}}
-            for row in cursor:
-                info['full_name'] = row['full_name']
-                if contact:
-                    info['contacts'][row['contact_mode']] = row['destination']
-            users[username] = info
-        user = users[username]
 
-        # Create the event itself
-        full_name = user.get('full_name', user['username'])
-        cal_event = Event()
-        cal_event.add('uid', 'event-%s@oncall' % event['id'])
-        cal_event.add('dtstart', dt.fromtimestamp(event['start'], utc))
-        cal_event.add('dtend', dt.fromtimestamp(event['end'], utc))
-        cal_event.add('dtstamp', dt.utcnow())
-        cal_event.add('summary',
-                      '%s %s shift: %s' % (event['team'], event['role'], full_name))
-        cal_event.add('description',
-                      '%s\n' % full_name +
-                      ('\n'.join(['%s: %s' % (mode, dest) for mode, dest in user['contacts'].items()]) if contact else ''))
-        cal_event.add('TRANSP', 'TRANSPARENT')
-
-        # Attach info about the user oncall
-        attendee = vCalAddress('MAILTO:%s' % (user['contacts'].get('email') if contact else ''))
-        attendee.params['cn'] = vText(full_name)
-        attendee.params['ROLE'] = vText('REQ-PARTICIPANT')
-        cal_event.add('attendee', attendee, encode=0)
-
-        ical.add_component(cal_event)
+def get_users(usernames, contact):
+    '''
+    Full names and, if contact is set, contacts of the given users, in one query
+    '''
+    users = {}
+    if not usernames:
+        return users
+    connection = db.connect()
+    cursor = connection.cursor(db.DictCursor)
+    if contact:
+        cursor.execute('''
+            SELECT
+                `user`.`name` AS username,
+                `user`.`full_name` AS full_name,
+                `contact_mode`.`name` AS contact_mode,
+                `user_contact`.`destination` AS destination
+            FROM `user`
+            LEFT JOIN `user_contact` ON `user`.`id` = `user_contact`.`user_id`
+            LEFT JOIN `contact_mode` ON `contact_mode`.`id` = `user_contact`.`mode_id`
+            WHERE `user`.`name` IN %s
+        ''', (list(usernames),))
+    else:
+        cursor.execute('''
+            SELECT `user`.`name` AS username, `user`.`full_name` AS full_name
+            FROM `user`
+            WHERE `user`.`name` IN %s
+        ''', (list(usernames),))
 
+    for row in cursor:
+        info = users.setdefault(row['username'], {'full_name': row['full_name'], 'contacts': {}})
+        if contact and row['contact_mode']:
+            info['contacts'][row['contact_mode']] = row['destination']
     cursor.close()
     connection.close()
-    return ical.to_ical()
+    return users
+
+
+def events_to_ical(events, identifier, contact=True):
+    users = get_users({event['user'] for event in events}, contact)
+    parts = [calendar_header(identifier)]
+    for event in events:
+        username = event['user']
+        user = users.get(username, {'contacts': {}})
+        parts.append(event_to_ical(event['id'], event['start'], event['end'], event['team'], event['role'],
+                                   user.get('full_name') or username,
+                                   tuple(sorted(user['contacts'].items())), contact, event['last_modified']))
+    parts.append(END_CALENDAR)
+    return b''.join(parts)
@@ -0,0 +1,199 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from ... import db
+from ujson import dumps as json_dumps
+from collections import defaultdict
+from falcon import HTTPBadRequest
+from ...utils import load_json_body
+
+
+def on_post(req, resp):
+    '''
+    Get the on-call summary of many teams at once. Takes a list of team names and/or service names and
+    returns, for each team (including the teams owning the given services), the same ``current``
+    and ``next`` objects as ``GET /api/v0/teams/{team}/summary``. Services map to the names of their
+    owning teams. Unknown teams and services are left out of the response.
+
+    The result is built with a fixed number of queries, however many teams are requested.
+
+    **Example request:**
+
+    .. sourcecode:: http
+
+        POST api/v0/oncall/batch   HTTP/1.1
+        Content-Type: application/json
+
+        {
+            "teams": ["team-foo"],
+            "services": ["service-bar"]
+        }
+
+    **Example response:**
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "teams": {
+                "team-foo": {
+                    "current": {
+                        "primary": [
+                            {
+                                "end": 1495760400,
+                                "full_name": "Adam Smith",
+                                "photo_url": "example.image.com",
+                                "role": "primary",
+                                "start": 1495350000,
+                                "team": "team-foo",
+                                "user": "asmith",
+                                "user_contacts": {
+                                    "call": "+1 222-222-2222",
+                                    "email": "asmith@example.com",
+                                    "im": "asmith",
+                                    "sms": "+1 222-222-2222"
+                                },
+                                "user_id": 1235
+                            }
+                        ]
+                    },
+                    "next": {}
+                },
+                "team-bar": {
+                    "current": {},
+                    "next": {}
+                }
+            },
+            "services": {
+                "service-bar": ["team-bar"]
+            }
+        }
+
+    :statuscode 200: no error
+    :statuscode 400: invalid request body
+    '''
+    data = load_json_body(req)
+    if not isinstance(data, dict):
+        raise HTTPBadRequest('Invalid request', 'request body must be an object')
+    team_names = data.get('teams', [])
+    service_names = data.get('services', [])
+    if not all(isinstance(names, list) and all(isinstance(name, str) for name in names)
+               for names in (team_names, service_names)):
+        raise HTTPBadRequest('Invalid request', 'teams and services must be lists of names')
+
+    connection = db.connect()
+    cursor = connection.cursor(db.DictCursor)
+    try:
+        resp.body = json_dumps(get_summaries(team_names, service_names, cursor))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def is_visible(event, sources):
+    return (event['team_id'], None) in sources or (event['team_id'], event['role_id']) in sources
+
+
+def get_summaries(team_names, service_names, cursor):
+    teams = {}
+    services = defaultdict(list)
+    if team_names:
+        cursor.execute('SELECT `id`, `name`, `override_phone_number` FROM `team` WHERE `name` IN %s',
+                       (team_names,))
+        for row in cursor:
+            teams[row['id']] = row
+    if service_names:
+        cursor.execute('''SELECT `service`.`name` AS `service`, `team`.`id`, `team`.`name`,
+                                 `team`.`override_phone_number`
+                          FROM `team_service`
+                          JOIN `service` ON `service`.`id` = `team_service`.`service_id`
+                          JOIN `team` ON `team`.`id` = `team_service`.`team_id`
+                          WHERE `service`.`name` IN %s''',
+                       (service_names,))
+        for row in cursor:
+            services[row.pop('service')].append(row['name'])
+            teams[row['id']] = row
+    if not teams:
+        return {'teams': {}, 'services': services}
+
+    # Each team sees its own events of every role, plus the events of the (team, role) pairs it subscribes to
+    sources = {team_id: {(team_id, None)} for team_id in teams}
+    cursor.execute('SELECT `team_id`, `subscription_id`, `role_id` FROM `team_subscription` WHERE `team_id` IN %s',
+                   (list(teams),))
+    for row in cursor:
+        sources[row['team_id']].add((row['subscription_id'], row['role_id']))
+    event_team_ids = list({source[0] for team_sources in sources.values() for source in team_sources})
+
+    cursor.execute('''SELECT `user`.`full_name` AS `full_name`,
+                             `user`.`photo_url`,
+                             `event`.`start`, `event`.`end`,
+                             `event`.`user_id`,
+                             `user`.`name` AS `user`,
+                             `team`.`name` AS `team`,
+                             `role`.`name` AS `role`,
+                             `event`.`team_id`, `event`.`role_id`
+                      FROM `event`
+                      JOIN `user` ON `event`.`user_id` = `user`.`id`
+                      JOIN `team` ON `event`.`team_id` = `team`.`id`
+                      JOIN `role` ON `role`.`id` = `event`.`role_id`
+                      WHERE UNIX_TIMESTAMP() BETWEEN `event`.`start` AND `event`.`end`
+                          AND `event`.`team_id` IN %s''',
+                   (event_team_ids,))
+    current = cursor.fetchall()
+
+    # Earliest upcoming events of each (team, role)
+    cursor.execute('''SELECT `role`.`name` AS `role`,
+                             `user`.`full_name` AS `full_name`,
+                             `event`.`start`,
+                             `event`.`end`,
+                             `user`.`photo_url`,
+                             `user`.`name` AS `user`,
+                             `event`.`user_id`,
+                             `event`.`role_id`,
+                             `event`.`team_id`
+                      FROM `event`
+                      JOIN `role` ON `event`.`role_id` = `role`.`id`
+                      JOIN `user` ON `event`.`user_id` = `user`.`id`
+                      JOIN (SELECT `role_id`, `team_id`, MIN(`start`) AS `start`
+                            FROM `event`
+                            WHERE `start` > UNIX_TIMESTAMP() AND `team_id` IN %s
+                            GROUP BY `role_id`, `team_id`) AS `t1`
+                          ON `event`.`role_id` = `t1`.`role_id`
+                              AND `event`.`team_id` = `t1`.`team_id`
+                              AND `event`.`start` = `t1`.`start`''',
+                   (event_team_ids,))
+    upcoming = cursor.fetchall()
+
+    contacts = defaultdict(dict)
+    user_ids = {event['user_id'] for events in (current, upcoming) for event in events}
+    if user_ids:
+        cursor.execute('''SELECT `contact_mode`.`name` AS `mode`,
+                                 `user_contact`.`destination`,
+                                 `user_contact`.`user_id`
+                          FROM `user_contact`
+                          JOIN `contact_mode` ON `contact_mode`.`id` = `user_contact`.`mode_id`
+                          WHERE `user_contact`.`user_id` IN %s''',
+                       (list(user_ids),))
+        for row in cursor:
+            contacts[row['user_id']][row['mode']] = row['destination']
+
+    summaries = {}
+    for team_id, team in teams.items():
+        team_sources = sources[team_id]
+        summary = {'current': defaultdict(list), 'next': defaultdict(list)}
+        for event in current:
+            if is_visible(event, team_sources):
+                event = dict(event, user_contacts=dict(contacts[event['user_id']]))
+                del event['team_id'], event['role_id']
+                if team['override_phone_number'] and event['role'] == 'primary':
+                    event['user_contacts']['call'] = team['override_phone_number']
+                    event['user_contacts']['sms'] = team['override_phone_number']
+                summary['current'][event['role']].append(event)
+        for event in upcoming:
+            if is_visible(event, team_sources):
+                summary['next'][event['role']].append(dict(event, user_contacts=dict(contacts[event['user_id']])))
+        summaries[team['name']] = summary
+
+    return {'teams': summaries, 'services': services}
@@ -1,8 +1,8 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
-from ... import db
-from ...utils import load_json_body
+from ... import db, cache
+from ...utils import load_json_body, mark_schedules_dirty, mark_team_modified
 from ...auth import check_team_auth, login_required
 from .schedules import get_schedules
 from falcon import HTTPNotFound
@@ -46,5 +46,10 @@ def on_post(req, resp, schedule_id):
     schedule = get_schedules({'id': schedule_id})[0]
     check_team_auth(schedule['team'], req)
     scheduler.populate(schedule, start_time, (connection, cursor))
+    # Populating moves the schedule's last epoch, so the scheduler needs to re-evaluate it
+    mark_schedules_dirty(cursor, schedule_id=schedule_id)
+    mark_team_modified(cursor, schedule_id=schedule_id)
+    connection.commit()
+    cache.invalidate_teams([schedule['team']])
     cursor.close()
     connection.close()
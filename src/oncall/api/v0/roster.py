@@ -6,8 +6,8 @@ from falcon import HTTPError, HTTPNotFound, HTTPBadRequest
 from ujson import dumps as json_dumps
 
 from ...auth import login_required, check_team_auth
-from ... import db
-from ...utils import load_json_body, invalid_char_reg
+from ... import db, cache
+from ...utils import load_json_body, invalid_char_reg, mark_schedules_dirty
 from .schedules import get_schedules
 from ...constants import ROSTER_DELETED, ROSTER_EDITED
 from ...utils import create_audit
@@ -139,6 +139,7 @@ def on_put(req, resp, team, roster):
                                     AND team_id = (SELECT id FROM team WHERE name = %s))
                                   AND user_id = (SELECT id FROM user WHERE name = %s)''',
                                ((idx, roster, team, user) for idx, user in enumerate(roster_order)))
+            mark_schedules_dirty(cursor, team=team)
             connection.commit()
 
         if name and name != roster:
@@ -152,6 +153,7 @@ def on_put(req, resp, team, roster):
                        AND `name`=%s''',
                 (name, team, roster))
             create_audit({'old_name': roster, 'new_name': name}, team, ROSTER_EDITED, req, cursor)
+            mark_schedules_dirty(cursor, team=team)
             connection.commit()
     except db.IntegrityError as e:
         err_msg = str(e.args[1])
@@ -201,6 +203,7 @@ def on_delete(req, resp, team, roster):
         create_audit({'name': roster}, team, ROSTER_DELETED, req, cursor)
 
     connection.commit()
+    cache.auth.invalidate()
     cursor.close()
     connection.close()
 
@@ -5,8 +5,8 @@ from urllib.parse import unquote
 from falcon import HTTPNotFound, HTTPBadRequest, HTTP_200
 
 from ...auth import login_required, check_team_auth
-from ...utils import load_json_body, unsubscribe_notifications, create_audit
-from ... import db
+from ...utils import load_json_body, unsubscribe_notifications, create_audit, mark_schedules_dirty
+from ... import db, cache
 from ...constants import ROSTER_USER_DELETED, ROSTER_USER_EDITED
 
 
@@ -71,7 +71,9 @@ def on_delete(req, resp, team, roster, user):
     cursor.execute(query, (user, team, team, team))
     if cursor.rowcount != 0:
         unsubscribe_notifications(team, user, cursor)
+    mark_schedules_dirty(cursor, team=team)
     connection.commit()
+    cache.auth.invalidate()
     cursor.close()
     connection.close()
     resp.status = HTTP_200
@@ -126,7 +128,9 @@ def on_put(req, resp, team, roster, user):
                  ROSTER_USER_EDITED,
                  req,
                  cursor)
+    mark_schedules_dirty(cursor, team=team)
     connection.commit()
+    cache.auth.invalidate()
     cursor.close()
     connection.close()
     resp.status = HTTP_200
@@ -7,8 +7,8 @@ from ujson import dumps as json_dumps
 
 from ...auth import login_required, check_team_auth
 from .users import get_user_data
-from ... import db
-from ...utils import load_json_body, subscribe_notifications, create_audit
+from ... import db, cache
+from ...utils import load_json_body, subscribe_notifications, create_audit, mark_schedules_dirty
 from ...constants import ROSTER_USER_ADDED
 
 
@@ -152,7 +152,9 @@ def on_post(req, resp, team, roster):
 
         create_audit({'roster': roster, 'user': user_name, 'request_body': data}, team,
                      ROSTER_USER_ADDED, req, cursor)
+        mark_schedules_dirty(cursor, team=team)
         connection.commit()
+        cache.auth.invalidate()
     except db.IntegrityError:
         raise HTTPError('422 Unprocessable Entity',
                         'IntegrityError',
@@ -6,7 +6,7 @@ from falcon import HTTPNotFound, HTTPBadRequest, HTTPForbidden
 from ...auth import login_required, check_team_auth
 from .schedules import insert_schedule_events
 from ... import db
-from ...utils import load_json_body
+from ...utils import load_json_body, mark_schedules_dirty, mark_team_modified
 from json import dumps as json_dumps
 from .schedules import validate_simple_schedule, get_schedules
 
@@ -155,6 +155,8 @@ def on_put(req, resp, schedule_id):
         cursor.executemany('''INSERT INTO `schedule_order` (`schedule_id`, `user_id`, `priority`)
                               VALUES (%s, (SELECT `id` FROM `user` WHERE `name` = %s), %s)''',
                            params)
+    mark_schedules_dirty(cursor, schedule_id=schedule_id)
+    mark_team_modified(cursor, schedule_id=schedule_id)
     connection.commit()
     cursor.close()
     connection.close()
@@ -177,6 +179,7 @@ def on_delete(req, resp, schedule_id):
     connection = db.connect()
     cursor = connection.cursor()
     verify_auth(req, schedule_id, connection, cursor)
+    mark_team_modified(cursor, schedule_id=schedule_id)
     cursor.execute('DELETE FROM `schedule` WHERE `id`=%s', int(schedule_id))
     deleted = cursor.rowcount
     connection.commit()
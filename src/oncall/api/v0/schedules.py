@@ -5,9 +5,10 @@ from urllib.parse import unquote
 from falcon import HTTP_201, HTTPError, HTTPBadRequest
 from ujson import dumps as json_dumps
 
-from ...utils import load_json_body
+from ...utils import load_json_body, mark_team_modified
 from ...auth import login_required, check_team_auth
 from ... import db
+from ...query import QueryBuilder
 
 HOUR = 60 * 60
 WEEK = 24 * HOUR * 7
@@ -55,6 +56,8 @@ constraints = {
     'roster_id': '`schedule`.`roster_id` = %s'
 }
 
+query_builder = QueryBuilder(constraints)
+
 
 def validate_simple_schedule(events):
     '''
@@ -70,7 +73,7 @@ def validate_simple_schedule(events):
         return len(events) in simple_12hr_num_events and all([ev['duration'] == 12 * HOUR for ev in events])
 
 
-def get_schedules(filter_params, dbinfo=None, fields=None):
+def get_schedules(filter_params, dbinfo=None, fields=None, team_ids=None):
     """
     Helper function to get schedule data for a request.
 
@@ -81,6 +84,7 @@ def get_schedules(filter_params, dbinfo=None, fields=None):
     :param fields: optional. If provided, defines which schedule fields to return. Valid
     fields are defined in the global ``columns`` dict. Defaults to all fields. Invalid
     fields raise a 400 Bad Request.
+    :param team_ids: optional. If provided, only schedules for these team ids are returned.
     :return:
     """
     events = False
@@ -118,14 +122,14 @@ def get_schedules(filter_params, dbinfo=None, fields=None):
     else:
         connection, cursor = dbinfo
 
-    where = ' AND '.join(constraints[key] % connection.escape(value)
-                         for key, value in filter_params.items()
-                         if key in constraints)
-    query = 'SELECT %s FROM %s' % (cols, from_clause)
-    if where:
-        query = '%s WHERE %s' % (query, where)
+    extra_where = []
+    if team_ids is not None:
+        extra_where.append('`schedule`.`team_id` IN %s')
+    query, query_params = query_builder.build(cols, from_clause, filter_params, extra_where)
+    if team_ids is not None:
+        query_params.append(list(team_ids) or [None])
 
-    cursor.execute(query)
+    cursor.execute(query, query_params)
     data = cursor.fetchall()
     if scheduler and data:
         schedule_ids = {d['id'] for d in data}
@@ -441,6 +445,7 @@ def on_post(req, resp, team, roster):
             err_msg = 'team "%s" not found' % team
         raise HTTPError('422 Unprocessable Entity', 'IntegrityError', err_msg)
     else:
+        mark_team_modified(cursor, team=team)
         connection.commit()
     finally:
         cursor.close()
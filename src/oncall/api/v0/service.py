@@ -3,9 +3,9 @@
 
 from falcon import HTTPNotFound
 from ujson import dumps
-from ...utils import load_json_body
+from ...utils import load_json_body, mark_team_modified
 
-from ... import db
+from ... import db, cache
 from ...auth import debug_only
 
 
@@ -56,7 +56,9 @@ def on_put(req, resp, service):
     cursor = connection.cursor()
     cursor.execute('UPDATE `service` SET `name`=%s WHERE `name`=%s',
                    (data['name'], service))
+    mark_team_modified(cursor)
     connection.commit()
+    cache.oncall.invalidate()
     cursor.close()
     connection.close()
 
@@ -72,7 +74,9 @@ def on_delete(req, resp, service):
     # FIXME: also delete team service mappings?
     cursor.execute('DELETE FROM `service` WHERE `name`=%s', service)
     deleted = cursor.rowcount
+    mark_team_modified(cursor)
     connection.commit()
+    cache.oncall.invalidate()
     cursor.close()
     connection.close()
 
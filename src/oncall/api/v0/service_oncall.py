@@ -2,7 +2,7 @@
 # See LICENSE in the project root for license information.
 
 from ujson import dumps as json_dumps
-from ... import db
+from ... import db, cache
 
 
 def on_get(req, resp, service, role=None):
@@ -39,6 +39,15 @@ def on_get(req, resp, service, role=None):
             }
         ]
 
+    '''
+    resp.body = cache.oncall.load(('service', service, role), lambda: get_service_oncall(service, role),
+                                  ['service:%s' % service])
+
+
+def get_service_oncall(service, role=None):
+    '''
+    Build the current on-call response for a service. Returns the JSON body and the unix time of the
+    next event boundary of the owning teams, when it goes stale.
     '''
     get_oncall_query = '''
         SELECT `user`.`full_name` AS `full_name`,
@@ -72,16 +81,28 @@ def on_get(req, resp, service, role=None):
     team_ids = [row['team_id'] for row in data]
     team_override_numbers = {row['name']: row['override_phone_number'] for row in data}
     if not team_ids:
-        resp.body = json_dumps([])
         cursor.close()
         connection.close()
-        return
+        return json_dumps([]), float('inf')
     query_params += [team_ids, team_ids]
     if role is not None:
         get_oncall_query += ' AND `role`.`name` = %s'
         query_params.append(role)
     cursor.execute(get_oncall_query, query_params)
     data = cursor.fetchall()
+    next_start_query = '''
+        SELECT MIN(`event`.`start`) AS `start`
+        FROM `event`
+        JOIN `role` ON `role`.`id` = `event`.`role_id`
+        LEFT JOIN `team_subscription` ON `subscription_id` = `event`.`team_id`
+            AND `team_subscription`.`role_id` = `role`.`id`
+        WHERE `event`.`start` > UNIX_TIMESTAMP()
+            AND (`event`.`team_id` IN %s OR `team_subscription`.`team_id` IN %s)'''
+    if role is not None:
+        next_start_query += ' AND `role`.`name` = %s'
+    cursor.execute(next_start_query, query_params)
+    next_start = cursor.fetchone()['start']
+    expires = min([row['end'] + 1 for row in data] + [next_start or float('inf')])
     ret = {}
     for row in data:
         user = row['user']
@@ -103,4 +124,4 @@ def on_get(req, resp, service, role=None):
 
     cursor.close()
     connection.close()
-    resp.body = json_dumps(data)
+    return json_dumps(data), expires
@@ -6,11 +6,11 @@ from urllib.parse import unquote
 from falcon import HTTPNotFound, HTTPBadRequest, HTTPError
 from ujson import dumps as json_dumps
 
-from ... import db, iris
+from ... import db, iris, cache
 from .users import get_user_data
 from .rosters import get_roster_by_team_id
 from ...auth import login_required, check_team_auth
-from ...utils import load_json_body, invalid_char_reg, create_audit
+from ...utils import load_json_body, invalid_char_reg, create_audit, mark_schedules_dirty
 from ...constants import TEAM_DELETED, TEAM_EDITED, SUPPORTED_TIMEZONES
 
 # Columns which may be modified
@@ -55,6 +55,19 @@ populate_map = {
 }
 
 
+def get_versions(req, params):
+    '''
+    Team version for conditional GETs, see ConditionalGetMiddleware
+    '''
+    connection = db.connect()
+    cursor = connection.cursor()
+    cursor.execute('SELECT `id`, `version`, `last_modified` FROM `team` WHERE `name` = %s', unquote(params['team']))
+    versions = cursor.fetchall()
+    cursor.close()
+    connection.close()
+    return versions
+
+
 def on_get(req, resp, team):
     '''
     Get team info by name. By default, only finds active teams. Allows selection of
@@ -231,7 +244,12 @@ def on_put(req, resp, team):
         update_query = 'UPDATE `team` SET {0} WHERE name=%s'.format(set_clause)
         cursor.execute(update_query, query_params)
         create_audit({'request_body': data}, team, TEAM_EDITED, req, cursor)
+        if 'scheduling_timezone' in data:
+            # Schedule events are laid out in the team's timezone
+            mark_schedules_dirty(cursor, team=data.get('name', team))
         connection.commit()
+        cache.oncall.invalidate()
+        cache.auth.invalidate()
     except db.IntegrityError as e:
         err_msg = str(e.args[1])
         if 'Duplicate entry' in err_msg:
@@ -284,5 +302,7 @@ def on_delete(req, resp, team):
     cursor.execute('UPDATE `team` SET `name` = %s WHERE `name`= %s', (new_team, team))
     cursor.execute('INSERT INTO `deleted_team` (team_id, new_name, old_name, deletion_date) VALUES (%s, %s, %s, %s)', (team_id, new_team, team, deletion_date))
     connection.commit()
+    cache.oncall.invalidate()
+    cache.auth.invalidate()
     cursor.close()
     connection.close()
@@ -4,7 +4,7 @@
 from falcon import HTTPNotFound
 
 from ...auth import login_required, check_team_auth
-from ... import db
+from ... import db, cache
 from ...utils import unsubscribe_notifications, create_audit
 from ...constants import ADMIN_DELETED
 
@@ -49,5 +49,6 @@ def on_delete(req, resp, team, user):
     if cursor.rowcount != 0:
         unsubscribe_notifications(team, user, cursor)
     connection.commit()
+    cache.auth.invalidate()
     cursor.close()
     connection.close()
@@ -4,7 +4,7 @@
 from urllib.parse import unquote
 from falcon import HTTPError, HTTP_201, HTTPBadRequest
 from ujson import dumps as json_dumps
-from ... import db
+from ... import db, cache
 from .users import get_user_data
 from ...auth import login_required, check_team_auth
 from ...utils import load_json_body, subscribe_notifications, create_audit
@@ -119,6 +119,7 @@ def on_post(req, resp, team):
         subscribe_notifications(team, user_name, cursor)
         create_audit({'user': user_name}, team, ADMIN_CREATED, req, cursor)
         connection.commit()
+        cache.auth.invalidate()
     except db.IntegrityError as e:
         err_msg = str(e.args[1])
         if err_msg == "Column 'team_id' cannot be null":
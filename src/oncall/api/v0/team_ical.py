@@ -39,7 +39,8 @@ def get_team_events(team, start, roles=None, include_subscribed=False):
             `user`.`name` AS user,
             `role`.`name` AS role,
             `event`.`start`,
-            `event`.`end`
+            `event`.`end`,
+            `team`.`last_modified`
         FROM `event`
             JOIN `team` ON `event`.`team_id` = `team`.`id`
             JOIN `user` ON `event`.`user_id` = `user`.`id`
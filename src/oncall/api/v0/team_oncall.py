@@ -2,7 +2,7 @@
 # See LICENSE in the project root for license information.
 
 from ujson import dumps as json_dumps
-from ... import db
+from ... import db, cache
 
 
 def on_get(req, resp, team, role=None):
@@ -52,6 +52,15 @@ def on_get(req, resp, team, role=None):
 
     :statuscode 200: no error
     """
+    resp.body = cache.oncall.load(('team', team, role), lambda: get_team_oncall(team, role),
+                                  ['team:%s' % team])
+
+
+def get_team_oncall(team, role=None):
+    '''
+    Build the current on-call response for a team. Returns the JSON body and the unix time of the
+    next event boundary (a current event ending or an upcoming one starting), when it goes stale.
+    '''
     get_oncall_query = '''
         SELECT `user`.`full_name` AS `full_name`,
                `event`.`start`, `event`.`end`,
@@ -80,6 +89,22 @@ def on_get(req, resp, team, role=None):
     cursor = connection.cursor(db.DictCursor)
     cursor.execute(get_oncall_query, query_params)
     data = cursor.fetchall()
+    next_start_query = '''
+        SELECT MIN(`event`.`start`) AS `start`
+        FROM `event`
+        JOIN `team` ON `event`.`team_id` = `team`.`id`
+        JOIN `role` ON `role`.`id` = `event`.`role_id`
+        LEFT JOIN `team_subscription` ON `subscription_id` = `team`.`id`
+            AND `team_subscription`.`role_id` = `role`.`id`
+        LEFT JOIN `team` `subscriber` ON `subscriber`.`id` = `team_subscription`.`team_id`
+        WHERE `event`.`start` > UNIX_TIMESTAMP()
+            AND (`team`.`name` = %s OR `subscriber`.`name` = %s)'''
+    if role is not None:
+        next_start_query += ' AND `role`.`name` = %s'
+    cursor.execute(next_start_query, query_params)
+    next_start = cursor.fetchone()['start']
+    expires = min([row['end'] + 1 for row in data] + [next_start or float('inf')])
+
     cursor.execute('SELECT `override_phone_number` FROM team WHERE `name` = %s', team)
     team = cursor.fetchone()
     override_number = team['override_phone_number'] if team else None
@@ -103,4 +128,4 @@ def on_get(req, resp, team, role=None):
 
     cursor.close()
     connection.close()
-    resp.body = json_dumps(data)
+    return json_dumps(data), expires
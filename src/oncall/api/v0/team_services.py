@@ -5,9 +5,9 @@ from urllib.parse import unquote
 from falcon import HTTPError, HTTP_201
 from ujson import dumps as json_dumps
 from ...auth import login_required, check_team_auth
-from ...utils import load_json_body
+from ...utils import load_json_body, mark_team_modified
 
-from ... import db
+from ... import db, cache
 
 
 def on_get(req, resp, team):
@@ -101,7 +101,9 @@ def on_post(req, resp, team):
                               (SELECT `id` FROM `service` WHERE `name`=%s)
                           )''',
                        (team, service))
+        mark_team_modified(cursor, team=team)
         connection.commit()
+        cache.invalidate_teams([team], [service])
     except db.IntegrityError as e:
         err_msg = str(e.args[1])
         if err_msg == 'Column \'service_id\' cannot be null':
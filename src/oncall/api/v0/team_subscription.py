@@ -1,7 +1,8 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
-from ... import db
+from ... import db, cache
+from ...utils import mark_team_modified, mark_schedules_dirty
 from ...auth import login_required, check_team_auth
 from falcon import HTTPNotFound
 
@@ -18,7 +19,11 @@ def on_delete(req, resp, team, subscription, role):
                       AND `role_id` = (SELECT `id` FROM `role` WHERE `name` = %s)''',
                    (team, subscription, role))
     deleted = cursor.rowcount
+    mark_team_modified(cursor, team=team)
+    # Subscribed teams' events are part of the team's conflict checks
+    mark_schedules_dirty(cursor, team=team)
     connection.commit()
+    cache.invalidate_teams([team])
     cursor.close()
     connection.close()
     if deleted == 0:
@@ -1,10 +1,10 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
-from ... import db
+from ... import db, cache
 from ujson import dumps as json_dumps
 from falcon import HTTPError, HTTPBadRequest, HTTP_201
-from ...utils import load_json_body
+from ...utils import load_json_body, mark_team_modified, mark_schedules_dirty
 from ...auth import login_required, check_team_auth
 import logging
 
@@ -58,7 +58,11 @@ def on_post(req, resp, team):
             logger.exception('Unknown integrity error in team_subscriptions')
         raise HTTPError('422 Unprocessable Entity', 'IntegrityError', err_msg)
     else:
+        mark_team_modified(cursor, team=team)
+        # Subscribed teams' events are part of the team's conflict checks
+        mark_schedules_dirty(cursor, team=team)
         connection.commit()
+        cache.invalidate_teams([team])
     finally:
         cursor.close()
         connection.close()
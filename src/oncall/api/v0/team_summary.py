@@ -1,7 +1,7 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
-from ... import db
+from ... import db, cache
 from ujson import dumps
 from collections import defaultdict
 from falcon import HTTPNotFound
@@ -110,6 +110,15 @@ def on_get(req, resp, team):
             }
         }
 
+    '''
+    resp.body = cache.oncall.load(('summary', team), lambda: get_team_summary(team),
+                                  ['team:%s' % team])
+
+
+def get_team_summary(team):
+    '''
+    Build the summary response for a team. Returns the JSON body and the unix time of the next event
+    boundary (a current event ending or a next one starting), when it goes stale.
     '''
     connection = db.connect()
     cursor = connection.cursor(db.DictCursor)
@@ -212,4 +221,7 @@ def on_get(req, resp, team):
             # No current primary events exist, do nothing
             pass
 
-    resp.body = dumps(payload)
+    expires = min([event['end'] + 1 for events in payload['current'].values() for event in events] +
+                  [event['start'] for events in payload['next'].values() for event in events] +
+                  [float('inf')])
+    return dumps(payload), expires
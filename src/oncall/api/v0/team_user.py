@@ -7,7 +7,8 @@ from falcon import HTTPNotFound
 from ujson import dumps as json_dumps
 
 from ...auth import login_required, check_team_auth
-from ... import db
+from ... import db, cache
+from ...utils import mark_team_modified
 
 
 def on_get(req, resp):
@@ -74,6 +75,8 @@ def on_delete(req, resp, team, user):
     if deleted == 0:
         raise HTTPNotFound()
 
+    mark_team_modified(cursor, team=team)
     connection.commit()
+    cache.auth.invalidate()
     cursor.close()
     connection.close()
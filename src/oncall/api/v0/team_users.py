@@ -4,9 +4,9 @@
 from falcon import HTTPError, HTTP_201
 from ujson import dumps as json_dumps
 from .users import get_user_data
-from ... import db
+from ... import db, cache
 from ...auth import login_required, check_team_auth
-from ...utils import load_json_body
+from ...utils import load_json_body, mark_team_modified
 
 constraints = {'active': '`team`.`active` = %s'}
 
@@ -76,7 +76,9 @@ def on_post(req, resp, team):
                               (SELECT `id` FROM `user` WHERE `name`=%s)
                           )''',
                        (team, user_name))
+        mark_team_modified(cursor, team=team)
         connection.commit()
+        cache.auth.invalidate()
     except db.IntegrityError as e:
         err_msg = str(e.args[1])
         if err_msg == 'Column \'user_id\' cannot be null':
@@ -7,7 +7,7 @@ from ujson import dumps as json_dumps
 from ...utils import load_json_body, invalid_char_reg, subscribe_notifications, create_audit
 from ...constants import TEAM_CREATED
 
-from ... import db, iris
+from ... import db, iris, cache
 from ...auth import login_required
 
 constraints = {
@@ -219,6 +219,7 @@ def on_post(req, resp):
         subscribe_notifications(team_name, req.context['user'], cursor)
         create_audit({'team_id': team_id}, team_name, TEAM_CREATED, req, cursor)
         connection.commit()
+        cache.auth.invalidate()
     except db.IntegrityError:
         raise HTTPError('422 Unprocessable Entity',
                         'IntegrityError',
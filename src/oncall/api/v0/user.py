@@ -3,9 +3,9 @@
 
 from falcon import HTTPNotFound, HTTP_204, HTTPBadRequest
 from ujson import dumps as json_dumps
-from ... import db
+from ... import db, cache
 from ...auth import login_required, check_user_auth
-from ...utils import load_json_body
+from ...utils import load_json_body, mark_team_modified
 from .users import get_user_data
 
 
@@ -92,8 +92,11 @@ def on_delete(req, resp, user_name):
     check_user_auth(user_name, req)
     connection = db.connect()
     cursor = connection.cursor()
+    mark_team_modified(cursor, user=user_name)
     cursor.execute('DELETE FROM `user` WHERE `name`=%s', user_name)
     connection.commit()
+    cache.oncall.invalidate()
+    cache.auth.invalidate()
     cursor.close()
     connection.close()
 
@@ -176,7 +179,9 @@ def on_put(req, resp, user_name):
             contact['user'] = user_name
             contacts.append(contact)
         cursor.executemany(contacts_query, contacts)
+    mark_team_modified(cursor, user=user_name)
     connection.commit()
+    cache.oncall.invalidate()
     cursor.close()
     connection.close()
     resp.status = HTTP_204
@@ -32,7 +32,8 @@ def get_user_events(user_name, start, roles=None, excluded_teams=None):
             `user`.`name` AS user,
             `role`.`name` AS role,
             `event`.`start`,
-            `event`.`end`
+            `event`.`end`,
+            `team`.`last_modified`
         FROM `event`
             JOIN `team` ON `event`.`team_id` = `team`.`id`
             JOIN `user` ON `event`.`user_id` = `user`.`id`
@@ -5,6 +5,7 @@ from falcon import HTTPError, HTTPBadRequest, HTTP_201
 from ujson import dumps as json_dumps
 from ... import db
 from ... import auth
+from ...query import QueryBuilder
 from ...utils import load_json_body
 
 
@@ -47,6 +48,8 @@ constraints = {
     'active': '`user`.`active` = %s'
 }
 
+query_builder = QueryBuilder(constraints)
+
 
 def get_user_data(fields, filter_params, dbinfo=None):
     """
@@ -78,14 +81,8 @@ def get_user_data(fields, filter_params, dbinfo=None):
     else:
         connection, cursor = dbinfo
 
-    where = ' AND '.join(constraints[key] % connection.escape(value)
-                         for key, value in filter_params.items()
-                         if key in constraints)
-    query = 'SELECT %s FROM %s' % (cols, from_clause)
-    if where:
-        query = '%s WHERE %s' % (query, where)
-
-    cursor.execute(query)
+    query, query_params = query_builder.build(cols, from_clause, filter_params)
+    cursor.execute(query, query_params)
     data = cursor.fetchall()
     if connection_opened:
         cursor.close()
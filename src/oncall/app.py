@@ -1,15 +1,18 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 from urllib.parse import unquote_plus
+from datetime import datetime
 from importlib import import_module
 
 import falcon
+import hashlib
 import os
 import re
+import time
 from beaker.middleware import SessionMiddleware
 from falcon_cors import CORS
 
-from . import db, constants, iris, auth
+from . import db, constants, iris, auth, cache, metrics
 
 import logging
 logger = logging.getLogger('oncall.app')
@@ -32,6 +35,80 @@ class SecurityHeaderMiddleware(object):
         resp.set_headers(security_headers)
 
 
+class ConditionalGetMiddleware(object):
+    '''
+    ETags for GET responses. Resources may define get_versions(req, params), returning the (id, version,
+    last_modified) rows of the teams their response depends on, or None. For those, the ETag is derived
+    from the team versions, and a matching If-None-Match is answered with 304 before the responder
+    runs. Other successful GETs get an ETag hashed from their body, so clients at least skip
+    downloading unchanged payloads.
+
+    Team versions only move on writes through the API and scheduler. Version ETags also change every
+    max_age seconds, bounding staleness from other writers such as user sync.
+    '''
+
+    def __init__(self, max_age=3600):
+        self.max_age = max_age
+
+    def process_resource(self, req, resp, resource, params):
+        if req.method != 'GET':
+            return
+        get_versions = getattr(resource, 'get_versions', None)
+        if get_versions is None:
+            return
+        versions = get_versions(req, params)
+        if not versions:
+            return
+        token = '%s|%s|%d' % (req.relative_uri,
+                              sorted((row[0], row[1]) for row in versions),
+                              time.time() // self.max_age)
+        req.context['etag'] = hashlib.sha1(token.encode('utf-8')).hexdigest()
+        req.context['last_modified'] = max(row[2] for row in versions)
+        if self.not_modified(req, req.context['etag']):
+            resp.status = falcon.HTTP_304
+            self.set_headers(req, resp)
+            resp.complete = True
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if req.method != 'GET' or not req_succeeded or resp.status != falcon.HTTP_200:
+            return
+        if req.context.get('etag') is None:
+            body = resp.text if resp.text is not None else resp.data
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            if not isinstance(body, bytes):
+                return
+            req.context['etag'] = hashlib.sha1(body).hexdigest()
+        self.set_headers(req, resp)
+        if self.not_modified(req, req.context['etag']):
+            resp.status = falcon.HTTP_304
+            resp.text = None
+            resp.data = None
+            resp.delete_header('Content-Type')
+
+    def not_modified(self, req, etag):
+        tags = req.if_none_match or []
+        return etag in tags or '*' in tags
+
+    def set_headers(self, req, resp):
+        resp.etag = req.context['etag']
+        if req.context.get('last_modified'):
+            resp.last_modified = datetime.utcfromtimestamp(req.context['last_modified'])
+
+
+class DBConnectionMiddleware(object):
+    '''
+    Lends each request one pooled DB connection, checked out on its first db.connect() and returned
+    to the pool once the response is ready, instead of a checkout for every connect().
+    '''
+
+    def process_request(self, req, resp):
+        db.begin_request()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        db.end_request()
+
+
 class ReqBodyMiddleware(object):
     '''
     Falcon's req object has a stream that we read to obtain the post body. However, we can only read this once, and
@@ -67,18 +144,21 @@ def init_falcon_api(config):
     global application
     cors = CORS(allow_origins_list=config.get('allow_origins_list', []))
     middlewares = [
+        DBConnectionMiddleware(),
         SecurityHeaderMiddleware(),
         ReqBodyMiddleware(),
         cors.middleware
     ]
     if config.get('require_auth'):
         middlewares.append(AuthMiddleware())
+    # After auth, so that 304s are only sent to authenticated clients
+    middlewares.append(ConditionalGetMiddleware(config.get('etag_max_age', 3600)))
     application = falcon.App(middleware=middlewares)
     application.req_options.auto_parse_form_urlencoded = False
     application.set_error_serializer(json_error_serializer)
     application.req_options.strip_url_path_trailing_slash = True
     from .auth import init as init_auth
-    init_auth(application, config['auth'])
+    init_auth(application, config['auth'], config.get('session'))
 
     from .ui import init as init_ui
     init_ui(application, config)
@@ -122,6 +202,10 @@ class RawPathPatcher(object):
 def init(config):
     db.init(config['db'])
     constants.init(config)
+    cache.init(config.get('cache', {}))
+    if config.get('api_metrics_interval'):
+        metrics.init(config, 'oncall-api', {stat: 0 for stat in auth.HMAC_WINDOW_STATS + db.POOL_STATS})
+        metrics.emit_periodically(config['api_metrics_interval'])
     if 'iris_plan_integration' in config:
         iris.init(config['iris_plan_integration'])
 
@@ -9,11 +9,13 @@ import base64
 import importlib
 from urllib.parse import quote
 from falcon import HTTPUnauthorized, HTTPForbidden, Request
-from .. import db
+from .. import db, cache, metrics
 
 logger = logging.getLogger('oncall.auth')
 auth_manager = None
 sso_auth_manager = None
+csrf_sign_key = None
+SIGNED_CSRF_TOKEN_LENGTH = 64
 
 
 def debug_only(function):
@@ -22,14 +24,48 @@ def debug_only(function):
     return wrapper
 
 
-def is_god(challenger):
+def load_user_auth(name):
+    '''
+    Load a user's god flag and the teams they administer or belong to, in one query
+    '''
     connection = db.connect()
     cursor = connection.cursor()
-    cursor.execute('SELECT `id` FROM `user` WHERE `god` = TRUE AND `name` = %s', challenger)
-    is_god = cursor.rowcount
+    cursor.execute('''SELECT 'god', NULL, NULL FROM `user` WHERE `god` = TRUE AND `name` = %s
+                      UNION ALL
+                      SELECT 'admin', `team`.`id`, `team`.`name` FROM `team_admin`
+                      JOIN `team` ON `team_admin`.`team_id` = `team`.`id`
+                      JOIN `user` ON `team_admin`.`user_id` = `user`.`id`
+                      WHERE `user`.`name` = %s
+                      UNION ALL
+                      SELECT 'member', `team`.`id`, `team`.`name` FROM `team_user`
+                      JOIN `team` ON `team_user`.`team_id` = `team`.`id`
+                      JOIN `user` ON `team_user`.`user_id` = `user`.`id`
+                      WHERE `user`.`name` = %s''',
+                   (name, name, name))
+    user_auth = {'god': False, 'admin': set(), 'member': set(), 'member_ids': set()}
+    for kind, team_id, team in cursor:
+        if kind == 'god':
+            user_auth['god'] = True
+        elif kind == 'admin':
+            user_auth['admin'].add(team)
+        else:
+            user_auth['member'].add(team)
+            user_auth['member_ids'].add(team_id)
     cursor.close()
     connection.close()
-    return is_god != 0
+    return user_auth, float('inf')
+
+
+def get_user_auth(name):
+    '''
+    Return a user's authorization info from cache.auth, loading it on a miss. Writes to team admins and
+    team members invalidate the cache; entries otherwise live for auth_max_age seconds.
+    '''
+    return cache.auth.load(name, lambda: load_user_auth(name))
+
+
+def is_god(challenger):
+    return get_user_auth(challenger)['god']
 
 
 def check_ical_key_admin(challenger):
@@ -45,20 +81,8 @@ def check_user_auth(user, req):
     challenger = req.context['user']
     if user == challenger:
         return
-    connection = db.connect()
-    cursor = connection.cursor()
-    get_allowed_query = '''SELECT DISTINCT(`user`.`name`)
-        FROM `team_admin`
-        JOIN `team_user` ON `team_admin`.`team_id` = `team_user`.`team_id`
-        JOIN `user` ON `user`.`id` = `team_user`.`user_id`
-        JOIN `user` AS `admin` ON `admin`.`id` = `team_admin`.`user_id`
-        WHERE `admin`.`name` = %s
-        AND `user`.`name` = %s'''
-    cursor.execute(get_allowed_query, (challenger, user))
-    user_in_query = cursor.rowcount
-    cursor.close()
-    connection.close()
-    if user_in_query != 0 or is_god(challenger):
+    challenger_auth = get_user_auth(challenger)
+    if challenger_auth['god'] or challenger_auth['admin'] & get_user_auth(user)['member']:
         return
     raise HTTPForbidden('Unauthorized', 'Action not allowed for "%s"' % challenger)
 
@@ -70,19 +94,8 @@ def check_team_auth(team, req):
     if 'app' in req.context:
         return
     challenger = req.context['user']
-    connection = db.connect()
-    cursor = connection.cursor()
-    get_allowed_query = '''SELECT `team`.`name`
-                           FROM `team_admin`
-                           JOIN `team` ON `team_admin`.`team_id` = `team`.`id`
-                           JOIN `user` ON `team_admin`.`user_id` = `user`.`id`
-                           WHERE `user`.`name` = %s
-                           AND `team`.`name` = %s'''
-    cursor.execute(get_allowed_query, (challenger, team))
-    team_in_query = cursor.rowcount
-    cursor.close()
-    connection.close()
-    if team_in_query != 0 or is_god(challenger):
+    challenger_auth = get_user_auth(challenger)
+    if team in challenger_auth['admin'] or challenger_auth['god']:
         return
     raise HTTPForbidden(
         'Unauthorized',
@@ -93,17 +106,8 @@ def check_calendar_auth(team, req, user=None):
     if 'app' in req.context:
         return
     challenger = user if (user is not None) else req.context['user']
-    connection = db.connect()
-    cursor = connection.cursor()
-    cursor.execute('''SELECT `user`.`name`
-        FROM `team_user`
-        JOIN `user` ON `team_user`.`user_id` = `user`.`id`
-        WHERE `team_user`.`team_id` = (SELECT `id` FROM `team` WHERE `name` = %s)
-            AND `user`.`name` = %s''', (team, challenger))
-    user_in_team = cursor.rowcount
-    cursor.close()
-    connection.close()
-    if user_in_team != 0 or is_god(challenger):
+    challenger_auth = get_user_auth(challenger)
+    if team in challenger_auth['member'] or challenger_auth['god']:
         return
     raise HTTPForbidden('Unauthorized', 'Action not allowed: "%s" is not part of "%s"' % (challenger, team))
 
@@ -112,35 +116,68 @@ def check_calendar_auth_by_id(team_id, req):
     if 'app' in req.context:
         return
     challenger = req.context['user']
-    query = '''SELECT `user`.`name`
-               FROM `team_user`
-               JOIN `user` ON `team_user`.`user_id` = `user`.`id`
-               WHERE `team_user`.`team_id` = %s
-               AND `user`.`name` = %s'''
+    challenger_auth = get_user_auth(challenger)
+    if int(team_id) in challenger_auth['member_ids'] or challenger_auth['god']:
+        return
+    raise HTTPForbidden('Unauthorized', 'Action not allowed: "%s" is not a team member' % (challenger))
+
+
+# Time windows a client may have signed with, as (name, window length, offset), in the order they
+# are tried: the current and previous 5 second windows, then the legacy 30 second windows.
+HMAC_WINDOWS = (('current', 5, 0), ('previous', 5, 1), ('long_current', 30, 0), ('long_previous', 30, 1))
+HMAC_WINDOW_STATS = ['app_auth_%s_window' % name for name, _, _ in HMAC_WINDOWS] + \
+    ['app_auth_unquoted_path', 'app_auth_failed']
+
+# Digest variant (window name, quoted path) each application matched last
+app_digest_variants = {}
+
+
+def load_app_key(app_name):
     connection = db.connect()
     cursor = connection.cursor()
-    cursor.execute(query, (team_id, challenger))
-    user_in_team = cursor.rowcount
+    cursor.execute('SELECT `key` FROM `application` WHERE `name` = %s', app_name)
+    api_key = cursor.fetchone()[0].encode('utf-8') if cursor.rowcount > 0 else None
     cursor.close()
     connection.close()
-    if user_in_team != 0 or is_god(challenger):
-        return
-    raise HTTPForbidden('Unauthorized', 'Action not allowed: "%s" is not a team member' % (challenger))
+    return api_key, float('inf')
 
 
-def is_client_digest_valid(client_digest, api_key, window, method, path, body):
+def get_app_key(app_name, reload=False):
+    '''
+    Return an application's API key from cache.app_keys, or None for unknown applications. With reload,
+    the cached key is dropped first, for when a digest fails to verify because the key was rotated.
+    '''
+    if reload:
+        cache.app_keys.discard(app_name)
+    return cache.app_keys.load(app_name, lambda: load_app_key(app_name))
+
+
+def match_client_digest(client_digest, api_key, method, path, body, preferred=None):
+    '''
+    Return the (window name, quoted) variant client_digest was signed with, or None if no variant
+    matches. The digest is decoded once and compared as raw bytes. The preferred variant, usually the
+    one the application matched last, is tried first; paths that need no quoting are only tried once.
+    '''
+    try:
+        client_digest = base64.urlsafe_b64decode(client_digest)
+    except ValueError:
+        return None
+    now = int(time.time())
     # calulate HMAC hash with quoted and unquoted path for legacy client backwards compatibility
-    text = '%s %s %s %s' % (window, method, quote(path), body)
-    HMAC = hmac.new(api_key, text.encode('utf-8'), hashlib.sha512)
-    digest = base64.urlsafe_b64encode(HMAC.digest())
-    if hmac.compare_digest(bytes(client_digest, 'utf-8'), digest):
-        return True
-    text = '%s %s %s %s' % (window, method, path, body)
-    HMAC = hmac.new(api_key, text.encode('utf-8'), hashlib.sha512)
-    digest = base64.urlsafe_b64encode(HMAC.digest())
-    if hmac.compare_digest(bytes(client_digest, 'utf-8'), digest):
-        return True
-    return False
+    paths = {True: quote(path), False: path}
+    variants = [(name, quoted) for name, _, _ in HMAC_WINDOWS for quoted in (True, False)
+                if quoted or paths[True] != paths[False]]
+    if preferred in variants:
+        variants.remove(preferred)
+        variants.insert(0, preferred)
+    windows = {name: (length, offset) for name, length, offset in HMAC_WINDOWS}
+    for name, quoted in variants:
+        length, offset = windows[name]
+        text = '%s %s %s %s' % (now // length - offset, method, paths[quoted], body)
+        digest = hmac.new(api_key, text.encode('utf-8'), hashlib.sha512).digest()
+        if hmac.compare_digest(client_digest, digest):
+            return name, quoted
+    return None
 
 
 def authenticate_application(auth_token, req):
@@ -154,38 +191,41 @@ def authenticate_application(auth_token, req):
     body = req.context['body'].decode('utf-8')
     try:
         app_name, client_digest = auth_token[5:].split(':', 1)
-        connection = db.connect()
-        cursor = connection.cursor()
-        cursor.execute('SELECT `key` FROM `application` WHERE `name` = %s', app_name)
-        if cursor.rowcount > 0:
-            api_key = cursor.fetchone()[0].encode('utf-8')
-            cursor.close()
-            connection.close()
-            window = int(time.time()) // 5
-            long_window = int(time.time()) // 30
-            if is_client_digest_valid(client_digest, api_key, window, method, path, body):
-                req.context['app'] = app_name
-                return
-            elif is_client_digest_valid(client_digest, api_key, window - 1, method, path, body):
-                req.context['app'] = app_name
-                return
-            elif is_client_digest_valid(client_digest, api_key, long_window, method, path, body):
-                req.context['app'] = app_name
-                return
-            elif is_client_digest_valid(client_digest, api_key, long_window - 1, method, path, body):
-                req.context['app'] = app_name
-                return
-            else:
-                raise HTTPUnauthorized('Authentication failure', 'Wrong digest', '')
-        else:
-            cursor.close()
-            connection.close()
+        api_key = get_app_key(app_name)
+        if api_key is None:
             raise HTTPUnauthorized('Authentication failure', 'Application not found', '')
-
+        preferred = app_digest_variants.get(app_name)
+        variant = match_client_digest(client_digest, api_key, method, path, body, preferred)
+        if variant is None and cache.app_keys.max_age:
+            new_key = get_app_key(app_name, reload=True)
+            if new_key is not None and new_key != api_key:
+                variant = match_client_digest(client_digest, new_key, method, path, body, preferred)
+        if variant is None:
+            metrics.stats['app_auth_failed'] += 1
+            raise HTTPUnauthorized('Authentication failure', 'Wrong digest', '')
+
+        window, quoted = variant
+        metrics.stats['app_auth_%s_window' % window] += 1
+        if not quoted:
+            metrics.stats['app_auth_unquoted_path'] += 1
+        if variant != preferred:
+            app_digest_variants[app_name] = variant
+            if window != 'current' or not quoted:
+                logger.info('Application %s signs requests with the %s window%s', app_name, window,
+                            '' if quoted else ' and an unquoted path')
+        req.context['app'] = app_name
     except (ValueError, KeyError):
         raise HTTPUnauthorized('Authentication failure', 'Wrong digest', '')
 
 
+def signed_csrf_token(session_id):
+    '''
+    CSRF token for a session in signed token mode: an HMAC of the beaker session id under the
+    session sign key. Unlike legacy tokens, these are verified without a database lookup.
+    '''
+    return hmac.new(csrf_sign_key, ('csrf:%s' % session_id).encode('utf-8'), hashlib.sha256).hexdigest()
+
+
 def _authenticate_user(req):
     global sso_auth_manager
     # pass the req to the sso_auth_manager so it can check if it has valid SSO headers
@@ -198,6 +238,13 @@ def _authenticate_user(req):
     session = req.env['beaker.session']
     try:
         req.context['user'] = session['user']
+        client_token = req.get_header('X-CSRF-TOKEN')
+
+        # Signed tokens are longer than legacy random ones, which are still looked up in the session table
+        if csrf_sign_key and client_token and len(client_token) == SIGNED_CSRF_TOKEN_LENGTH:
+            if not hmac.compare_digest(client_token, signed_csrf_token(session['_id'])):
+                raise HTTPUnauthorized('Invalid Session', 'CSRF validation failed', '')
+            return
 
         connection = db.connect()
         cursor = connection.cursor()
@@ -209,7 +256,7 @@ def _authenticate_user(req):
             raise HTTPUnauthorized('Invalid Session', 'CSRF token missing', '')
 
         token = cursor.fetchone()[0]
-        if req.get_header('X-CSRF-TOKEN') != token:
+        if client_token != token:
             cursor.close()
             connection.close()
             raise HTTPUnauthorized('Invalid Session', 'CSRF validation failed', '')
@@ -240,7 +287,7 @@ def login_required(function):
     return wrapper
 
 
-def init(application, config):
+def init(application, config, session_config=None):
     global check_team_auth
     global check_user_auth
     global check_calendar_auth
@@ -249,6 +296,10 @@ def init(application, config):
     global auth_manager
     global sso_auth_manager
     global authenticate_user
+    global csrf_sign_key
+
+    if config.get('signed_csrf_tokens'):
+        csrf_sign_key = session_config['sign_key'].encode('utf-8')
 
     if config.get('sso_module'):
         sso_auth = importlib.import_module(config['sso_module'])
@@ -7,7 +7,7 @@ from oncall.api.v0.users import get_user_data
 from ujson import dumps
 from oncall import db
 from random import SystemRandom
-from . import auth_manager
+from . import auth_manager, csrf_sign_key, signed_csrf_token
 
 allow_no_auth = True
 
@@ -34,13 +34,16 @@ def on_post(req, resp):
     session = req.env['beaker.session']
     session['user'] = user
     session.save()
-    csrf_token = '%x' % SystemRandom().getrandbits(128)
-    try:
-        cursor.execute('INSERT INTO `session` (`id`, `csrf_token`) VALUES (%s, %s)',
-                       (req.env['beaker.session']['_id'], csrf_token))
-    except db.IntegrityError:
-        raise HTTPBadRequest('Invalid login attempt', 'User already logged in')
-    connection.commit()
+    if csrf_sign_key:
+        csrf_token = signed_csrf_token(session['_id'])
+    else:
+        csrf_token = '%x' % SystemRandom().getrandbits(128)
+        try:
+            cursor.execute('INSERT INTO `session` (`id`, `csrf_token`) VALUES (%s, %s)',
+                           (req.env['beaker.session']['_id'], csrf_token))
+        except db.IntegrityError:
+            raise HTTPBadRequest('Invalid login attempt', 'User already logged in')
+        connection.commit()
     cursor.close()
     connection.close()
 
@@ -6,13 +6,17 @@ import logging
 import logging.handlers
 import time
 import os
+import signal
+import socket
+from heapq import heapify, heappop, heappush
+from itertools import count
 from importlib import import_module
 from ujson import loads as json_loads
-from gevent import queue, spawn, sleep
+from gevent import joinall, killall, queue, spawn, sleep, signal_handler
 
 from oncall import db, metrics
-from oncall.messengers import init_messengers, send_message
-from oncall.notifier import reminder, user_validator
+from oncall.messengers import MessengerUnavailable, init_messengers, send_message
+from oncall.notifier import reminder, user_validator, queue_archiver
 
 # logging
 logger = logging.getLogger()
@@ -32,6 +36,40 @@ send_queue = queue.Queue()
 
 default_timezone = None
 
+# Queue rows are claimed in batches of at most claim_batch_size for lease_seconds. With shard_count
+# notifiers, each only claims rows whose CRC32(user_id) % shard_count equals its shard_index.
+claim_batch_size = 1000
+lease_seconds = 600
+shard_index = 0
+shard_count = 1
+instance_id = '%s:%s' % (socket.gethostname(), os.getpid())
+claim_ids = count()
+
+# Ids of sent (True) and failed (False) messages not yet marked in the queue. Flushed when
+# ack_batch_size ids are buffered, every ack_flush_interval seconds, and on shutdown.
+acks = {True: [], False: []}
+ack_batch_size = 100
+ack_flush_interval = 0.5
+# Ids of messages no messenger could take (rate limited, saturated or circuit open), by the time their
+# lease is cut to on the next flush. They stay active and are claimed again once that time has passed.
+deferred = {}
+retry_delay = 30
+# Seconds to wait on shutdown for workers to send the messages already claimed
+shutdown_timeout = 35
+
+# Min-heap of (send_time, id) of unclaimed messages in this shard due within lookahead seconds. The main
+# loop sleeps until the earliest of them. The heap is rebuilt every refresh_interval seconds, and rows
+# queued after last_seen_id are added every new_rows_interval seconds.
+due_times = []
+last_seen_id = 0
+lookahead = 300
+refresh_interval = 60
+new_rows_interval = 5
+# Seconds before retrying a claim that left due messages behind (full send queue or full batch)
+claim_retry_interval = 1
+
+SHARD_CONDITION = 'CRC32(`user_id`) %% %s = %s'
+
 
 def load_config_file(config_path):
     with open(config_path, 'r', encoding='utf-8') as h:
@@ -52,6 +90,19 @@ def init_notifier(config):
     db.init(config['db'])
     global default_timezone
     default_timezone = config['notifier'].get('default_timezone', 'US/Pacific')
+    global claim_batch_size, lease_seconds, shard_index, shard_count, ack_batch_size, ack_flush_interval
+    global lookahead, refresh_interval, new_rows_interval, retry_delay, shutdown_timeout
+    claim_batch_size = config['notifier'].get('claim_batch_size', claim_batch_size)
+    lease_seconds = config['notifier'].get('lease_seconds', lease_seconds)
+    shard_index = config['notifier'].get('shard_index', shard_index)
+    shard_count = config['notifier'].get('shard_count', shard_count)
+    ack_batch_size = config['notifier'].get('ack_batch_size', ack_batch_size)
+    ack_flush_interval = config['notifier'].get('ack_flush_interval_ms', ack_flush_interval * 1000) / 1000.0
+    lookahead = config['notifier'].get('lookahead', lookahead)
+    refresh_interval = config['notifier'].get('refresh_interval', refresh_interval)
+    new_rows_interval = config['notifier'].get('new_rows_interval', new_rows_interval)
+    retry_delay = config['notifier'].get('retry_delay', retry_delay)
+    shutdown_timeout = config['notifier'].get('shutdown_timeout', shutdown_timeout)
     if config['notifier']['skipsend']:
         global send_message
         send_message = blackhole
@@ -63,51 +114,209 @@ def blackhole(msg):
 
 
 def mark_message_as_sent(msg_info):
-    connection = db.connect()
-    cursor = connection.cursor()
-    cursor.execute('UPDATE `notification_queue` SET `active` = 0, `sent` = 1 WHERE `id` = %s',
-                   msg_info['id'])
-    connection.commit()
-    connection.close()
-    cursor.close()
+    ack_message(msg_info, True)
 
 
 def mark_message_as_unsent(msg_info):
-    connection = db.connect()
-    cursor = connection.cursor()
-    cursor.execute('UPDATE `notification_queue` SET `active` = 0, `sent` = 0 WHERE `id` = %s',
-                   msg_info['id'])
-    connection.commit()
-    connection.close()
-    cursor.close()
+    ack_message(msg_info, False)
+
+
+def ack_message(msg_info, sent):
+    acks[sent].append(msg_info['id'])
+    if len(acks[True]) + len(acks[False]) >= ack_batch_size:
+        flush_acks()
+
+
+def defer_message(msg_info, delay):
+    '''
+    Leave a message active, to be claimed again after delay seconds
+    '''
+    claimed_until = int(time.time()) + delay
+    deferred.setdefault(claimed_until, []).append(msg_info['id'])
+    # Claims only take rows whose lease has run out, i.e. claimed_until < UNIX_TIMESTAMP()
+    heappush(due_times, (claimed_until + 1, msg_info['id']))
+    if len(acks[True]) + len(acks[False]) + sum(map(len, deferred.values())) >= ack_batch_size:
+        flush_acks()
+
+
+def flush_acks():
+    '''
+    Deactivate buffered messages with one UPDATE per outcome, and shorten the lease of deferred ones.
+    Ids are put back in the buffer if the update fails, to be retried by the next flush.
+    '''
+    global acks, deferred
+    buffered, acks = acks, {True: [], False: []}
+    retries, deferred = deferred, {}
+    if not (buffered[True] or buffered[False] or retries):
+        return
+    try:
+        connection = db.connect()
+        cursor = connection.cursor()
+        for sent, ids in buffered.items():
+            if ids:
+                cursor.execute('UPDATE `notification_queue` SET `active` = 0, `sent` = %s WHERE `id` IN %s',
+                               (int(sent), ids))
+        for claimed_until, ids in retries.items():
+            cursor.execute('''UPDATE `notification_queue` SET `claimed_until` = %s
+                              WHERE `id` IN %s AND `active` = 1''',
+                           (claimed_until, ids))
+        connection.commit()
+        cursor.close()
+        connection.close()
+    except Exception:
+        logger.exception('Failed to mark %s messages as sent/unsent/deferred',
+                         len(buffered[True]) + len(buffered[False]) + sum(map(len, retries.values())))
+        for sent, ids in buffered.items():
+            acks[sent].extend(ids)
+        for claimed_until, ids in retries.items():
+            deferred.setdefault(claimed_until, []).extend(ids)
+
+
+def ack_flusher():
+    while True:
+        sleep(ack_flush_interval)
+        flush_acks()
 
 
 def poll():
+    '''
+    Claim due messages in this notifier's shard and queue them for sending. Claimed rows are leased to
+    this claim's token until they are marked sent/unsent or the lease runs out, so other notifiers (and
+    later polls of this one) skip messages still in flight. Returns whether every due message could be
+    claimed, i.e. the claim was neither skipped nor cut off by the batch size.
+    '''
+    limit = claim_batch_size - send_queue.qsize()
+    if limit <= 0:
+        logger.warning('[-] send queue is full, skipping claim')
+        return False
+    claim = '%s:%s' % (instance_id, next(claim_ids))
     query = '''SELECT `user`.`name` AS `user`, `contact_mode`.`name` AS `mode`, `notification_queue`.`send_time`,
                       `user`.`time_zone`,`notification_type`.`subject`, `notification_queue`.`context`,
-                      `notification_type`.`body`, `notification_queue`.`id`
+                      `notification_type`.`body`, `notification_queue`.`id`, `notification_queue`.`claimed_until`
                FROM `notification_queue` JOIN `user` ON `notification_queue`.`user_id` = `user`.`id`
                    JOIN `contact_mode` ON `notification_queue`.`mode_id` = `contact_mode`.`id`
                    JOIN `notification_type` ON `notification_queue`.`type_id` = `notification_type`.`id`
-               WHERE `notification_queue`.`active` = 1 AND `notification_queue`.`send_time` <= UNIX_TIMESTAMP()'''
+               WHERE `notification_queue`.`claimed_by` = %s AND `notification_queue`.`active` = 1'''
     logger.info('[-] start send task...')
 
     connection = db.connect()
     cursor = connection.cursor(db.DictCursor)
-    cursor.execute(query)
-    for row in cursor:
-        send_queue.put(row)
+    cursor.execute('''UPDATE `notification_queue`
+                      SET `claimed_by` = %s, `claimed_until` = UNIX_TIMESTAMP() + %s
+                      WHERE `active` = 1 AND `send_time` <= UNIX_TIMESTAMP()
+                          AND (`claimed_until` IS NULL OR `claimed_until` < UNIX_TIMESTAMP())
+                          AND ''' + SHARD_CONDITION + '''
+                      ORDER BY `send_time`
+                      LIMIT %s''',
+                   (claim, lease_seconds, shard_count, shard_index, limit))
+    claimed = cursor.rowcount
+    connection.commit()
+    if claimed:
+        cursor.execute(query, claim)
+        for row in cursor:
+            send_queue.put(row)
+    metrics.stats['message_claimed_cnt'] += claimed
     cursor.close()
     connection.close()
+    return claimed < limit
 
 
-def worker():
-    while 1:
-        format_and_send_message()
+def load_due_times():
+    '''
+    Rebuild the due_times heap from the active, unclaimed messages in this shard due within the
+    look-ahead window (including overdue ones whose lease expired)
+    '''
+    global due_times, last_seen_id
+    connection = db.connect()
+    cursor = connection.cursor()
+    cursor.execute('SELECT MAX(`id`) FROM `notification_queue`')
+    last_seen_id = cursor.fetchone()[0] or 0
+    cursor.execute('''SELECT `send_time`, `id` FROM `notification_queue`
+                      WHERE `active` = 1 AND `send_time` <= UNIX_TIMESTAMP() + %s
+                          AND (`claimed_until` IS NULL OR `claimed_until` < UNIX_TIMESTAMP())
+                          AND ''' + SHARD_CONDITION,
+                   (lookahead, shard_count, shard_index))
+    due_times = [tuple(row) for row in cursor]
+    heapify(due_times)
+    cursor.close()
+    connection.close()
+
 
+def load_new_due_times():
+    '''
+    Add messages queued since the last load to the due_times heap. Only scans ids above last_seen_id,
+    so it's cheap enough to run every few seconds.
+    '''
+    global last_seen_id
+    connection = db.connect()
+    cursor = connection.cursor()
+    cursor.execute('''SELECT `send_time`, `id`, ''' + SHARD_CONDITION + ''' FROM `notification_queue`
+                      WHERE `id` > %s AND `active` = 1''',
+                   (shard_count, shard_index, last_seen_id))
+    horizon = time.time() + lookahead
+    for send_time, msg_id, in_shard in cursor:
+        last_seen_id = max(last_seen_id, msg_id)
+        if in_shard and send_time <= horizon:
+            heappush(due_times, (send_time, msg_id))
+    cursor.close()
+    connection.close()
 
-def format_and_send_message():
-    msg_info = send_queue.get()
+
+def pop_due_times(now):
+    '''
+    Pop the messages due by now off the due_times heap, returning whether there were any
+    '''
+    due = False
+    while due_times and due_times[0][0] <= now:
+        heappop(due_times)
+        due = True
+    return due
+
+
+def claim_due(now):
+    '''
+    Claim messages if any are due by now, returning when the next claim is due (None if the heap is
+    empty). Due entries stay on the heap until a claim takes every due message, so a skipped or
+    truncated claim is retried after claim_retry_interval instead of waiting for the next refresh.
+    '''
+    if due_times and due_times[0][0] <= now:
+        if not poll():
+            return now + claim_retry_interval
+        pop_due_times(now)
+    return due_times[0][0] if due_times else None
+
+
+def worker():
+    # Runs until stop_workers queues a StopIteration
+    for msg_info in send_queue:
+        format_and_send_message(msg_info)
+
+
+def stop_workers(worker_tasks):
+    '''
+    Let the workers send the messages already claimed, for up to shutdown_timeout seconds, so the final
+    flush acks them. Messages still queued after that are released for the next claim. Sends cut off
+    mid-flight keep their lease, as their outcome is unknown.
+    '''
+    for _ in worker_tasks:
+        send_queue.put(StopIteration)
+    joinall(worker_tasks, timeout=shutdown_timeout)
+    busy = [task for task in worker_tasks if not task.ready()]
+    if busy:
+        logger.warning('Stopping %s workers still sending after %s seconds', len(busy), shutdown_timeout)
+        killall(busy)
+    while send_queue.qsize():
+        msg_info = send_queue.get()
+        if msg_info is not StopIteration:
+            defer_message(msg_info, 0)
+
+
+def format_and_send_message(msg_info):
+    if msg_info.get('claimed_until') and msg_info['claimed_until'] < time.time():
+        # Another notifier may have claimed this message since, leave it to the next claim
+        logger.warning('Lease on message %s expired before sending', msg_info['id'])
+        metrics.stats['message_lease_expired_cnt'] += 1
+        return
     msg = {}
     msg['user'] = msg_info['user']
     msg['mode'] = msg_info['mode']
@@ -116,6 +325,10 @@ def format_and_send_message():
     msg['body'] = msg_info['body'] % context
     try:
         send_message(msg)
+    except MessengerUnavailable:
+        logger.warning('No messenger available for message %s, retrying in %s seconds', msg_info['id'], retry_delay)
+        defer_message(msg_info, retry_delay)
+        metrics.stats['message_deferred_cnt'] += 1
     except Exception:
         logger.exception('Failed to send message %s', msg)
         mark_message_as_unsent(msg_info)
@@ -138,7 +351,10 @@ def main():
     init_notifier(config)
     metrics_on = False
     if 'metrics' in config:
-        metrics.init(config, 'oncall-notifier', {'message_blackhole_cnt': 0, 'message_sent_cnt': 0, 'message_fail_cnt': 0})
+        default_stats = {'message_blackhole_cnt': 0, 'message_sent_cnt': 0, 'message_fail_cnt': 0,
+                         'message_claimed_cnt': 0, 'message_lease_expired_cnt': 0, 'message_deferred_cnt': 0}
+        default_stats.update({stat: 0 for stat in db.POOL_STATS})
+        metrics.init(config, 'oncall-notifier', default_stats)
         metrics_worker = spawn(metrics_sender)
         metrics_on = True
     else:
@@ -155,40 +371,66 @@ def main():
     if config['user_validator']['activated']:
         validator_worker = spawn(user_validator.user_validator, config['user_validator'])
         validator_on = True
+    archiver_config = config.get('queue_archiver', {})
+    archiver_on = False
+    if archiver_config.get('activated'):
+        archiver_worker = spawn(queue_archiver.queue_archiver, archiver_config)
+        archiver_on = True
 
-    interval = 60
+    ack_worker = spawn(ack_flusher)
 
     logger.info('[*] notifier bootstrapped')
-    while True:
-        runtime = int(time.time())
-        logger.info('--> notifier loop started.')
-        poll()
-
-        # check status for all background greenlets and respawn if necessary
-        bad_workers = []
-        for i, task in enumerate(worker_tasks):
-            if not bool(task):
-                logger.error("worker task failed, %s", task.exception)
-                bad_workers.append(i)
-        for i in bad_workers:
-            worker_tasks[i] = spawn(worker)
-        # Check greenlet health for metrics, reminder, and validator tasks
-        if metrics_on and not bool(metrics_worker):
-            logger.error("metrics worker failed, %s", metrics_worker.exception)
-            metrics_worker = spawn(metrics_sender)
-        if reminder_on and not bool(reminder_worker):
-            logger.error("reminder worker failed, %s", reminder_worker.exception)
-            reminder_worker = spawn(reminder.reminder, config['reminder'])
-        if validator_on and not bool(validator_worker):
-            logger.error("user validator failed, %s", validator_worker.exception)
-            validator_worker = spawn(user_validator.user_validator, config['user_validator'])
-
-        now = time.time()
-        elapsed_time = now - runtime
-        nap_time = max(0, interval - elapsed_time)
-        logger.info('--> notifier loop finished in %s seconds - sleeping %s seconds',
-                    elapsed_time, nap_time)
-        sleep(nap_time)
+    # Exit through the finally below on SIGTERM, so in-flight sends finish and buffered acks are written
+    signal_handler(signal.SIGTERM, sys.exit, 0)
+    next_refresh = next_new_rows = 0
+    try:
+        while True:
+            now = time.time()
+            if now >= next_refresh:
+                logger.info('--> notifier refresh started.')
+                load_due_times()
+                next_refresh = now + refresh_interval
+                next_new_rows = now + new_rows_interval
+
+                # check status for all background greenlets and respawn if necessary
+                bad_workers = []
+                for i, task in enumerate(worker_tasks):
+                    if not bool(task):
+                        logger.error("worker task failed, %s", task.exception)
+                        bad_workers.append(i)
+                for i in bad_workers:
+                    worker_tasks[i] = spawn(worker)
+                # Check greenlet health for metrics, reminder, and validator tasks
+                if metrics_on and not bool(metrics_worker):
+                    logger.error("metrics worker failed, %s", metrics_worker.exception)
+                    metrics_worker = spawn(metrics_sender)
+                if reminder_on and not bool(reminder_worker):
+                    logger.error("reminder worker failed, %s", reminder_worker.exception)
+                    reminder_worker = spawn(reminder.reminder, config['reminder'])
+                if validator_on and not bool(validator_worker):
+                    logger.error("user validator failed, %s", validator_worker.exception)
+                    validator_worker = spawn(user_validator.user_validator, config['user_validator'])
+                if archiver_on and not bool(archiver_worker):
+                    logger.error("queue archiver failed, %s", archiver_worker.exception)
+                    archiver_worker = spawn(queue_archiver.queue_archiver, archiver_config)
+                if not bool(ack_worker):
+                    logger.error("ack flusher failed, %s", ack_worker.exception)
+                    ack_worker = spawn(ack_flusher)
+                logger.info('--> notifier refresh finished in %s seconds, %s messages due within %s seconds',
+                            time.time() - now, len(due_times), lookahead)
+            elif now >= next_new_rows:
+                load_new_due_times()
+                next_new_rows = now + new_rows_interval
+
+            next_due = claim_due(now) or next_refresh
+
+            # Wake up when the next message is due, or for the next refresh or new rows check
+            wake_time = min(next_refresh, next_new_rows, next_due)
+            sleep(max(0, wake_time - time.time()))
+    finally:
+        # No more claims past this point
+        stop_workers(worker_tasks)
+        flush_acks()
 
 
 if __name__ == '__main__':
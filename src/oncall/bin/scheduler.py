@@ -6,13 +6,16 @@
 # -*- coding:utf-8 -*-
 import sys
 import time
+import json
+import re
 import importlib
 import os
 import logging
 import logging.handlers
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from oncall import db, utils
+from oncall import db, utils, metrics, cache
 from oncall.api.v0.schedules import get_schedules
 
 logger = logging.getLogger()
@@ -26,17 +29,284 @@ ch.setFormatter(formatter)
 logger.setLevel(logging.INFO)
 logger.addHandler(ch)
 
+# Schedulers loaded by this process. Worker processes load their own copies on demand.
+schedulers = {}
+
 
 def load_scheduler(scheduler_name):
     return importlib.import_module('oncall.scheduler.' + scheduler_name).Scheduler()
 
 
+def get_scheduler(scheduler_name):
+    if scheduler_name not in schedulers:
+        schedulers[scheduler_name] = load_scheduler(scheduler_name)
+    return schedulers[scheduler_name]
+
+
+def init_worker(db_config):
+    # Engines can't be shared across a fork, so each worker process sets up its own
+    db.init(db_config)
+
+
+def get_team_groups(teams, cursor):
+    '''
+    Partition teams into groups that must be scheduled serially, in the order given. Subscribed teams'
+    events are part of a team's conflict checks, so teams linked by a subscription go in the same group.
+    Schedulers that check conflicts across all teams also pull in every team sharing a roster user.
+    Subscriptions are read from the teams if hydrated by load_teams, and queried otherwise.
+    '''
+    parents = {team['id']: team['id'] for team in teams}
+
+    def find(team_id):
+        while parents[team_id] != team_id:
+            parents[team_id] = parents[parents[team_id]]
+            team_id = parents[team_id]
+        return team_id
+
+    def union(team_id, other_id):
+        if team_id in parents and other_id in parents:
+            parents[find(team_id)] = find(other_id)
+
+    if all('subscriptions' in team for team in teams):
+        for team in teams:
+            for subscription_id, _ in team['subscriptions']:
+                union(team['id'], subscription_id)
+    else:
+        cursor.execute('SELECT `team_id`, `subscription_id` FROM `team_subscription`')
+        for row in cursor:
+            union(row['team_id'], row['subscription_id'])
+
+    cross_team = [name for name, scheduler in schedulers.items() if scheduler.cross_team_conflicts]
+    if cross_team:
+        cursor.execute('''SELECT DISTINCT `roster`.`team_id`, `roster_user`.`user_id` FROM `roster_user`
+                          JOIN `roster` ON `roster`.`id` = `roster_user`.`roster_id`
+                          WHERE `roster_user`.`user_id` IN (
+                              SELECT `ru`.`user_id` FROM `schedule`
+                              JOIN `scheduler` ON `scheduler`.`id` = `schedule`.`scheduler_id`
+                              JOIN `roster_user` AS `ru` ON `ru`.`roster_id` = `schedule`.`roster_id`
+                              WHERE `scheduler`.`name` IN %s)''',
+                       (cross_team,))
+        user_teams = {}
+        for row in cursor:
+            if row['user_id'] in user_teams:
+                union(row['team_id'], user_teams[row['user_id']])
+            else:
+                user_teams[row['user_id']] = row['team_id']
+
+    groups = defaultdict(list)
+    for team in teams:
+        groups[find(team['id'])].append(team)
+    return list(groups.values())
+
+
+def load_teams(team_ids, dbinfo):
+    '''
+    Load active teams with their schedules (including schedule events and roster orders) and subscriptions
+    in a few queries, so that scheduling them needs no further lookups of either.
+    '''
+    if not team_ids:
+        return []
+    connection, cursor = dbinfo
+    cursor.execute('SELECT id, name, scheduling_timezone FROM team WHERE active = TRUE AND id IN %s',
+                   (list(team_ids),))
+    teams = cursor.fetchall()
+    if not teams:
+        return teams
+    team_ids = [team['id'] for team in teams]
+
+    subscriptions = defaultdict(list)
+    cursor.execute('SELECT `team_id`, `subscription_id`, `role_id` FROM `team_subscription` WHERE `team_id` IN %s',
+                   (team_ids,))
+    for row in cursor:
+        subscriptions[row['team_id']].append((row['subscription_id'], row['role_id']))
+    schedules = defaultdict(list)
+    for schedule in get_schedules({}, dbinfo=(connection, cursor), team_ids=team_ids):
+        schedules[schedule['team_id']].append(schedule)
+
+    for team in teams:
+        team['subscriptions'] = subscriptions[team['id']]
+        team['schedules'] = schedules[team['id']]
+    return teams
+
+
+def schedule_team(team, dbinfo, schedule_ids=None):
+    '''
+    Schedule one team, returning a dict with the number of schedules processed, events created and
+    seconds spent in each scheduler
+    '''
+    logger.info('scheduling for team: %s', team['name'])
+    stats = {'schedules': 0, 'events': 0, 'scheduler_time': {}}
+    schedule_map = defaultdict(list)
+    schedules = team['schedules'] if 'schedules' in team else get_schedules({'team_id': team['id']}, dbinfo=dbinfo)
+    for schedule in schedules:
+        if schedule_ids is None or schedule['id'] in schedule_ids:
+            schedule_map[schedule['scheduler']['name']].append(schedule)
+
+    for scheduler_name, schedules in schedule_map.items():
+        try:
+            scheduler = get_scheduler(scheduler_name)
+        except (ImportError, AttributeError):
+            logger.exception('Failed to load scheduler %s, skipping', scheduler_name)
+            continue
+        start = time.time()
+        stats['events'] += scheduler.schedule(team, schedules, dbinfo) or 0
+        stats['schedules'] += len(schedules)
+        stats['scheduler_time'][scheduler_name] = time.time() - start
+    return stats
+
+
+def schedule_team_group(teams, schedule_ids=None):
+    '''
+    Schedule a group of teams on a dedicated connection. Each team is committed on its own, so a
+    failure only rolls back the team being scheduled. If schedule_ids is given, only those schedules
+    are processed. Returns a timing trace for each team, which is how stats get back from worker processes.
+    '''
+    connection = db.connect()
+    cursor = db.CountingCursor(connection.cursor(db.DictCursor))
+    traces = []
+    try:
+        for team in teams:
+            start = time.time()
+            queries, sql_time = cursor.queries, cursor.sql_time
+            trace = {'team': team['name'], 'failed': False}
+            try:
+                trace.update(schedule_team(team, (connection, cursor), schedule_ids))
+            except Exception:
+                logger.exception('Failed to schedule team %s', team['name'])
+                connection.rollback()
+                trace['failed'] = True
+            trace['time'] = time.time() - start
+            trace['queries'] = cursor.queries - queries
+            trace['sql_time'] = cursor.sql_time - sql_time
+            traces.append(trace)
+    finally:
+        cursor.close()
+        connection.close()
+    return traces
+
+
+def metric_name(scheduler_name):
+    # Metrics providers only accept alphanumerics and underscores
+    return 'scheduler_%s_time' % re.sub('[^a-zA-Z0-9]+', '_', scheduler_name)
+
+
+def record_cycle(traces, cycle_start, num_due, num_skipped, trace_file=None):
+    '''
+    Set this pass's stats from the team traces and emit them. If trace_file is set, the traces are also
+    written to it as JSON, slowest first.
+    '''
+    traces = sorted(traces, key=lambda trace: trace['time'], reverse=True)
+    cycle_time = time.time() - cycle_start
+    scheduler_time = defaultdict(float)
+    for trace in traces:
+        for scheduler_name, seconds in trace.get('scheduler_time', {}).items():
+            scheduler_time[scheduler_name] += seconds
+
+    metrics.stats['cycle_time'] = cycle_time
+    metrics.stats['teams_processed'] = len(traces)
+    metrics.stats['teams_failed'] = sum(1 for trace in traces if trace['failed'])
+    metrics.stats['schedules_processed'] = num_due
+    metrics.stats['schedules_skipped'] = num_skipped
+    metrics.stats['events_created'] = sum(trace.get('events', 0) for trace in traces)
+    metrics.stats['sql_queries'] = sum(trace['queries'] for trace in traces)
+    metrics.stats['sql_time'] = sum(trace['sql_time'] for trace in traces)
+    metrics.stats['slowest_team_time'] = traces[0]['time'] if traces else 0
+    for scheduler_name in schedulers:
+        metrics.stats[metric_name(scheduler_name)] = scheduler_time[scheduler_name]
+    metrics.emit_metrics()
+
+    for trace in traces[:5]:
+        logger.info('Slow team %s: %.3fs, %s queries, %.3fs in SQL', trace['team'], trace['time'], trace['queries'],
+                    trace['sql_time'])
+    if trace_file:
+        try:
+            with open(trace_file, 'w') as f:
+                json.dump({'start': cycle_start, 'duration': cycle_time, 'teams': traces}, f, indent=2)
+        except IOError:
+            logger.exception('Failed to write scheduler trace to %s', trace_file)
+
+
+def get_due_times(cursor, schedule_ids=None):
+    '''
+    Find when schedules of active teams next need work, based on their last scheduled epoch. Returns a
+    dict mapping schedule id to (due time, team id), where the due time is None for schedules that are
+    never auto-populated. If schedule_ids is given, only those schedules are looked up.
+    '''
+    query = '''SELECT `schedule`.`id`, `schedule`.`team_id`, `schedule`.`last_epoch_scheduled`,
+                      `schedule`.`auto_populate_threshold`, `team`.`scheduling_timezone` AS `timezone`,
+                      `scheduler`.`name` AS `scheduler`, `schedule_event`.`start`, `schedule_event`.`duration`
+               FROM `schedule`
+               JOIN `team` ON `team`.`id` = `schedule`.`team_id`
+               JOIN `scheduler` ON `scheduler`.`id` = `schedule`.`scheduler_id`
+               JOIN `schedule_event` ON `schedule_event`.`schedule_id` = `schedule`.`id`
+               WHERE `team`.`active` = TRUE'''
+    if schedule_ids is not None:
+        if not schedule_ids:
+            return {}
+        query += ' AND `schedule`.`id` IN %s'
+        cursor.execute(query, (list(schedule_ids),))
+    else:
+        cursor.execute(query)
+
+    schedules = {}
+    for row in cursor:
+        if row['id'] not in schedules:
+            schedules[row['id']] = dict(row, events=[])
+        schedules[row['id']]['events'].append({'start': row['start'], 'duration': row['duration']})
+
+    due_times = {}
+    for schedule_id, schedule in schedules.items():
+        try:
+            scheduler = get_scheduler(schedule['scheduler'])
+        except (ImportError, AttributeError):
+            continue
+        due_times[schedule_id] = (scheduler.get_next_due_time(schedule, schedule['last_epoch_scheduled']),
+                                  schedule['team_id'])
+    return due_times
+
+
+def claim_dirty_schedules(connection, cursor):
+    '''
+    Fetch and clear the dirty flag on schedules. Rows are locked until the flags are cleared, so marks made
+    concurrently are picked up on the next poll instead of being lost.
+    '''
+    cursor.execute('SELECT `id` FROM `schedule` WHERE `dirty` = TRUE FOR UPDATE')
+    schedule_ids = [row['id'] for row in cursor]
+    if schedule_ids:
+        cursor.execute('UPDATE `schedule` SET `dirty` = FALSE WHERE `id` IN %s', (schedule_ids,))
+    connection.commit()
+    return schedule_ids
+
+
+def get_worker_pool(config):
+    worker_count = config.get('scheduler_workers', 1)
+    if worker_count <= 1:
+        return None
+    if config.get('scheduler_worker_type', 'thread') == 'process':
+        return ProcessPoolExecutor(max_workers=worker_count, initializer=init_worker, initargs=(config['db'],))
+    return ThreadPoolExecutor(max_workers=worker_count)
+
+
 def main():
     config = utils.read_config(sys.argv[1])
     db.init(config['db'])
+    cache.init(config.get('cache', {}))
 
+    # Every schedule is re-evaluated once per cycle. In between, only schedules marked dirty by writes or
+    # whose next epoch has come within their auto-populate threshold are processed.
     cycle_time = config.get('scheduler_cycle_time', 3600)
-    schedulers = {}
+    poll_interval = config.get('scheduler_poll_interval', 60)
+    trace_file = config.get('scheduler_trace_file')
+    pool = get_worker_pool(config)
+    if 'metrics' in config:
+        metrics.init(config, 'oncall-scheduler', {stat: 0 for stat in db.POOL_STATS})
+    else:
+        logger.warning('Not running with metrics')
+
+    # Schedule id -> (next due time, team id). Due times are None for schedules never auto-populated, which
+    # only full scans process. A filter over this per poll is cheap next to the scheduling it gates.
+    due_times = {}
+    last_full_scan = 0
 
     while 1:
         connection = db.connect()
@@ -45,38 +315,69 @@ def main():
         start = time.time()
         # Load all schedulers
         db_cursor.execute('SELECT name FROM scheduler')
-        schedulers = {}
         for row in db_cursor:
             try:
-                scheduler_name = row['name']
-                if scheduler_name not in schedulers:
-                    schedulers[scheduler_name] = load_scheduler(scheduler_name)
+                get_scheduler(row['name'])
             except (ImportError, AttributeError):
                 logger.exception('Failed to load scheduler %s, skipping', row['name'])
 
-        # Iterate through all teams
-        db_cursor.execute('SELECT id, name, scheduling_timezone FROM team WHERE active = TRUE')
-        teams = db_cursor.fetchall()
-        for team in teams:
-            logger.info('scheduling for team: %s', team['name'])
-            schedule_map = defaultdict(list)
-            for schedule in get_schedules({'team_id': team['id']}):
-                schedule_map[schedule['scheduler']['name']].append(schedule)
+        dirty_ids = claim_dirty_schedules(connection, db_cursor)
+        if start - last_full_scan >= cycle_time:
+            due_times = {schedule_id: (start if due is None else due, team_id)
+                         for schedule_id, (due, team_id) in get_due_times(db_cursor).items()}
+            last_full_scan = start
+        else:
+            due_times.update(get_due_times(db_cursor, dirty_ids))
+        for schedule_id in dirty_ids:
+            if schedule_id in due_times:
+                due_times[schedule_id] = (start, due_times[schedule_id][1])
 
-            for scheduler_name, schedules in schedule_map.items():
-                schedulers[scheduler_name].schedule(team, schedules, (connection, db_cursor))
+        # Schedule the teams of everything that's due
+        due_ids = {schedule_id for schedule_id, (due, _) in due_times.items() if due is not None and due <= start}
+        team_ids = {due_times[schedule_id][1] for schedule_id in due_ids}
+        logger.info('%s schedules due across %s teams, %s marked dirty', len(due_ids), len(team_ids), len(dirty_ids))
+
+        teams = load_teams(team_ids, (connection, db_cursor))
+        groups = get_team_groups(teams, db_cursor)
+        db_cursor.close()
+        connection.close()
 
-        # Sleep until next time
-        sleep_time = cycle_time - (time.time() - start)
+        traces = []
+        if pool is None:
+            for group in groups:
+                traces += schedule_team_group(group, due_ids)
+        else:
+            # Hand out the largest groups first so they don't end up as stragglers
+            groups.sort(key=len, reverse=True)
+            for future in [pool.submit(schedule_team_group, group, due_ids) for group in groups]:
+                traces += future.result()
+        record_cycle(traces, start, len(due_ids), len(due_times) - len(due_ids), trace_file)
+        cache.invalidate_teams([trace['team'] for trace in traces if trace.get('events')])
+
+        # Work out when processed schedules are next due. Schedules that are still due failed, so retry
+        # them next cycle rather than on every poll.
+        if due_ids:
+            connection = db.connect()
+            db_cursor = connection.cursor(db.DictCursor)
+            now = time.time()
+            for schedule_id in due_ids:
+                due_times.pop(schedule_id, None)
+            for schedule_id, (due, team_id) in get_due_times(db_cursor, due_ids).items():
+                if due is not None and due <= now:
+                    due = now + cycle_time
+                due_times[schedule_id] = (due, team_id)
+            db_cursor.close()
+            connection.close()
+
+        # Sleep until the next schedule is due, checking for dirty schedules in the meantime
+        next_due = min([due for due, _ in due_times.values() if due is not None] + [last_full_scan + cycle_time])
+        sleep_time = min(next_due, start + poll_interval) - time.time()
         if sleep_time > 0:
             logger.info('Sleeping for %s seconds' % sleep_time)
-            time.sleep(cycle_time - (time.time() - start))
+            time.sleep(sleep_time)
         else:
             logger.info('Schedule loop took %s seconds, skipping sleep' % (time.time() - start))
 
-        db_cursor.close()
-        connection.close()
-
 
 if __name__ == '__main__':
     main()
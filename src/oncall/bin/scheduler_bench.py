@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# -*- coding:utf-8 -*-
+'''
+Benchmark schedulers against a synthetic fleet of teams.
+
+By default the fleet lives in an in-memory SQLite database behind a cursor that accepts the scheduler's
+MySQL queries. Pass a config file to run against the MySQL database it points to instead; the fleet is
+inserted into that database and left there, so only ever point this at a scratch database.
+
+    oncall-scheduler-bench --teams 10000 --save-baseline baseline.json
+    oncall-scheduler-bench --teams 10000 --baseline baseline.json
+    oncall-scheduler-bench --config configs/config.yaml --scheduler default
+'''
+import argparse
+import json
+import logging
+import random
+import sqlite3
+import sys
+import time
+
+from pymysql.converters import encoders, escape_item
+
+from oncall import db, utils
+from oncall.constants import EVENT_CREATED
+from oncall.bin.scheduler import load_scheduler
+
+logger = logging.getLogger(__name__)
+
+SCHEDULERS = ['default', 'round-robin', 'no-skip-matching', 'multi-team']
+TIMEZONES = ['US/Pacific', 'US/Eastern', 'Europe/London', 'Asia/Kolkata', 'UTC']
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+# Schedule event templates, as offsets from Sunday 00:00 in the team's timezone
+SHIFT_PATTERNS = {
+    'weekly': [{'start': DAY + 10 * 60 * 60, 'duration': WEEK}],
+    '12-hour': [{'start': day * DAY + half * 12 * 60 * 60, 'duration': 12 * 60 * 60}
+                for day in range(7) for half in range(2)],
+    'biweekly': [{'start': DAY + 10 * 60 * 60, 'duration': 2 * WEEK}],
+}
+
+SQLITE_SCHEMA = '''
+CREATE TABLE `team` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT NOT NULL UNIQUE,
+                     `scheduling_timezone` TEXT, `active` INTEGER NOT NULL DEFAULT 1,
+                     `version` INTEGER NOT NULL DEFAULT 0, `last_modified` INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE `user` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT NOT NULL UNIQUE,
+                     `active` INTEGER NOT NULL DEFAULT 1, `full_name` TEXT, `time_zone` TEXT);
+CREATE TABLE `role` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT NOT NULL UNIQUE,
+                     `display_order` INTEGER NOT NULL DEFAULT 1);
+CREATE TABLE `scheduler` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT NOT NULL UNIQUE,
+                          `description` TEXT NOT NULL DEFAULT '');
+CREATE TABLE `contact_mode` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT NOT NULL UNIQUE);
+CREATE TABLE `notification_type` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT NOT NULL UNIQUE);
+CREATE TABLE `roster` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT NOT NULL, `team_id` INTEGER NOT NULL);
+CREATE TABLE `roster_user` (`roster_id` INTEGER NOT NULL, `user_id` INTEGER NOT NULL,
+                            `in_rotation` INTEGER NOT NULL DEFAULT 1, `roster_priority` INTEGER NOT NULL,
+                            PRIMARY KEY (`roster_id`, `user_id`));
+CREATE TABLE `team_user` (`team_id` INTEGER NOT NULL, `user_id` INTEGER NOT NULL,
+                          PRIMARY KEY (`team_id`, `user_id`));
+CREATE TABLE `team_subscription` (`team_id` INTEGER NOT NULL, `subscription_id` INTEGER NOT NULL,
+                                  `role_id` INTEGER NOT NULL);
+CREATE TABLE `schedule` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `team_id` INTEGER NOT NULL,
+                         `roster_id` INTEGER NOT NULL, `role_id` INTEGER NOT NULL,
+                         `auto_populate_threshold` INTEGER NOT NULL DEFAULT 0, `advanced_mode` INTEGER NOT NULL,
+                         `last_epoch_scheduled` INTEGER, `last_scheduled_user_id` INTEGER,
+                         `scheduler_id` INTEGER NOT NULL, `dirty` INTEGER NOT NULL DEFAULT 1);
+CREATE TABLE `schedule_event` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `schedule_id` INTEGER NOT NULL,
+                               `start` INTEGER NOT NULL, `duration` INTEGER NOT NULL);
+CREATE TABLE `schedule_order` (`schedule_id` INTEGER NOT NULL, `user_id` INTEGER NOT NULL,
+                               `priority` INTEGER NOT NULL);
+CREATE TABLE `event` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `team_id` INTEGER NOT NULL,
+                      `role_id` INTEGER NOT NULL, `schedule_id` INTEGER, `link_id` TEXT,
+                      `user_id` INTEGER NOT NULL, `start` INTEGER NOT NULL, `end` INTEGER NOT NULL, `note` TEXT);
+CREATE INDEX `event_user_idx` ON `event` (`user_id`, `end`);
+CREATE INDEX `event_team_idx` ON `event` (`team_id`, `role_id`, `start`);
+CREATE TABLE `notification_setting` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `user_id` INTEGER NOT NULL,
+                                     `team_id` INTEGER NOT NULL, `mode_id` INTEGER NOT NULL,
+                                     `type_id` INTEGER NOT NULL, `time_before` INTEGER, `only_if_involved` INTEGER);
+CREATE TABLE `setting_role` (`setting_id` INTEGER NOT NULL, `role_id` INTEGER NOT NULL);
+CREATE TABLE `notification_queue` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `user_id` INTEGER NOT NULL,
+                                   `send_time` INTEGER NOT NULL, `mode_id` INTEGER NOT NULL, `context` TEXT NOT NULL,
+                                   `type_id` INTEGER NOT NULL, `active` INTEGER, `sent` INTEGER);
+'''
+
+# Literals are rendered the way pymysql renders them, except strings, which SQLite quotes by doubling
+sqlite_encoders = dict(encoders)
+sqlite_encoders[str] = lambda value, mapping=None: "'%s'" % value.replace("'", "''")
+
+
+class FakeConnection(object):
+    '''
+    In-memory stand-in for a MySQL connection, backed by SQLite
+    '''
+
+    def __init__(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.create_function('UNIX_TIMESTAMP', 0, lambda: int(time.time()))
+        self.conn.executescript(SQLITE_SCHEMA)
+        for table, names in (('role', ['primary', 'secondary', 'vacation']),
+                             ('scheduler', SCHEDULERS),
+                             ('contact_mode', ['email', 'sms']),
+                             ('notification_type', [EVENT_CREATED])):
+            self.conn.executemany('INSERT INTO `%s` (`name`) VALUES (?)' % table, [(name,) for name in names])
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self.conn.cursor())
+
+    def escape(self, value):
+        return escape_item(value, 'utf8', sqlite_encoders)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        pass
+
+
+class FakeCursor(object):
+    '''
+    Runs the scheduler's pymysql-style queries on SQLite, returning rows as dicts like db.DictCursor
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, query, args=None):
+        if args is not None:
+            if isinstance(args, dict):
+                args = {key: escape_item(val, 'utf8', sqlite_encoders) for key, val in args.items()}
+            elif isinstance(args, (tuple, list)):
+                args = tuple(escape_item(arg, 'utf8', sqlite_encoders) for arg in args)
+            else:
+                args = escape_item(args, 'utf8', sqlite_encoders)
+            query = query % args
+        self.cursor.execute(query)
+        if self.cursor.description:
+            columns = [col[0] for col in self.cursor.description]
+            self.rows = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+            self.rowcount = len(self.rows)
+        else:
+            self.rows = []
+            self.rowcount = self.cursor.rowcount
+        self.lastrowid = self.cursor.lastrowid
+        return self.rowcount
+
+    def executemany(self, query, args):
+        rowcount = 0
+        for arg in args:
+            rowcount += self.execute(query, arg)
+        self.rowcount = rowcount
+        return rowcount
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.cursor.close()
+
+
+def insert(cursor, table, row):
+    columns = ', '.join('`%s`' % col for col in row)
+    cursor.execute('INSERT INTO `%s` (%s) VALUES (%s)' % (table, columns, ', '.join(['%s'] * len(row))),
+                   tuple(row.values()))
+    return cursor.lastrowid
+
+
+def load_fleet(connection, cursor, num_teams, seed, prefix):
+    '''
+    Insert a synthetic fleet and return a list of (team, schedules) tuples, shaped like the scheduler
+    daemon's input. Rosters have 3 to 10 users, some of whom are on other teams' rosters too. Some teams
+    subscribe to another team's primary role, and some users get event created notifications.
+    '''
+    rng = random.Random(seed)
+    cursor.execute('SELECT `id`, `name` FROM `role` WHERE `name` IN %s', (['primary', 'secondary'],))
+    roles = {row['name']: row['id'] for row in cursor}
+    cursor.execute('SELECT `id` FROM `contact_mode` WHERE `name` = %s', 'email')
+    mode_id = cursor.fetchone()['id']
+    cursor.execute('SELECT `id` FROM `notification_type` WHERE `name` = %s', EVENT_CREATED)
+    type_id = cursor.fetchone()['id']
+    cursor.execute('SELECT `id` FROM `scheduler` WHERE `name` = %s', 'default')
+    scheduler_id = cursor.fetchone()['id']
+
+    user_ids = []
+    fleet = []
+    for i in range(num_teams):
+        tz = rng.choice(TIMEZONES)
+        team_id = insert(cursor, 'team', {'name': '%s-team-%d' % (prefix, i), 'scheduling_timezone': tz})
+        team = {'id': team_id, 'name': '%s-team-%d' % (prefix, i), 'scheduling_timezone': tz}
+        roster_id = insert(cursor, 'roster', {'name': 'roster', 'team_id': team_id})
+
+        members = set()
+        for _ in range(rng.randint(3, 10)):
+            if user_ids and rng.random() < 0.15:
+                members.add(rng.choice(user_ids))
+            else:
+                name = '%s-user-%d' % (prefix, len(user_ids))
+                user_ids.append(insert(cursor, 'user', {'name': name, 'full_name': name, 'time_zone': tz}))
+                members.add(user_ids[-1])
+        members = sorted(members)
+        cursor.executemany('INSERT INTO `roster_user` (`roster_id`, `user_id`, `roster_priority`) '
+                           'VALUES (%s, %s, %s)', [(roster_id, user_id, p) for p, user_id in enumerate(members)])
+        cursor.executemany('INSERT INTO `team_user` (`team_id`, `user_id`) VALUES (%s, %s)',
+                           [(team_id, user_id) for user_id in members])
+        if fleet and rng.random() < 0.2:
+            insert(cursor, 'team_subscription', {'team_id': team_id, 'subscription_id': rng.choice(fleet)[0]['id'],
+                                                 'role_id': roles['primary']})
+        for user_id in members:
+            if rng.random() < 0.3:
+                setting_id = insert(cursor, 'notification_setting',
+                                    {'user_id': user_id, 'team_id': team_id, 'mode_id': mode_id,
+                                     'type_id': type_id, 'only_if_involved': 1})
+                insert(cursor, 'setting_role', {'setting_id': setting_id, 'role_id': roles['primary']})
+
+        schedules = []
+        for role in ['primary', 'secondary'] if rng.random() < 0.5 else ['primary']:
+            events = SHIFT_PATTERNS[rng.choice(sorted(SHIFT_PATTERNS))]
+            schedule = {'team_id': team_id, 'roster_id': roster_id, 'role_id': roles[role],
+                        'auto_populate_threshold': 21, 'advanced_mode': 1 if len(events) > 1 else 0,
+                        'scheduler_id': scheduler_id}
+            schedule['id'] = insert(cursor, 'schedule', schedule)
+            schedule['events'] = [dict(ev) for ev in events]
+            cursor.executemany('INSERT INTO `schedule_event` (`schedule_id`, `start`, `duration`) '
+                               'VALUES (%s, %s, %s)',
+                               [(schedule['id'], ev['start'], ev['duration']) for ev in events])
+            cursor.executemany('INSERT INTO `schedule_order` (`schedule_id`, `user_id`, `priority`) '
+                               'VALUES (%s, %s, %s)',
+                               [(schedule['id'], user_id, p) for p, user_id in enumerate(members)])
+            schedules.append(schedule)
+        fleet.append((team, schedules))
+    connection.commit()
+    return fleet
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_scheduler(scheduler_name, connection, fleet):
+    '''
+    Schedule every team in the fleet with one scheduler, returning its stats
+    '''
+    scheduler = load_scheduler(scheduler_name)
+    cursor = db.CountingCursor(connection.cursor(db.DictCursor))
+    cursor.execute('UPDATE `schedule` SET `scheduler_id` = (SELECT `id` FROM `scheduler` WHERE `name` = %s) '
+                   'WHERE `id` IN %s', (scheduler_name, [s['id'] for _, schedules in fleet for s in schedules]))
+    connection.commit()
+    cursor.queries = 0
+    cursor.sql_time = 0.0
+
+    latencies = []
+    start = time.time()
+    for team, schedules in fleet:
+        team_start = time.time()
+        scheduler.schedule(team, schedules, (connection, cursor))
+        latencies.append((time.time() - team_start, team['name']))
+    wall_time = time.time() - start
+    queries, sql_time = cursor.queries, cursor.sql_time
+
+    cursor.execute('SELECT COUNT(*) AS `count` FROM `event` WHERE `team_id` IN %s', ([team['id'] for team, _ in fleet],))
+    num_events = cursor.fetchone()['count']
+    cursor.close()
+
+    ms = sorted(latency * 1000 for latency, _ in latencies)
+    return {
+        'teams': len(fleet),
+        'events': num_events,
+        'wall_time': round(wall_time, 3),
+        'queries': queries,
+        'queries_per_team': round(queries / float(len(fleet)), 2),
+        'sql_time': round(sql_time, 3),
+        'latency_ms': {'p50': round(percentile(ms, 50), 3), 'p90': round(percentile(ms, 90), 3),
+                       'p99': round(percentile(ms, 99), 3), 'max': round(ms[-1], 3)},
+        'slowest_teams': [[name, round(latency * 1000, 3)] for latency, name in sorted(latencies, reverse=True)[:5]],
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Print changes against a baseline, returning False if wall time or query count regressed by more than
+    ``tolerance``
+    '''
+    ok = True
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print('%s: not in baseline' % name)
+            continue
+        for metric in ('wall_time', 'queries', 'sql_time'):
+            change = (result[metric] - base[metric]) / float(base[metric]) if base[metric] else 0.0
+            regressed = metric != 'sql_time' and change > tolerance
+            ok = ok and not regressed
+            print('%-18s %-10s %12s -> %-12s %+7.1f%%%s' % (
+                name, metric, base[metric], result[metric], change * 100, '  REGRESSION' if regressed else ''))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark oncall schedulers against a synthetic fleet')
+    parser.add_argument('--config', help='oncall config file; runs against its MySQL database instead of in memory')
+    parser.add_argument('--teams', type=int, default=1000, help='number of teams in the fleet')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the fleet')
+    parser.add_argument('--scheduler', action='append', choices=SCHEDULERS,
+                        help='scheduler to benchmark, may be repeated (default: all)')
+    parser.add_argument('--baseline', help='baseline JSON to compare results against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative increase in wall time and queries over the baseline')
+    parser.add_argument('--save-baseline', help='write results to this file as JSON')
+    args = parser.parse_args()
+
+    # Scheduling logs every schedule at info level
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.config:
+        db.init(utils.read_config(args.config)['db'])
+
+    results = {}
+    for scheduler_name in args.scheduler or SCHEDULERS:
+        # Every scheduler gets a fresh copy of the same fleet
+        connection = db.connect() if args.config else FakeConnection()
+        cursor = connection.cursor(db.DictCursor)
+        prefix = 'bench%d-%s' % (int(time.time()), scheduler_name)
+        fleet = load_fleet(connection, cursor, args.teams, args.seed, prefix)
+        cursor.close()
+        results[scheduler_name] = run_scheduler(scheduler_name, connection, fleet)
+        connection.close()
+        result = results[scheduler_name]
+        print('%-18s teams=%d events=%d wall=%.2fs queries=%d (%.1f/team) sql=%.2fs '
+              'p50=%.2fms p90=%.2fms p99=%.2fms max=%.2fms' % (
+                  scheduler_name, result['teams'], result['events'], result['wall_time'], result['queries'],
+                  result['queries_per_team'], result['sql_time'], result['latency_ms']['p50'],
+                  result['latency_ms']['p90'], result['latency_ms']['p99'], result['latency_ms']['max']))
+
+    report = {'backend': 'mysql' if args.config else 'memory', 'teams': args.teams, 'seed': args.seed,
+              'results': results}
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline.get('backend'), baseline.get('teams'), baseline.get('seed')) != \
+                (report['backend'], report['teams'], report['seed']):
+            print('warning: baseline was run with backend=%s teams=%s seed=%s' % (
+                baseline.get('backend'), baseline.get('teams'), baseline.get('seed')))
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+'''
+Read-through caches for hot API responses that change rarely, e.g. "who is on call now".
+
+Values are kept in each worker's memory. Every cache has a generation counter, and entries stored
+under an older generation are ignored. Entries may also be tagged (e.g. with the team they describe);
+each tag has its own counter, so invalidating a tag only drops the entries carrying it. With
+``shm_path`` configured the counters live in a small shared memory file, so a write handled by one
+gunicorn worker (or the scheduler) invalidates the entries of every process on the host. Without it,
+invalidation is local to the process and ``max_age`` bounds how stale a worker can get.
+'''
+
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import defaultdict
+
+from . import db
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LocalGenerations(object):
+    def __init__(self):
+        self.counters = defaultdict(int)
+
+    def get(self, name):
+        return self.counters[name]
+
+    def bump(self, name):
+        self.counters[name] += 1
+
+
+class SharedGenerations(object):
+    '''
+    Generation counters in an mmapped file, one 8 byte slot per counter name. Names hashing to the same
+    slot share a counter, which only costs spurious invalidations. Reads are lock free; increments take
+    an exclusive flock so concurrent writers don't lose updates.
+    '''
+    slots = 4096
+
+    def __init__(self, path):
+        size = self.slots * 8
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    def offset(self, name):
+        return (zlib.crc32(name.encode('utf-8')) % self.slots) * 8
+
+    def get(self, name):
+        return struct.unpack_from('Q', self.map, self.offset(name))[0]
+
+    def bump(self, name):
+        offset = self.offset(name)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            struct.pack_into('Q', self.map, offset, struct.unpack_from('Q', self.map, offset)[0] + 1)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+generations = LocalGenerations()
+
+
+class Cache(object):
+    '''
+    Maps keys to (value, expires, generation). A max_age of 0 disables the cache.
+    '''
+
+    def __init__(self, name, max_age=0, max_entries=10000):
+        self.name = name
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def current(self, generation):
+        global_generation, tag_generations = generation
+        return global_generation == generations.get(self.name) and \
+            all(generations.get(name) == tag_generation for name, tag_generation in tag_generations)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires, generation = entry
+            if expires > time.time() and self.current(generation):
+                self.hits += 1
+                return value
+            self.entries.pop(key, None)
+        self.misses += 1
+        return None
+
+    def generation(self, tags=()):
+        '''
+        Snapshot of the counters an entry with the given tags depends on, to pass to set()
+        '''
+        return generations.get(self.name), tuple((name, generations.get(name)) for name in self.tag_names(tags))
+
+    def tag_names(self, tags):
+        return ['%s:%s' % (self.name, tag) for tag in tags]
+
+    def set(self, key, value, expires, generation):
+        if len(self.entries) >= self.max_entries:
+            now = time.time()
+            for k, entry in list(self.entries.items()):
+                if entry[1] <= now:
+                    self.entries.pop(k, None)
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+        self.entries[key] = (value, min(expires, time.time() + self.max_age), generation)
+
+    def load(self, key, loader, tags=()):
+        '''
+        Return the cached value for key, calling loader() on a miss. loader returns a (value, expires)
+        tuple, where expires is the unix time after which the value is no longer correct. The entry is
+        dropped when the cache or any of its tags is invalidated. Generations are read before loading,
+        so a write that commits while the loader runs still invalidates the result.
+        '''
+        if not self.max_age:
+            return loader()[0]
+        value = self.get(key)
+        if value is None:
+            generation = self.generation(tags)
+            value, expires = loader()
+            self.set(key, value, expires, generation)
+        return value
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def invalidate(self, tags=None):
+        '''
+        Invalidate the entries carrying any of tags, or every entry if tags is None
+        '''
+        if tags is None:
+            generations.bump(self.name)
+            self.entries.clear()
+        else:
+            for name in self.tag_names(tags):
+                generations.bump(name)
+
+
+# Current on-call responses (team summary, team and service oncall), tagged 'team:<name>' and
+# 'service:<name>'. Invalidate with invalidate_teams on writes to a team's events, subscriptions and
+# services, and entirely on writes to teams, services and user contacts.
+oncall = Cache('oncall')
+
+# Per-user authorization info (god flag, administered and member teams). Invalidate on writes to team
+# admins, team members and teams.
+auth = Cache('auth')
+
+# Application API keys. Keys are managed outside the API, so a failed digest check reloads the key.
+app_keys = Cache('app_keys')
+
+
+def invalidate_teams(teams, services=()):
+    '''
+    Invalidate the cached on-call responses depending on the given teams: their own, those of teams
+    subscribed to them and those of the services owned by any of these. Also invalidates the given
+    services, for changes to which teams own them.
+    '''
+    teams = set(teams)
+    services = set(services)
+    if not oncall.max_age:
+        return
+    if teams:
+        connection = db.connect()
+        cursor = connection.cursor()
+        cursor.execute('''SELECT `subscriber`.`name` FROM `team_subscription`
+                          JOIN `team` ON `team`.`id` = `team_subscription`.`subscription_id`
+                          JOIN `team` `subscriber` ON `subscriber`.`id` = `team_subscription`.`team_id`
+                          WHERE `team`.`name` IN %s''',
+                       (list(teams),))
+        teams.update(row[0] for row in cursor)
+        cursor.execute('''SELECT `service`.`name` FROM `team_service`
+                          JOIN `service` ON `service`.`id` = `team_service`.`service_id`
+                          JOIN `team` ON `team`.`id` = `team_service`.`team_id`
+                          WHERE `team`.`name` IN %s''',
+                       (list(teams),))
+        services.update(row[0] for row in cursor)
+        cursor.close()
+        connection.close()
+    oncall.invalidate(['team:%s' % team for team in teams] + ['service:%s' % service for service in services])
+
+
+def init(config):
+    global generations
+    shm_path = config.get('shm_path')
+    if shm_path:
+        try:
+            generations = SharedGenerations(shm_path)
+        except (OSError, ValueError):
+            logger.exception('Failed to open shared cache generations at %s, invalidation is process local', shm_path)
+    oncall.max_age = config.get('oncall_max_age', 0)
+    auth.max_age = config.get('auth_max_age', 0)
+    app_keys.max_age = config.get('app_key_max_age', 0)
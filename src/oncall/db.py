@@ -1,14 +1,30 @@
 from sqlalchemy import create_engine
+from pymysql.cursors import RE_INSERT_VALUES
+from threading import local
 import ssl
+import time
+from . import metrics
 
-connect = None
+engine = None
+raw_connect = None
 DictCursor = None
+SSDictCursor = None
 IntegrityError = None
 
 
+# Connection lent to the current request. Thread local, so greenlet local under gevent's monkey patching.
+request_scope = local()
+
+# Pool counters. Every process emitting metrics registers these as default stats, so they are reset
+# each time metrics are emitted.
+POOL_STATS = ['db_pool_checkouts', 'db_pool_wait_time', 'db_pool_max_wait_time']
+
+
 def init(config):
-    global connect
+    global engine
+    global raw_connect
     global DictCursor
+    global SSDictCursor
     global IntegrityError
 
     connect_args = {}
@@ -26,4 +42,113 @@ def init(config):
     IntegrityError = dbapi.IntegrityError
 
     DictCursor = dbapi.cursors.DictCursor
-    connect = engine.raw_connection
+    SSDictCursor = dbapi.cursors.SSDictCursor
+    raw_connect = engine.raw_connection
+
+
+class ScopedConnection(object):
+    '''
+    A request's pooled connection, shared by every db.connect() in the request. close() keeps it
+    checked out; once all callers have closed it, uncommitted work is rolled back as the pool would
+    on return, so each caller still starts from a clean transaction.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.users = 0
+        self.dirty = False
+
+    def cursor(self, *args):
+        self.dirty = True
+        return self.connection.cursor(*args)
+
+    def commit(self):
+        self.connection.commit()
+        self.dirty = False
+
+    def close(self):
+        self.users -= 1
+        if self.users == 0 and self.dirty:
+            self.connection.rollback()
+            self.dirty = False
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def checkout():
+    start = time.time()
+    connection = raw_connect()
+    wait_time = (time.time() - start) * 1000
+    metrics.stats['db_pool_checkouts'] += 1
+    metrics.stats['db_pool_wait_time'] += wait_time
+    metrics.stats['db_pool_max_wait_time'] = max(metrics.stats['db_pool_max_wait_time'], wait_time)
+    return connection
+
+
+def connect(scoped=True):
+    '''
+    Return a DB-API connection from the pool. Inside a request scope (see begin_request), all calls share
+    one connection, checked out on first use. Pass scoped=False for connections that outlive the
+    request handler, e.g. ones read by streamed responses.
+    '''
+    if not scoped or not getattr(request_scope, 'active', False):
+        return checkout()
+    if request_scope.connection is None:
+        request_scope.connection = ScopedConnection(checkout())
+    request_scope.connection.users += 1
+    return request_scope.connection
+
+
+def begin_request():
+    request_scope.active = True
+    request_scope.connection = None
+
+
+def end_request():
+    '''
+    Return the request's connection, if one was checked out, to the pool and sample pool gauges
+    '''
+    connection = getattr(request_scope, 'connection', None)
+    request_scope.active = False
+    request_scope.connection = None
+    if connection is not None:
+        connection.connection.close()
+    pool = engine.pool
+    if hasattr(pool, 'checkedout'):
+        metrics.stats['db_pool_checked_out'] = pool.checkedout()
+        metrics.stats['db_pool_overflow'] = max(pool.overflow(), 0)
+
+
+class CountingCursor(object):
+    '''
+    Wraps a cursor, counting the statements sent to the DB and the time spent on them
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.queries = 0
+        self.sql_time = 0.0
+
+    def execute(self, query, args=None):
+        start = time.time()
+        try:
+            return self.cursor.execute(query, args)
+        finally:
+            self.queries += 1
+            self.sql_time += time.time() - start
+
+    def executemany(self, query, args):
+        start = time.time()
+        try:
+            return self.cursor.executemany(query, args)
+        finally:
+            # pymysql sends multi-row INSERTs as one statement
+            self.queries += 1 if RE_INSERT_VALUES.match(query) else len(args)
+            self.sql_time += time.time() - start
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
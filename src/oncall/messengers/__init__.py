@@ -2,8 +2,15 @@
 # See LICENSE in the project root for license information.
 
 from collections import defaultdict
+from gevent import Timeout, sleep
+from gevent.lock import BoundedSemaphore
+from gevent.threadpool import ThreadPool
 import logging
 import importlib
+import re
+import time
+
+from oncall import metrics
 
 logger = logging.getLogger()
 _active_messengers = defaultdict(list)
@@ -13,6 +20,152 @@ class OncallMessengerException(Exception):
     pass
 
 
+class MessengerUnavailable(OncallMessengerException):
+    '''
+    Raised when a messenger is skipped without attempting a send: its circuit is open, or it is rate
+    or concurrency limited
+    '''
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def consume(self, timeout=0):
+        '''
+        Take a token, waiting up to timeout seconds for one to become available. Returns whether a
+        token was taken.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            sleep(wait)
+
+
+class CircuitBreaker(object):
+    '''
+    Opens after failure_threshold consecutive failures. Once open, sends are refused for cooldown
+    seconds, then a single trial send is let through: success closes the circuit, failure reopens it.
+    '''
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.trial or time.time() - self.opened_at < self.cooldown:
+            return False
+        self.trial = True
+        return True
+
+    def cancel_trial(self):
+        self.trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+
+
+class GuardedMessenger(object):
+    '''
+    Wraps a messenger so that one slow or failing backend can't tie up every notifier worker. Sends are
+    rate limited by a token bucket (rate_limit per second, up to burst at once), limited to
+    max_concurrency at a time and cut off after timeout seconds. Waits for a token or a send slot
+    give up after wait_timeout seconds. A circuit breaker skips the messenger for cooldown seconds
+    after failure_threshold consecutive failures.
+
+    Messenger clients (requests, pymsteams, irisclient) block, and the notifier doesn't monkey patch, so
+    sends run in a per-messenger thread pool. A send that times out keeps its slot until its thread
+    finishes, so a hung backend can use at most max_concurrency threads.
+    '''
+
+    def __init__(self, messenger, config):
+        self.messenger = messenger
+        self.name = re.sub('[^a-zA-Z0-9_]+', '_', config['type'])
+        rate = config.get('rate_limit')
+        self.bucket = TokenBucket(rate, config.get('burst', max(rate, 1))) if rate else None
+        self.semaphore = BoundedSemaphore(config.get('max_concurrency', 10))
+        self.pool = ThreadPool(config.get('max_concurrency', 10))
+        self.timeout = config.get('timeout', 30)
+        self.wait_timeout = config.get('wait_timeout', 5)
+        self.breaker = CircuitBreaker(config.get('failure_threshold', 5), config.get('cooldown', 60))
+        self.supports = messenger.supports
+        metrics.stats_reset.update({self.stat('failed_cnt'): 0, self.stat('skipped_cnt'): 0})
+        metrics.stats[self.stat('breaker_open')] = 0
+
+    def __repr__(self):
+        return repr(self.messenger)
+
+    def stat(self, name):
+        return 'messenger_%s_%s' % (self.name, name)
+
+    def acquire(self):
+        if self.bucket and not self.bucket.consume(self.wait_timeout):
+            raise MessengerUnavailable('%s is rate limited' % self.name)
+        if not self.semaphore.acquire(timeout=self.wait_timeout):
+            raise MessengerUnavailable('%s has too many sends in progress' % self.name)
+
+    def send(self, message):
+        if not self.breaker.allow():
+            metrics.stats[self.stat('skipped_cnt')] += 1
+            raise MessengerUnavailable('%s circuit is open' % self.name)
+        try:
+            self.acquire()
+        except MessengerUnavailable:
+            self.breaker.cancel_trial()
+            metrics.stats[self.stat('skipped_cnt')] += 1
+            raise
+        try:
+            pending = self.pool.spawn(self.messenger.send, message)
+        except Exception:
+            self.semaphore.release()
+            raise
+        pending.rawlink(lambda _: self.semaphore.release())
+        try:
+            result = pending.get(timeout=self.timeout)
+        except Timeout:
+            self.breaker.record_failure()
+            metrics.stats[self.stat('failed_cnt')] += 1
+            raise OncallMessengerException('%s send timed out' % self.name)
+        except Exception:
+            self.breaker.record_failure()
+            metrics.stats[self.stat('failed_cnt')] += 1
+            raise
+        else:
+            self.breaker.record_success()
+            return result
+        finally:
+            metrics.stats[self.stat('breaker_open')] = int(self.breaker.is_open)
+
+
 def init_messengers(messengers):
     for messenger in messengers:
         if '.' in messenger['type']:
@@ -21,18 +174,31 @@ def init_messengers(messengers):
         else:
             module_path = 'oncall.messengers.' + messenger['type']
 
-        instance = getattr(importlib.import_module(module_path), messenger['type'])(messenger)
+        instance = GuardedMessenger(getattr(importlib.import_module(module_path), messenger['type'])(messenger),
+                                    messenger)
         for transport in instance.supports:
             _active_messengers[transport].append(instance)
 
 
 def send_message(message):
-    for messenger in _active_messengers[message['mode']]:
+    '''
+    Send with the first messenger for the message's mode that succeeds. Raises MessengerUnavailable if
+    every messenger was skipped without attempting a send, so the caller can retry the message later.
+    '''
+    messengers = _active_messengers[message['mode']]
+    attempted = False
+    for messenger in messengers:
         logger.debug('Attempting %s send using messenger %s', message['mode'], messenger)
         try:
             return messenger.send(message)
+        except MessengerUnavailable as e:
+            logger.warning('Skipping messenger %s for %s: %s', messenger, message['mode'], e)
+            continue
         except Exception:
+            attempted = True
             logger.exception('Sending %s with messenger %s failed', message, messenger)
             continue
 
+    if messengers and not attempted:
+        raise MessengerUnavailable('All %s messengers unavailable for %s' % (message['mode'], message))
     raise OncallMessengerException('All %s messengers failed for %s' % (message['mode'], message))
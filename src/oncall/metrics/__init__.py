@@ -6,6 +6,8 @@
 
 from oncall.utils import import_custom_module
 from collections import defaultdict
+from threading import Thread
+import time
 import logging
 logger = logging.getLogger(__name__)
 
@@ -34,3 +36,19 @@ def init(config, app_name, default_stats):
     logger.info('Loaded metrics handler %s', config['metrics'])
     stats_reset.update(default_stats)
     stats.update(stats_reset)
+
+
+def emit_periodically(interval):
+    '''
+    Emit metrics every interval seconds from a daemon thread, for long running processes like the API
+    that have no main loop of their own.
+    '''
+    def emitter():
+        while True:
+            time.sleep(interval)
+            try:
+                emit_metrics()
+            except Exception:
+                logger.exception('Failed to emit metrics')
+
+    Thread(target=emitter, daemon=True).start()
@@ -0,0 +1,60 @@
+import logging
+import time
+from gevent import sleep
+
+
+from oncall import db
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = '`id`, `user_id`, `send_time`, `mode_id`, `context`, `type_id`, `active`, `sent`'
+
+
+def archive_batch(cursor, cutoff, batch_size):
+    '''
+    Move up to batch_size inactive messages queued to send before cutoff into the archive table.
+    Returns the number of messages moved.
+    '''
+    cursor.execute('''SELECT `id` FROM `notification_queue`
+                      WHERE `active` = 0 AND `send_time` < %s
+                      ORDER BY `send_time` LIMIT %s''',
+                   (cutoff, batch_size))
+    ids = [row[0] for row in cursor]
+    if ids:
+        cursor.execute('INSERT INTO `notification_queue_archive` (' + COLUMNS + ') SELECT ' + COLUMNS +
+                       ' FROM `notification_queue` WHERE `id` IN %s', (ids,))
+        cursor.execute('DELETE FROM `notification_queue` WHERE `id` IN %s', (ids,))
+    return len(ids)
+
+
+def queue_archiver(config):
+    '''
+    Periodically move sent and failed notifications older than max_age days out of notification_queue,
+    in transactions of at most batch_size rows, so the live queue stays small.
+    '''
+    sleep_time = config.get('interval', 3600)
+    max_age = config.get('max_age', 30) * 86400
+    batch_size = config.get('batch_size', 1000)
+    batch_pause = config.get('batch_pause', 1)
+    while 1:
+        sleep(sleep_time)
+        archived = 0
+        cutoff = int(time.time()) - max_age
+        connection = db.connect()
+        cursor = connection.cursor()
+        try:
+            while 1:
+                moved = archive_batch(cursor, cutoff, batch_size)
+                connection.commit()
+                archived += moved
+                if moved < batch_size:
+                    break
+                # Give other queue users a turn between batches
+                sleep(batch_pause)
+        except Exception:
+            logger.exception('Failed to archive notifications')
+            connection.rollback()
+        finally:
+            cursor.close()
+            connection.close()
+        logger.info('Archived %s notifications sent before %s', archived, cutoff)
@@ -0,0 +1,36 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from functools import lru_cache
+
+
+class QueryBuilder(object):
+    '''
+    Builds ``SELECT <cols> FROM <from_clause> WHERE ...`` statements from a dict of constraint
+    templates, as used by the API's filter params. The SQL text only depends on the shape of a
+    request (columns, joins and the set of filter keys), so it's compiled once per shape and cached.
+    Filter values never go into the text; build() returns them in placeholder order, to be bound by
+    cursor.execute.
+    '''
+
+    def __init__(self, constraints, maxsize=512):
+        self.constraints = constraints
+        self.compile = lru_cache(maxsize=maxsize)(self._compile)
+
+    def _compile(self, cols, from_clause, keys, extra_where, suffix):
+        where = [self.constraints[key] for key in keys]
+        where.extend(extra_where)
+        query = 'SELECT %s FROM %s' % (cols, from_clause)
+        if where:
+            query = '%s WHERE %s' % (query, ' AND '.join(where))
+        return query + suffix
+
+    def build(self, cols, from_clause, filter_params, extra_where=(), suffix=''):
+        '''
+        Return (query, args) selecting cols from from_clause, filtered by the entries of filter_params
+        that are known constraints. Params for extra_where clauses and the suffix (e.g. ORDER BY/LIMIT)
+        must be appended to args by the caller, in order.
+        '''
+        keys = tuple(sorted(key for key in filter_params if key in self.constraints))
+        query = self.compile(cols, from_clause, keys, tuple(extra_where), suffix)
+        return query, [filter_params[key] for key in keys]
@@ -1,9 +1,12 @@
 from datetime import datetime, timedelta
 from pytz import timezone, utc
-from oncall.utils import gen_link_id, create_notification
+from oncall.utils import gen_link_id, create_notifications, get_notification_settings, mark_team_modified
 from ..constants import EVENT_CREATED
+from .event_index import EventIndex
 from falcon import HTTPBadRequest
 from ujson import dumps as json_dumps
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
 import time
 import logging
 import operator
@@ -13,30 +16,109 @@ logger = logging.getLogger()
 UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=utc)
 SECONDS_IN_A_DAY = 24 * 60 * 60
 SECONDS_IN_A_WEEK = SECONDS_IN_A_DAY * 7
+NAIVE_UNIX_EPOCH = UNIX_EPOCH.replace(tzinfo=None)
 
 columns = {
-    'id': '`temp_event`.`id` as `id`',
-    'start': '`temp_event`.`start` as `start`',
-    'end': '`temp_event`.`end` as `end`',
+    'id': '`event`.`id` as `id`',
+    'start': '`event`.`start` as `start`',
+    'end': '`event`.`end` as `end`',
     'role': '`role`.`name` as `role`',
     'team': '`team`.`name` as `team`',
     'user': '`user`.`name` as `user`',
     'full_name': '`user`.`full_name` as `full_name`',
-    'schedule_id': '`temp_event`.`schedule_id`',
-    'link_id': '`temp_event`.`link_id`',
-    'note': '`temp_event`.`note`',
+    'schedule_id': '`event`.`schedule_id`',
+    'link_id': '`event`.`link_id`',
+    'note': '`event`.`note`',
 }
 
 constraints = {
-    'start__lt': '`temp_event`.`start` < %s',
-    'end__ge': '`temp_event`.`end` >= %s',
+    'start__lt': '`event`.`start` < %s',
+    'end__ge': '`event`.`end` >= %s',
     'team__eq': '`team`.`name` = %s',
 }
 
 all_columns = ', '.join(columns.values())
 
 
+def naive_timestamp(date):
+    '''
+    Seconds between the unix epoch and a naive datetime, as if both were in the same timezone
+    '''
+    td = date - NAIVE_UNIX_EPOCH
+    return td.days * SECONDS_IN_A_DAY + td.seconds
+
+
+@lru_cache(maxsize=4096)
+def get_week_offsets(tz_name, week_start):
+    '''
+    Returns (starts, offsets) for the local week starting at ``week_start`` (a naive timestamp, see
+    naive_timestamp) in ``tz_name``. Local times from starts[i] up to starts[i + 1] are offsets[i] seconds
+    ahead of UTC. Offsets are those of localize with is_dst=1, so ambiguous and nonexistent times resolve
+    as they always have. Cached, since schedules in the same timezone share weeks.
+    '''
+    tz = timezone(tz_name)
+    week_end = week_start + SECONDS_IN_A_WEEK
+    # Local times at which the offset can change: either side of every UTC transition near this week
+    starts = {week_start}
+    transition_times = getattr(tz, '_utc_transition_times', None)
+    if transition_times:
+        first = bisect_left(transition_times, datetime.utcfromtimestamp(week_start - 2 * SECONDS_IN_A_DAY))
+        last = bisect_right(transition_times, datetime.utcfromtimestamp(week_end + 2 * SECONDS_IN_A_DAY))
+        for i in range(max(first, 1), last):
+            transition = naive_timestamp(transition_times[i])
+            for info in (tz._transition_info[i - 1], tz._transition_info[i]):
+                local = transition + int(info[0].total_seconds())
+                if week_start < local < week_end:
+                    starts.add(local)
+    starts = sorted(starts)
+    offsets = [int(tz.localize(datetime.utcfromtimestamp(start), is_dst=1).utcoffset().total_seconds())
+               for start in starts]
+    return starts, offsets
+
+
+def utc_from_naive_timestamp(local, tz_name):
+    '''
+    Convert a naive timestamp in ``tz_name`` to a unix timestamp
+    '''
+    days = local // SECONDS_IN_A_DAY
+    # The unix epoch is a Thursday; weeks start on Sunday
+    week_start = (days - (days + 4) % 7) * SECONDS_IN_A_DAY
+    starts, offsets = get_week_offsets(tz_name, week_start)
+    return local - offsets[bisect_right(starts, local) - 1]
+
+
+def find_overlapping_user_ids(candidates, events):
+    '''
+    Sweep over candidate events (dicts with `user_id`, `start` and `end`) and the events being scheduled,
+    returning the ids of users whose candidates overlap any of them
+    '''
+    # Merge the events being scheduled into disjoint spans
+    spans = []
+    for start, end in sorted((e['start'], e['end']) for e in events):
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+
+    busy = set()
+    idx = 0
+    for row in sorted(candidates, key=operator.itemgetter('start')):
+        # Spans ending before this candidate starts can't overlap it or any later one
+        while idx < len(spans) and spans[idx][1] <= row['start']:
+            idx += 1
+        if idx == len(spans):
+            break
+        if spans[idx][0] < row['end']:
+            busy.add(row['user_id'])
+    return busy
+
+
 class Scheduler(object):
+    # Whether conflict checks look at events on every team, rather than just the team and its subscriptions
+    cross_team_conflicts = False
+    # Whether epochs already covered by matching events for the team and role are skipped
+    skip_match = True
+
     def __init__(self):
         pass
 
@@ -70,32 +152,29 @@ class Scheduler(object):
                 AND `user`.`active` = TRUE''', roster_id)
         return [r['user_id'] for r in cursor]
 
+    def get_overlap_candidates(self, user_ids, events, cursor, table_name='event'):
+        '''
+        Fetch events for ``user_ids`` within the bounding range of ``events``, with a single range scan. Rows
+        have `user_id`, `team_id`, `role_id`, `start`, `end` and `is_vacation` keys.
+        '''
+        cursor.execute('''SELECT `user_id`, `team_id`, `role_id`, `start`, `end`,
+                              `role_id` = (SELECT `id` FROM `role` WHERE `name` = 'vacation') AS `is_vacation`
+                          FROM `%s`
+                          WHERE `user_id` IN %%s AND `start` < %%s AND `end` > %%s''' % table_name,
+                       (list(user_ids), max(e['end'] for e in events), min(e['start'] for e in events)))
+        return cursor.fetchall()
+
     def get_busy_user_by_event_range(self, user_ids, team_id, events, cursor, table_name='event'):
         ''' Find which users have overlapping events for the same team in this time range'''
-        query_params = [user_ids]
-        range_check = []
-        for e in events:
-            range_check.append('(%s < `end` AND `start` < %s)')
-            query_params += [e['start'], e['end']]
-
         cursor.execute('''SELECT `subscription_id`, `role_id`
                           FROM `team_subscription`
                           WHERE `team_id` = %s''',
                        team_id)
-        subscriptions = cursor.fetchall()
-        team_check = ['team_id = %s']
-        query_params.append(team_id)
-        for sub in subscriptions:
-            team_check.append('(team_id = %s AND role_id = %s)')
-            query_params += [sub['subscription_id'], sub['role_id']]
-
-        query = '''
-                SELECT DISTINCT `user_id` FROM `%s`
-                WHERE `user_id` in %%s AND (%s) AND (%s or `role_id`= (SELECT `id` FROM `role` WHERE `name` = 'vacation'))
-                ''' % (table_name, ' OR '.join(range_check), ' OR '.join(team_check))
-
-        cursor.execute(query, query_params)
-        return [r['user_id'] for r in cursor.fetchall()]
+        subscriptions = {(sub['subscription_id'], sub['role_id']) for sub in cursor}
+        candidates = [row for row in self.get_overlap_candidates(user_ids, events, cursor, table_name)
+                      if row['team_id'] == team_id or row['is_vacation'] or
+                      (row['team_id'], row['role_id']) in subscriptions]
+        return list(find_overlapping_user_ids(candidates, events))
 
     def find_least_active_user_id_by_team(self, user_ids, team_id, start_time, role_id, cursor, table_name='event'):
         '''
@@ -136,9 +215,13 @@ class Scheduler(object):
             logger.debug('Found new guy')
         return {row['id'] for row in cursor}
 
-    def create_events(self, team_id, schedule_id, user_id, events, role_id, cursor, table_name='event', skip_match=True):
+    def create_events(self, team_id, schedule_id, user_id, events, role_id, cursor, table_name='event', skip_match=True,
+                      notification_settings=None):
+        '''
+        Insert events for a user, returning whether they were created
+        '''
         if len(events) == 0:
-            return
+            return False
         # Skip creating this epoch of events if matching events exist
         if skip_match:
             matching = ' OR '.join(['(start = %s AND end = %s AND role_id = %s AND team_id = %s)'] * len(events))
@@ -151,57 +234,50 @@ class Scheduler(object):
 
             cursor.execute(query, query_params)
             if cursor.fetchone()['num_events'] == len(events):
-                return
-
-        if len(events) == 1:
-            [event] = events
-            event_args = (team_id, schedule_id, event['start'], event['end'], user_id, role_id)
-            logger.debug('inserting event: %s', event_args)
-            query = '''
-                INSERT INTO `%s` (
-                    `team_id`, `schedule_id`, `start`, `end`, `user_id`, `role_id`
-                ) VALUES (
-                    %%s, %%s, %%s, %%s, %%s, %%s
-                )''' % table_name
-            cursor.execute(query, event_args)
-            cursor.execute('SELECT `name` FROM `user` WHERE `id` = %s', user_id)
-            name = cursor.fetchone()
-            context = {
-                'team': team_id,
-                'role': role_id,
-                'full_name': name
-            }
-            create_notification(context, team_id,
-                                [role_id],
-                                EVENT_CREATED,
-                                [user_id],
-                                cursor,
-                                start_time=event['start'])
-        else:
-            link_id = gen_link_id()
-            for event in events:
-                event_args = (team_id, schedule_id, event['start'], event['end'], user_id, role_id, link_id)
-                logger.debug('inserting event: %s', event_args)
-                query = '''
-                    INSERT INTO `%s` (
-                        `team_id`, `schedule_id`, `start`, `end`, `user_id`, `role_id`, `link_id`
-                    ) VALUES (
-                        %%s, %%s, %%s, %%s, %%s, %%s, %%s
-                    )''' % table_name
-                cursor.execute(query, event_args)
-                cursor.execute('SELECT `name` FROM `user` WHERE `id` = %s', user_id)
-                name = cursor.fetchone()
-                context = {
-                    'team': team_id,
-                    'role': role_id,
-                    'full_name': name
-                }
-                create_notification(context, team_id,
-                                    [role_id],
-                                    EVENT_CREATED,
-                                    [user_id],
-                                    cursor,
-                                    start_time=event['start'])
+                return False
+
+        self.insert_events(team_id, schedule_id, user_id, events, role_id, cursor, table_name, notification_settings)
+        return True
+
+    def insert_events(self, team_id, schedule_id, user_id, events, role_id, cursor, table_name='event',
+                      notification_settings=None):
+        '''
+        Insert an epoch of events for a user in one statement, linking them if there are several, and queue
+        the event created notifications in one batch. ``notification_settings`` is an optional dict used to
+        cache notification settings by (team_id, role_id) across calls.
+        '''
+        link_id = gen_link_id() if len(events) > 1 else None
+        event_args = [(team_id, schedule_id, event['start'], event['end'], user_id, role_id, link_id)
+                      for event in events]
+        logger.debug('inserting events: %s', event_args)
+        query = '''
+            INSERT INTO `%s` (
+                `team_id`, `schedule_id`, `start`, `end`, `user_id`, `role_id`, `link_id`
+            ) VALUES (
+                %%s, %%s, %%s, %%s, %%s, %%s, %%s
+            )''' % table_name
+        cursor.executemany(query, event_args)
+
+        cursor.execute('SELECT `name` FROM `user` WHERE `id` = %s', user_id)
+        name = cursor.fetchone()
+        context = {
+            'team': team_id,
+            'role': role_id,
+            'full_name': name
+        }
+        settings = None
+        if notification_settings is not None:
+            if (team_id, role_id) not in notification_settings:
+                notification_settings[(team_id, role_id)] = get_notification_settings(team_id, [role_id],
+                                                                                      EVENT_CREATED, cursor)
+            settings = notification_settings[(team_id, role_id)]
+        create_notifications(context, team_id,
+                             [role_id],
+                             EVENT_CREATED,
+                             [user_id],
+                             cursor,
+                             [{'start_time': event['start']} for event in events],
+                             settings)
 
     def set_last_epoch(self, schedule_id, last_epoch, cursor):
         cursor.execute('UPDATE `schedule` SET `last_epoch_scheduled` = %s WHERE `id` = %s',
@@ -242,25 +318,22 @@ class Scheduler(object):
             return after
 
     def utc_from_naive_date(self, date, schedule):
-        tz = timezone(schedule['timezone'])
         # Arbitrarily choose ambiguous/nonexistent dates to be in DST. Results in no gaps in a schedule given
         # a consistent arbitrary choice.
-        date = (tz.localize(date, is_dst=1)).astimezone(utc)
-        td = date - UNIX_EPOCH
-        # Convert timedelta to seconds
-        return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10 ** 6) // 10 ** 6
+        return utc_from_naive_timestamp(naive_timestamp(date), schedule['timezone'])
 
     # End time helpers
 
     def generate_events(self, schedule, schedule_events, epoch):
         generated = []
+        epoch = naive_timestamp(epoch)
+        tz_name = schedule['timezone']
         for event in schedule_events:
-            start = timedelta(seconds=event['start']) + epoch
+            start = epoch + event['start']
             # Need to calculate naive end date to correct for DST
-            end = timedelta(seconds=event['start'] + event['duration']) + epoch
-            start = self.utc_from_naive_date(start, schedule)
-            end = self.utc_from_naive_date(end, schedule)
-            generated.append({'start': start, 'end': end})
+            end = start + event['duration']
+            generated.append({'start': utc_from_naive_timestamp(start, tz_name),
+                              'end': utc_from_naive_timestamp(end, tz_name)})
         return generated
 
     def get_period_len(self, schedule):
@@ -273,6 +346,35 @@ class Scheduler(object):
         period = end - first_event['start']
         return ((period + SECONDS_IN_A_WEEK - 1) // SECONDS_IN_A_WEEK)
 
+    def get_next_epoch(self, schedule, last_epoch_timestamp, period):
+        '''
+        Given the last epoch scheduled as a unix timestamp, returns naive datetime of the next epoch to schedule
+        '''
+        # Handle new schedules, start scheduling from current week
+        if last_epoch_timestamp is None:
+            start_dt = datetime.fromtimestamp(time.time(), utc).astimezone(timezone(schedule['timezone']))
+            return self.epoch_from_datetime(start_dt)
+        # Otherwise, find the next epoch (NOTE: can't assume that last_epoch_timestamp is Sunday 00:00:00 in the
+        # schedule's timezone, because the scheduling timezone might have changed. Instead, find the closest
+        # epoch and work from there)
+        last_epoch_dt = datetime.fromtimestamp(last_epoch_timestamp, utc)
+        localized_last_epoch = last_epoch_dt.astimezone(timezone(schedule['timezone']))
+        return self.get_closest_epoch(localized_last_epoch) + timedelta(days=7 * period)
+
+    def get_next_due_time(self, schedule, last_epoch_timestamp):
+        '''
+        Returns the unix timestamp at which calculate_future_events will next produce events for a schedule,
+        given the last epoch scheduled, or None if the schedule is never auto-populated.
+        '''
+        if schedule['auto_populate_threshold'] <= 0:
+            return None
+        if last_epoch_timestamp is None:
+            return time.time()
+        next_epoch = self.get_next_epoch(schedule, last_epoch_timestamp, self.get_period_len(schedule))
+        # Matches the cutoff check in calculate_future_events, which compares naive datetimes
+        naive_unix_epoch = UNIX_EPOCH.replace(tzinfo=None)
+        return (next_epoch - naive_unix_epoch).total_seconds() - schedule['auto_populate_threshold'] * SECONDS_IN_A_DAY
+
     def calculate_future_events(self, schedule, cursor, start_epoch=None):
         period = self.get_period_len(schedule)
 
@@ -283,18 +385,7 @@ class Scheduler(object):
         # Find where to start scheduling
         if start_epoch is None:
             last_epoch_timestamp = self.get_schedule_last_epoch(schedule, cursor)
-
-            # Handle new schedules, start scheduling from current week
-            if last_epoch_timestamp is None:
-                start_dt = datetime.fromtimestamp(time.time(), utc).astimezone(timezone(schedule['timezone']))
-                next_epoch = self.epoch_from_datetime(start_dt)
-            else:
-                # Otherwise, find the next epoch (NOTE: can't assume that last_epoch_timestamp is Sunday 00:00:00 in the
-                # schedule's timezone, because the scheduling timezone might have changed. Instead, find the closest
-                # epoch and work from there)
-                last_epoch_dt = datetime.fromtimestamp(last_epoch_timestamp, utc)
-                localized_last_epoch = last_epoch_dt.astimezone(timezone(schedule['timezone']))
-                next_epoch = self.get_closest_epoch(localized_last_epoch) + timedelta(days=7 * period)
+            next_epoch = self.get_next_epoch(schedule, last_epoch_timestamp, period)
         else:
             next_epoch = start_epoch
 
@@ -310,33 +401,62 @@ class Scheduler(object):
         # Return future events and the last epoch events were scheduled for.
         return future_events, self.utc_from_naive_date(next_epoch - timedelta(days=7 * period), schedule)
 
-    def find_next_user_id(self, schedule, future_events, cursor, table_name='event'):
+    def load_event_index(self, team, epochs, cursor, exclude_schedule_id=None):
+        '''
+        Load the events needed to assign users to ``epochs``, a list of (schedule, epoch events) tuples.
+        Events of ``exclude_schedule_id`` from the first epoch onwards are left out.
+        '''
+        start = min(ev['start'] for _, epoch in epochs for ev in epoch)
+        roster_ids = {schedule['roster_id'] for schedule, _ in epochs}
+        return EventIndex.load(team['id'], roster_ids, start, cursor, exclude_schedule_id, team.get('subscriptions'))
+
+    def find_next_user_id(self, schedule, future_events, cursor, table_name='event', index=None):
+        '''
+        Pick the user to assign to ``future_events``. If an EventIndex is given, decisions are made from it
+        rather than by querying the DB.
+        '''
         team_id = schedule['team_id']
         role_id = schedule['role_id']
         roster_id = schedule['roster_id']
         # find people without conflicting events
         # TODO: finer grain conflict checking
-        user_ids = set(self.get_roster_user_ids(roster_id, cursor))
+        if index is None:
+            user_ids = set(self.get_roster_user_ids(roster_id, cursor))
+        else:
+            user_ids = index.get_roster_user_ids(roster_id)
         if not user_ids:
             logger.info('Empty roster, skipping')
             return None
         logger.debug('filtering users: %s', user_ids)
         start = min([e['start'] for e in future_events])
-        for uid in self.get_busy_user_by_event_range(user_ids, team_id, future_events, cursor, table_name):
+        if index is None:
+            busy_user_ids = self.get_busy_user_by_event_range(user_ids, team_id, future_events, cursor, table_name)
+        else:
+            busy_user_ids = index.get_busy_user_ids(user_ids, future_events, self.cross_team_conflicts)
+        for uid in busy_user_ids:
             user_ids.remove(uid)
         if not user_ids:
             logger.info('All users have conflicting events, skipping...')
             return None
-        new_user_ids = self.find_new_user_in_roster(roster_id, team_id, start, role_id, cursor, table_name)
+        if index is None:
+            new_user_ids = self.find_new_user_in_roster(roster_id, team_id, start, role_id, cursor, table_name)
+        else:
+            new_user_ids = index.find_new_user_ids(roster_id, team_id, start, role_id)
         available_and_new = new_user_ids & user_ids
         if available_and_new:
             logger.info('Picking new and available user from %s', available_and_new)
             return available_and_new.pop()
 
         logger.debug('picking user between: %s, team: %s', user_ids, team_id)
-        return self.find_least_active_user_id_by_team(user_ids, team_id, start, role_id, cursor, table_name)
+        if index is None:
+            return self.find_least_active_user_id_by_team(user_ids, team_id, start, role_id, cursor, table_name)
+        return index.find_least_active_user_id(user_ids, team_id, start, role_id)
 
     def schedule(self, team, schedules, dbinfo):
+        '''
+        Create events for a team's schedules up to their auto-populate thresholds, returning the number of
+        events created
+        '''
         connection, cursor = dbinfo
         events = []
         for schedule in schedules:
@@ -354,25 +474,99 @@ class Scheduler(object):
 
         # Create events in the db, associating a user to them
         # Iterate through events in order of (start time, role) to properly assign users
+        index = self.load_event_index(team, events, cursor) if events else None
+        notification_settings = {}
+        num_events = 0
         for schedule, epoch in sorted(events, key=lambda x: (min(ev['start'] for ev in x[1]), x[0]['role_id'])):
-            user_id = self.find_next_user_id(schedule, epoch, cursor)
+            user_id = self.find_next_user_id(schedule, epoch, cursor, index=index)
             if not user_id:
                 logger.info('Failed to find available user')
                 continue
             logger.info('Found user: %s', user_id)
-            self.create_events(team['id'], schedule['id'], user_id, epoch, schedule['role_id'], cursor)
+            created = self.create_events(team['id'], schedule['id'], user_id, epoch, schedule['role_id'], cursor,
+                                         notification_settings=notification_settings)
+            if created:
+                num_events += len(epoch)
+                if index is not None:
+                    index.assign(schedule['id'], user_id, team['id'], schedule['role_id'], epoch)
+        if num_events:
+            mark_team_modified(cursor, team_id=team['id'])
         connection.commit()
+        return num_events
+
+    def get_populate_start_epoch(self, schedule, start_time):
+        '''
+        Returns the epoch populate starts from, which is the epoch of the first hand-off after ``start_time``
+        '''
+        start_dt = datetime.fromtimestamp(start_time, utc)
+        start_epoch = self.epoch_from_datetime(start_dt)
+        first_event_start = min(ev['start'] for ev in schedule['events'])
+        period = self.get_period_len(schedule)
+        handoff = start_epoch + timedelta(seconds=first_event_start)
+        handoff = timezone(schedule['timezone']).localize(handoff)
+
+        # Start scheduling from the next occurrence of the hand-off time.
+        if start_dt > handoff:
+            start_epoch += timedelta(weeks=period)
+            handoff += timedelta(weeks=period)
+        if handoff < utc.localize(datetime.utcnow()):
+            raise HTTPBadRequest('Invalid populate/preview request', 'cannot populate/preview starting in the past')
+        return start_epoch
 
-    def build_preview_response(self, cursor, start__lt, end__ge, team__eq, table_name='temp_event'):
-        # get existing events
+    def get_matching_events(self, schedule, start, cursor):
+        '''
+        Returns (start, end) of events for the schedule's team and role from ``start`` onwards which populate
+        would keep, so epochs they already cover can be skipped
+        '''
+        cursor.execute('''SELECT `start`, `end` FROM `event`
+                          WHERE `team_id` = %s AND `role_id` = %s AND `start` >= %s
+                              AND (`schedule_id` IS NULL OR `schedule_id` != %s)''',
+                       (schedule['team_id'], schedule['role_id'], start, schedule['id']))
+        return {(row['start'], row['end']) for row in cursor}
+
+    def plan(self, schedule, start_time, cursor):
+        '''
+        Work out the events populate would create for ``schedule`` from ``start_time`` without writing to
+        the DB. Existing events of the schedule from the first future event onwards are treated as deleted.
+        Returns (replace_from, assignments, last_epoch), where replace_from is the start of the first future
+        event (None if there are none) and assignments is a list of (user_id, events) tuples in order.
+        '''
+        start_epoch = self.get_populate_start_epoch(schedule, start_time)
+        future_events, last_epoch = self.calculate_future_events(schedule, cursor, start_epoch)
+        future_events = [[x for x in evs if x['start'] >= start_time] for evs in future_events]
+        future_events = [x for x in future_events if x != []]
+        if not future_events:
+            return None, [], last_epoch
+
+        first_event_start = min(future_events[0], key=lambda x: x['start'])['start']
+        matching = self.get_matching_events(schedule, first_event_start, cursor) if self.skip_match else set()
+        index = self.load_event_index({'id': schedule['team_id']}, [(schedule, epoch) for epoch in future_events],
+                                      cursor, exclude_schedule_id=schedule['id'])
+        assignments = []
+        for epoch in future_events:
+            # Skip this epoch if matching events exist
+            if all((ev['start'], ev['end']) in matching for ev in epoch):
+                continue
+            user_id = self.find_next_user_id(schedule, epoch, cursor, index=index)
+            if not user_id:
+                continue
+            index.assign(schedule['id'], user_id, schedule['team_id'], schedule['role_id'], epoch)
+            assignments.append((user_id, epoch))
+        return first_event_start, assignments, last_epoch
 
+    def build_preview_response(self, schedule, replace_from, assignments, cursor, start__lt, end__ge, team__eq):
+        # get existing events, leaving out those populate would replace
         cols = all_columns
-        query = '''SELECT %s FROM `%s`
-                JOIN `user` ON `user`.`id` = `%s`.`user_id`
-                JOIN `team` ON `team`.`id` = `%s`.`team_id`
-                JOIN `role` ON `role`.`id` = `%s`.`role_id`''' % (cols, table_name, table_name, table_name, table_name)
+        query = '''SELECT %s FROM `event`
+                JOIN `user` ON `user`.`id` = `event`.`user_id`
+                JOIN `team` ON `team`.`id` = `event`.`team_id`
+                JOIN `role` ON `role`.`id` = `event`.`role_id`''' % cols
         where_params = [constraints['start__lt'], constraints['end__ge']]
         where_vals = [start__lt, end__ge]
+        if replace_from is not None:
+            where_params.append('(`event`.`schedule_id` IS NULL OR `event`.`schedule_id` != %s '
+                                'OR `event`.`start` < %s)')
+            where_vals += [schedule['id'], replace_from]
 
         # Deal with team subscriptions and team parameters
         team_where = [constraints['team__eq']]
@@ -381,10 +575,11 @@ class Scheduler(object):
         cursor.execute('''SELECT `subscription_id`, `role_id` FROM `team_subscription`
                         JOIN `team` ON `team_id` = `team`.`id`
                         WHERE %s''' % subs_and, subs_vals)
-        if cursor.rowcount != 0:
+        subscriptions = {(row['subscription_id'], row['role_id']) for row in cursor}
+        if subscriptions:
             # Build where clause based on team params and subscriptions
             subs_and = '(%s OR (%s))' % (subs_and, ' OR '.join(['`team`.`id` = %s AND `role`.`id` = %s' %
-                                                                (row['subscription_id'], row['role_id']) for row in cursor]))
+                                                                sub for sub in subscriptions]))
         where_params.append(subs_and)
         where_vals += subs_vals
 
@@ -393,45 +588,71 @@ class Scheduler(object):
             query = '%s WHERE %s' % (query, where_query)
         cursor.execute(query, where_vals)
         data = cursor.fetchall()
+
+        # Add planned events, shaped like the existing ones
+        if (schedule['team'] == team__eq or (schedule['team_id'], schedule['role_id']) in subscriptions) and assignments:
+            cursor.execute('SELECT `id`, `name`, `full_name` FROM `user` WHERE `id` IN %s',
+                           ([user_id for user_id, _ in assignments],))
+            users = {row['id']: row for row in cursor}
+            for user_id, epoch in assignments:
+                link_id = gen_link_id() if len(epoch) > 1 else None
+                for ev in epoch:
+                    if ev['start'] >= float(start__lt) or ev['end'] < float(end__ge):
+                        continue
+                    data.append({'id': None, 'start': ev['start'], 'end': ev['end'], 'role': schedule['role'],
+                                 'team': schedule['team'], 'user': users[user_id]['name'],
+                                 'full_name': users[user_id]['full_name'], 'schedule_id': schedule['id'],
+                                 'link_id': link_id, 'note': None})
         return json_dumps(data)
 
-    def populate(self, schedule, start_time, dbinfo, table_name='event'):
-        connection, cursor = dbinfo
-        start_dt = datetime.fromtimestamp(start_time, utc)
-        start_epoch = self.epoch_from_datetime(start_dt)
+    def preview(self, schedule, start_time, cursor, start__lt, end__ge, team__eq):
+        '''
+        Returns the JSON for the events a team would have in a time range if ``schedule`` was populated from
+        ``start_time``. Nothing is written to the DB.
+        '''
+        replace_from, assignments, _ = self.plan(schedule, start_time, cursor)
+        return self.build_preview_response(schedule, replace_from, assignments, cursor, start__lt, end__ge, team__eq)
 
-        # Get schedule info
-        role_id = schedule['role_id']
+    def insert_planned_events(self, schedule, assignments, cursor):
+        '''
+        Insert every epoch of planned events in one statement and queue their event created notifications
+        '''
         team_id = schedule['team_id']
-        first_event_start = min(ev['start'] for ev in schedule['events'])
-        period = self.get_period_len(schedule)
-        handoff = start_epoch + timedelta(seconds=first_event_start)
-        handoff = timezone(schedule['timezone']).localize(handoff)
-
-        # Start scheduling from the next occurrence of the hand-off time.
-        if start_dt > handoff:
-            start_epoch += timedelta(weeks=period)
-            handoff += timedelta(weeks=period)
-        if handoff < utc.localize(datetime.utcnow()):
-            cursor.execute("DROP TEMPORARY TABLE IF EXISTS `temp_event`")
-            connection.commit()
-            raise HTTPBadRequest('Invalid populate/preview request', 'cannot populate/preview starting in the past')
+        role_id = schedule['role_id']
+        event_args = []
+        for user_id, epoch in assignments:
+            link_id = gen_link_id() if len(epoch) > 1 else None
+            event_args += [(team_id, schedule['id'], ev['start'], ev['end'], user_id, role_id, link_id)
+                           for ev in epoch]
+        cursor.executemany('''
+            INSERT INTO `event` (
+                `team_id`, `schedule_id`, `start`, `end`, `user_id`, `role_id`, `link_id`
+            ) VALUES (
+                %s, %s, %s, %s, %s, %s, %s
+            )''', event_args)
+
+        user_ids = list({user_id for user_id, _ in assignments})
+        cursor.execute('SELECT `id`, `name` FROM `user` WHERE `id` IN %s', (user_ids,))
+        names = {row['id']: {'name': row['name']} for row in cursor}
+        settings = get_notification_settings(team_id, [role_id], EVENT_CREATED, cursor)
+        for user_id, epoch in assignments:
+            context = {
+                'team': team_id,
+                'role': role_id,
+                'full_name': names[user_id]
+            }
+            create_notifications(context, team_id, [role_id], EVENT_CREATED, [user_id], cursor,
+                                 [{'start_time': ev['start']} for ev in epoch], settings)
 
-        future_events, last_epoch = self.calculate_future_events(schedule, cursor, start_epoch)
+    def populate(self, schedule, start_time, dbinfo):
+        connection, cursor = dbinfo
+        replace_from, assignments, last_epoch = self.plan(schedule, start_time, cursor)
         self.set_last_epoch(schedule['id'], last_epoch, cursor)
 
-        # Delete existing events from the start of the first event
-        future_events = [[x for x in evs if x['start'] >= start_time] for evs in future_events]
-        future_events = [x for x in future_events if x != []]
-        if future_events:
-            first_event_start = min(future_events[0], key=lambda x: x['start'])['start']
-            query = 'DELETE FROM %s WHERE schedule_id = %%s AND start >= %%s' % table_name
-            cursor.execute(query, (schedule['id'], first_event_start))
-
-        # Create events in the db, associating a user to them
-        for epoch in future_events:
-            user_id = self.find_next_user_id(schedule, epoch, cursor, table_name)
-            if not user_id:
-                continue
-            self.create_events(team_id, schedule['id'], user_id, epoch, role_id, cursor, table_name)
+        # Delete existing events from the start of the first event, then write the plan in one batch
+        if replace_from is not None:
+            cursor.execute('DELETE FROM `event` WHERE `schedule_id` = %s AND `start` >= %s',
+                           (schedule['id'], replace_from))
+        if assignments:
+            self.insert_planned_events(schedule, assignments, cursor)
         connection.commit()
@@ -0,0 +1,139 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+
+class EventIndex(object):
+    '''
+    In-memory view of the events a team's scheduling decisions depend on. Loaded once per team per
+    scheduling run, it answers the roster, conflict, new user and least active user questions that
+    Scheduler.find_next_user_id would otherwise ask the DB for every epoch. Events created by the
+    scheduler are added as they are assigned, so later epochs see earlier assignments.
+    '''
+
+    def __init__(self, team_id, subscriptions, vacation_role_id):
+        self.team_id = team_id
+        # (team_id, role_id) pairs whose events count as conflicts for this team
+        self.subscriptions = set(subscriptions)
+        self.vacation_role_id = vacation_role_id
+        # roster_id -> user ids in rotation
+        self.rosters = {}
+        # user_id -> sorted list of (start, end, team_id, role_id)
+        self.user_events = defaultdict(list)
+        # (team_id, role_id, user_id) -> sorted list of event end times
+        self.ends = defaultdict(list)
+        # schedule_id -> user last assigned to it while planning
+        self.last_users = {}
+
+    @classmethod
+    def load(cls, team_id, roster_ids, start, cursor, exclude_schedule_id=None, subscriptions=None):
+        '''
+        Load the index for scheduling ``team_id`` from ``start`` onwards, using users from ``roster_ids``.
+        Only aggregates are loaded for events ending before ``start``; later events are loaded in full.
+        Events of ``exclude_schedule_id`` starting from ``start`` are left out, as populate replaces them.
+        ``subscriptions`` is an optional list of the team's (subscription_id, role_id) pairs, if already known.
+        '''
+        if subscriptions is None:
+            cursor.execute('''SELECT `subscription_id`, `role_id` FROM `team_subscription` WHERE `team_id` = %s''',
+                           team_id)
+            subscriptions = [(row['subscription_id'], row['role_id']) for row in cursor]
+        cursor.execute('''SELECT `id` FROM `role` WHERE `name` = 'vacation' ''')
+        vacation_role_id = cursor.fetchone()['id'] if cursor.rowcount else None
+        index = cls(team_id, subscriptions, vacation_role_id)
+
+        for roster_id in roster_ids:
+            index.rosters[roster_id] = set()
+        if not roster_ids:
+            return index
+        cursor.execute('''SELECT `roster_user`.`roster_id`, `roster_user`.`user_id` FROM `roster_user`
+                          JOIN `user` ON `user`.`id` = `roster_user`.`user_id`
+                          WHERE `roster_user`.`in_rotation` = 1 AND `roster_user`.`roster_id` IN %s
+                              AND `user`.`active` = TRUE''', (list(roster_ids),))
+        for row in cursor:
+            index.rosters[row['roster_id']].add(row['user_id'])
+        user_ids = set().union(*index.rosters.values())
+        if not user_ids:
+            return index
+
+        cursor.execute('''SELECT `role_id`, `user_id`, MAX(`end`) AS `last_end` FROM `event`
+                          WHERE `team_id` = %s AND `user_id` IN %s AND `end` <= %s
+                          GROUP BY `role_id`, `user_id`''',
+                       (team_id, list(user_ids), start))
+        for row in cursor:
+            index.ends[(team_id, row['role_id'], row['user_id'])].append(row['last_end'])
+
+        cursor.execute('''SELECT `team_id`, `role_id`, `user_id`, `schedule_id`, `start`, `end` FROM `event`
+                          WHERE `user_id` IN %s AND `end` > %s''',
+                       (list(user_ids), start))
+        for row in cursor:
+            if exclude_schedule_id is not None and row['schedule_id'] == exclude_schedule_id and row['start'] >= start:
+                continue
+            index.add_event(row['user_id'], row['team_id'], row['role_id'], row['start'], row['end'])
+        return index
+
+    def add_event(self, user_id, team_id, role_id, start, end):
+        insort(self.user_events[user_id], (start, end, team_id, role_id))
+        insort(self.ends[(team_id, role_id, user_id)], end)
+
+    def add_events(self, user_id, team_id, role_id, events):
+        for ev in events:
+            self.add_event(user_id, team_id, role_id, ev['start'], ev['end'])
+
+    def assign(self, schedule_id, user_id, team_id, role_id, events):
+        '''
+        Record that ``user_id`` was assigned an epoch of ``events`` for a schedule
+        '''
+        self.add_events(user_id, team_id, role_id, events)
+        self.last_users[schedule_id] = user_id
+
+    def get_roster_user_ids(self, roster_id):
+        return set(self.rosters.get(roster_id, ()))
+
+    def is_conflict(self, team_id, role_id, all_teams=False):
+        return (all_teams or team_id == self.team_id or role_id == self.vacation_role_id or
+                (team_id, role_id) in self.subscriptions)
+
+    def get_busy_user_ids(self, user_ids, events, all_teams=False):
+        '''
+        Find which users have events overlapping any of ``events``. Only this team's events, its
+        subscriptions' and vacations are considered, unless ``all_teams`` is set.
+        '''
+        busy = set()
+        for user_id in user_ids:
+            user_events = self.user_events.get(user_id)
+            if not user_events:
+                continue
+            for ev in events:
+                # Candidates start before the event ends; check them for overlap
+                for start, end, team_id, role_id in user_events[:bisect_left(user_events, (ev['end'],))]:
+                    if ev['start'] < end and self.is_conflict(team_id, role_id, all_teams):
+                        busy.add(user_id)
+                        break
+                if user_id in busy:
+                    break
+        return busy
+
+    def get_last_end(self, user_id, team_id, role_id, start):
+        ends = self.ends.get((team_id, role_id, user_id))
+        if not ends:
+            return None
+        idx = bisect_right(ends, start)
+        return ends[idx - 1] if idx else None
+
+    def find_new_user_ids(self, roster_id, team_id, start, role_id):
+        '''
+        Return roster users who have no events for this team and role ending before ``start``
+        '''
+        return {user_id for user_id in self.get_roster_user_ids(roster_id)
+                if self.get_last_end(user_id, team_id, role_id, start) is None}
+
+    def find_least_active_user_id(self, user_ids, team_id, start, role_id):
+        '''
+        Of the users who have been oncall for this team and role before ``start``, find the one who
+        hasn't been oncall for the longest
+        '''
+        last_ends = [(last_end, user_id) for user_id, last_end in
+                     ((uid, self.get_last_end(uid, team_id, role_id, start)) for uid in user_ids)
+                     if last_end is not None]
+        if not last_ends:
+            return None
+        return min(last_ends)[1]
@@ -2,5 +2,9 @@ from . import default
 
 
 class Scheduler(default.Scheduler):
-    def create_events(self, team_id, schedule_id, user_id, events, role_id, cursor, table_name='event', skip_match=True):
-        super(Scheduler, self).create_events(team_id, schedule_id, user_id, events, role_id, cursor, table_name, skip_match=False)
\ No newline at end of file
+    skip_match = False
+
+    def create_events(self, team_id, schedule_id, user_id, events, role_id, cursor, table_name='event', skip_match=True,
+                      notification_settings=None):
+        return super(Scheduler, self).create_events(team_id, schedule_id, user_id, events, role_id, cursor, table_name, skip_match=False,
+                                                    notification_settings=notification_settings)
\ No newline at end of file
@@ -1,12 +1,12 @@
-from oncall.utils import gen_link_id, create_notification
-from ..constants import EVENT_CREATED
 from . import default
+from .event_index import EventIndex
 import logging
 
 logger = logging.getLogger()
 
 
 class Scheduler(default.Scheduler):
+    skip_match = False
 
     def guess_last_scheduled_user(self, schedule, start, roster, cursor, table_name='event'):
         query = '''
@@ -14,17 +14,28 @@ class Scheduler(default.Scheduler):
                         (SELECT `user_id`, MAX(`start`) AS `last_start` FROM `%s`
                          WHERE `team_id` = %%s AND `user_id` IN %%s AND `start` <= %%s
                          AND `role_id` = %%s
+                         AND (`schedule_id` IS NULL OR `schedule_id` != %%s OR `start` < %%s)
                          GROUP BY `user_id`
                          ORDER BY `last_start` DESC) t
                         LIMIT 1
                         ''' % table_name
-        cursor.execute(query, (schedule['team_id'], roster, start, schedule['role_id']))
+        # This schedule's events from start onwards are the ones being (re)placed, so they don't count
+        cursor.execute(query, (schedule['team_id'], roster, start, schedule['role_id'], schedule['id'], start))
         if cursor.rowcount != 0:
             return cursor.fetchone()['user_id']
         else:
             return None
 
-    def find_next_user_id(self, schedule, future_events, cursor, table_name='event'):
+    def load_event_index(self, team, epochs, cursor, exclude_schedule_id=None):
+        # Round robin follows the roster order and ignores other events, so the index only tracks the
+        # users assigned along the way
+        index = EventIndex(team['id'], (), None)
+        if exclude_schedule_id is not None:
+            # When repopulating, ignore last_scheduled_user_id and pick the rotation up from the calendar
+            index.last_users[exclude_schedule_id] = None
+        return index
+
+    def find_next_user_id(self, schedule, future_events, cursor, table_name='event', index=None):
         cursor.execute('''SELECT `user_id` FROM `roster_user`
                            WHERE `roster_id` = %s AND in_rotation = TRUE''',
                        schedule['roster_id'])
@@ -35,11 +46,17 @@ class Scheduler(default.Scheduler):
                           ORDER BY priority, user_id''',
                        schedule['id'])
         roster = [row['user_id'] for row in cursor if row['user_id'] in roster_users]
-        cursor.execute('SELECT last_scheduled_user_id FROM schedule WHERE id = %s', schedule['id'])
-        if cursor.rowcount == 0 or roster == []:
-            # Schedule doesn't exist, or roster is empty. Bail
+        if roster == []:
+            # Roster is empty. Bail
             return None
-        last_user = cursor.fetchone()['last_scheduled_user_id']
+        if index is not None and schedule['id'] in index.last_users:
+            last_user = index.last_users[schedule['id']]
+        else:
+            cursor.execute('SELECT last_scheduled_user_id FROM schedule WHERE id = %s', schedule['id'])
+            if cursor.rowcount == 0:
+                # Schedule doesn't exist. Bail
+                return None
+            last_user = cursor.fetchone()['last_scheduled_user_id']
         if last_user not in roster:
             # If this user is no longer in the roster or last_scheduled_user is NULL, try to find
             # the last scheduled user using the calendar
@@ -51,60 +68,15 @@ class Scheduler(default.Scheduler):
         last_idx = roster.index(last_user)
         return roster[(last_idx + 1) % len(roster)]
 
-    def create_events(self, team_id, schedule_id, user_id, events, role_id, cursor, table_name='event', skip_match=True):
-        if len(events) == 1:
-            [event] = events
-            event_args = (team_id, schedule_id, event['start'], event['end'], user_id, role_id)
-            logger.debug('inserting event: %s', event_args)
-            query = '''
-                INSERT INTO `%s` (
-                    `team_id`, `schedule_id`, `start`, `end`, `user_id`, `role_id`
-                ) VALUES (
-                    %%s, %%s, %%s, %%s, %%s, %%s
-                )''' % table_name
-            cursor.execute(query, event_args)
-            cursor.execute('SELECT `name` FROM `user` WHERE `id` = %s', user_id)
-            name = cursor.fetchone()
-            context = {
-                'team': team_id,
-                'role': role_id,
-                'full_name': name
-            }
-            create_notification(context, team_id,
-                                [role_id],
-                                EVENT_CREATED,
-                                [user_id],
-                                cursor,
-                                start_time=event['start'])
-        else:
-            link_id = gen_link_id()
-            for event in events:
-                event_args = (team_id, schedule_id, event['start'], event['end'], user_id, role_id, link_id)
-                logger.debug('inserting event: %s', event_args)
-                query = '''
-                    INSERT INTO `%s` (
-                        `team_id`, `schedule_id`, `start`, `end`, `user_id`, `role_id`, `link_id`
-                    ) VALUES (
-                        %%s, %%s, %%s, %%s, %%s, %%s, %%s
-                    )''' % table_name
-                cursor.execute(query, event_args)
-                cursor.execute('SELECT `name` FROM `user` WHERE `id` = %s', user_id)
-                name = cursor.fetchone()
-                context = {
-                    'team': team_id,
-                    'role': role_id,
-                    'full_name': name
-                }
-                create_notification(context, team_id,
-                                    [role_id],
-                                    EVENT_CREATED,
-                                    [user_id],
-                                    cursor,
-                                    start_time=event['start'])
+    def create_events(self, team_id, schedule_id, user_id, events, role_id, cursor, table_name='event', skip_match=True,
+                      notification_settings=None):
+        if len(events) == 0:
+            return False
+        self.insert_events(team_id, schedule_id, user_id, events, role_id, cursor, table_name, notification_settings)
         cursor.execute('UPDATE `schedule` SET `last_scheduled_user_id` = %s WHERE `id` = %s', (user_id, schedule_id))
+        return True
 
-    def populate(self, schedule, start_time, dbinfo, table_name='event'):
-        _, cursor = dbinfo
-        # Null last_scheduled_user to force find_next_user to determine that from the calendar
-        cursor.execute('UPDATE `schedule` SET `last_scheduled_user_id` = NULL WHERE `id` = %s', schedule['id'])
-        super(Scheduler, self).populate(schedule, start_time, dbinfo, table_name=table_name)
\ No newline at end of file
+    def insert_planned_events(self, schedule, assignments, cursor):
+        super(Scheduler, self).insert_planned_events(schedule, assignments, cursor)
+        cursor.execute('UPDATE `schedule` SET `last_scheduled_user_id` = %s WHERE `id` = %s',
+                       (assignments[-1][0], schedule['id']))
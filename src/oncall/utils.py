@@ -44,26 +44,60 @@ def create_notification(context, team_id, role_ids, type_name, users_involved, c
     :param kwargs: components of context that require timezone formatting, passed as unix timestamps
     :return: None
     '''
-    cursor.execute('''SELECT `user_id`, `mode_id`, `type_id`, `user`.`time_zone` FROM notification_setting
+    create_notifications(context, team_id, role_ids, type_name, users_involved, cursor, [kwargs])
+
+
+def get_notification_settings(team_id, role_ids, type_name, cursor):
+    '''
+    Fetch every notification setting for a team, roles and notification type, regardless of who is involved.
+    The result can be reused across calls to create_notifications for the same team, roles and type.
+    '''
+    cursor.execute('''SELECT `user_id`, `mode_id`, `type_id`, `only_if_involved`, `user`.`time_zone`
+                      FROM notification_setting
                       JOIN `notification_type` ON `notification_setting`.`type_id` = `notification_type`.`id`
                       JOIN `setting_role` ON `notification_setting`.`id` = `setting_role`.`setting_id`
                       JOIN `user` ON `user_id` = `user`.`id`
                       WHERE team_id = %s AND `setting_role`.`role_id` IN %s AND `notification_type`.`name` = %s
-                          AND (user_id IN %s OR only_if_involved = FALSE)
-                      GROUP BY `user_id`, `mode_id`
-                  ''', (team_id, role_ids, type_name, users_involved))
-    notifications = cursor.fetchall()
+                  ''', (team_id, role_ids, type_name))
+    return cursor.fetchall()
+
+
+def create_notifications(context, team_id, role_ids, type_name, users_involved, cursor, timestamps, settings=None):
+    '''
+    Batched version of create_notification. Queues one notification per recipient for each dict in
+    ``timestamps``, using a single INSERT.
+
+    :param timestamps: list of dicts of context components that require timezone formatting, passed as
+    unix timestamps
+    :param settings: optional. Result of get_notification_settings for this team, roles and type. Fetched if
+    not provided.
+    '''
+    if settings is None:
+        settings = get_notification_settings(team_id, role_ids, type_name, cursor)
+
+    # Pick one setting per (user, mode), skipping users who only want notifications they're involved in
+    notifications = {}
+    for setting in settings:
+        if setting['user_id'] in users_involved or setting['only_if_involved'] == 0:
+            notifications.setdefault((setting['user_id'], setting['mode_id']), setting)
 
-    for notification in notifications:
+    query_params = []
+    for notification in notifications.values():
         tz = notification['time_zone'] if notification['time_zone'] else 'UTC'
-        for var_name, timestamp in kwargs.items():
-            context[var_name] = ' '.join([datetime.fromtimestamp(timestamp,
-                                                                 timezone(tz)).strftime('%Y-%m-%d %H:%M:%S'),
-                                          tz])
-        cursor.execute('''INSERT INTO `notification_queue` (`user_id`, `send_time`, `mode_id`, `context`, `type_id`,
-                              `active`)
-                          VALUES (%s, UNIX_TIMESTAMP(), %s, %s, %s, 1)''',
-                       (notification['user_id'], notification['mode_id'], json_dumps(context), notification['type_id']))
+        for kwargs in timestamps:
+            for var_name, timestamp in kwargs.items():
+                context[var_name] = ' '.join([datetime.fromtimestamp(timestamp,
+                                                                     timezone(tz)).strftime('%Y-%m-%d %H:%M:%S'),
+                                              tz])
+            query_params += [notification['user_id'], notification['mode_id'], json_dumps(context),
+                             notification['type_id']]
+    if not query_params:
+        return
+    row_count = len(query_params) // 4
+    cursor.execute('''INSERT INTO `notification_queue` (`user_id`, `send_time`, `mode_id`, `context`, `type_id`,
+                          `active`)
+                      VALUES ''' + ', '.join(['(%s, UNIX_TIMESTAMP(), %s, %s, %s, 1)'] * row_count),
+                   query_params)
 
 
 def subscribe_notifications(team, user, cursor):
@@ -99,6 +133,44 @@ def create_audit(context, team_name, action_name, req, cursor):
     cursor.execute('''INSERT INTO audit(`team_name`, `owner_name`, `action_name`, `context`, `timestamp`)
                       VALUES (%s, %s, %s, %s, UNIX_TIMESTAMP())''',
                    (team_name, owner_name, action_name, json_dumps(context)))
+    mark_team_modified(cursor, team=team_name)
+
+
+def mark_schedules_dirty(cursor, team_id=None, team=None, schedule_id=None):
+    '''
+    Flag schedules for the scheduler to re-evaluate on its next poll. Call this on writes to schedules,
+    rosters, roster users, events, team subscriptions and team scheduling timezones. Schedules are
+    selected by exactly one of team_id, team (name) or schedule_id.
+    '''
+    if schedule_id is not None:
+        cursor.execute('UPDATE `schedule` SET `dirty` = TRUE WHERE `id` = %s', schedule_id)
+    elif team_id is not None:
+        cursor.execute('UPDATE `schedule` SET `dirty` = TRUE WHERE `team_id` = %s', team_id)
+    else:
+        cursor.execute('''UPDATE `schedule` SET `dirty` = TRUE
+                          WHERE `team_id` = (SELECT `id` FROM `team` WHERE `name` = %s)''', team)
+
+
+def mark_team_modified(cursor, team_id=None, team=None, schedule_id=None, user=None):
+    '''
+    Bump the version of teams whose data changed, which changes the ETags of their read endpoints. Call
+    this on writes to anything returned by team-scoped GETs; create_audit does so for audited writes.
+    Teams are selected by exactly one of team_id, team (name), schedule_id or user (name, for every
+    team the user is in). If none is given, all teams are bumped.
+    '''
+    update = 'UPDATE `team` SET `version` = `version` + 1, `last_modified` = UNIX_TIMESTAMP()'
+    if team_id is not None:
+        cursor.execute(update + ' WHERE `id` = %s', team_id)
+    elif team is not None:
+        cursor.execute(update + ' WHERE `name` = %s', team)
+    elif schedule_id is not None:
+        cursor.execute(update + ' WHERE `id` = (SELECT `team_id` FROM `schedule` WHERE `id` = %s)', schedule_id)
+    elif user is not None:
+        cursor.execute(update + ''' WHERE `id` IN (SELECT `team_id` FROM `team_user`
+                                                 JOIN `user` ON `user`.`id` = `team_user`.`user_id`
+                                                 WHERE `user`.`name` = %s)''', user)
+    else:
+        cursor.execute(update)
 
 
 def user_in_team(cursor, user_id, team_id):
@@ -0,0 +1,105 @@
+import falcon
+import falcon.testing
+
+from oncall import db
+from oncall.app import ConditionalGetMiddleware, DBConnectionMiddleware
+
+
+class VersionedResource(object):
+    def __init__(self):
+        self.version = 1
+        self.calls = 0
+
+    def get_versions(self, req, params):
+        return [(1, self.version, 1500000000)]
+
+    def on_get(self, req, resp):
+        self.calls += 1
+        resp.text = '{"version": %d}' % self.version
+
+
+class PlainResource(object):
+    def on_get(self, req, resp):
+        resp.text = '["foo"]'
+
+
+def test_conditional_get():
+    versioned = VersionedResource()
+    application = falcon.App(middleware=[ConditionalGetMiddleware()])
+    application.add_route('/versioned', versioned)
+    application.add_route('/plain', PlainResource())
+    client = falcon.testing.TestClient(application)
+
+    re = client.simulate_get('/versioned')
+    assert re.status == falcon.HTTP_200
+    etag = re.headers['ETag']
+    assert re.headers['Last-Modified'] == 'Fri, 14 Jul 2017 02:40:00 GMT'
+
+    # Unchanged version: 304 without running the responder
+    re = client.simulate_get('/versioned', headers={'If-None-Match': etag})
+    assert re.status == falcon.HTTP_304
+    assert re.headers['ETag'] == etag
+    assert versioned.calls == 1
+
+    # Different query strings get different tags
+    re = client.simulate_get('/versioned', query_string='fields=name', headers={'If-None-Match': etag})
+    assert re.status == falcon.HTTP_200
+    assert re.headers['ETag'] != etag
+
+    versioned.version = 2
+    re = client.simulate_get('/versioned', headers={'If-None-Match': etag})
+    assert re.status == falcon.HTTP_200
+    assert re.json == {'version': 2}
+
+    # Resources without versions are tagged by body
+    re = client.simulate_get('/plain')
+    etag = re.headers['ETag']
+    re = client.simulate_get('/plain', headers={'If-None-Match': etag})
+    assert re.status == falcon.HTTP_304
+    assert not re.text
+
+
+class DBResource(object):
+    def on_get(self, req, resp):
+        for _ in range(3):
+            connection = db.connect()
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            connection.close()
+        resp.text = '[]'
+
+    def on_post(self, req, resp):
+        connection = db.connect()
+        connection.cursor().execute('INSERT INTO `foo` VALUES (1)')
+        connection.commit()
+        connection.close()
+
+
+def test_db_connection_middleware(mocker):
+    raw_connection = mocker.MagicMock()
+    mocker.patch('oncall.db.raw_connect', return_value=raw_connection)
+    mocker.patch('oncall.db.engine')
+    db.engine.pool.checkedout.return_value = 0
+    db.engine.pool.overflow.return_value = -5
+    application = falcon.App(middleware=[DBConnectionMiddleware()])
+    application.add_route('/db', DBResource())
+    client = falcon.testing.TestClient(application)
+
+    # One checkout per request, returned to the pool at the end
+    client.simulate_get('/db')
+    assert db.raw_connect.call_count == 1
+    assert raw_connection.cursor.return_value.execute.call_count == 3
+    assert raw_connection.rollback.call_count == 3
+    assert raw_connection.close.call_count == 1
+    assert db.engine.pool.checkedout.called
+
+    # Committed work needs no rollback
+    client.simulate_post('/db')
+    assert db.raw_connect.call_count == 2
+    assert raw_connection.rollback.call_count == 3
+
+    # Outside of requests every connect() is a checkout
+    db.connect().close()
+    assert db.raw_connect.call_count == 3
+    assert raw_connection.close.call_count == 3
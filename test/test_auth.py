@@ -1,4 +1,6 @@
-from oncall.auth import login_required
+from oncall.auth import (login_required, check_team_auth, check_calendar_auth, check_calendar_auth_by_id,
+                         is_god, match_client_digest, signed_csrf_token, _authenticate_user)
+from oncall import cache, metrics
 from oncall.app import ReqBodyMiddleware
 import falcon
 import falcon.testing
@@ -6,6 +8,7 @@ import time
 import hmac
 import hashlib
 import base64
+import pytest
 
 
 class DummyAPI(object):
@@ -58,4 +61,112 @@ def test_application_auth(mocker):
     auth = 'hmac dummy:%s' % digest
 
     re = client.simulate_post('/dummy_path', body=body, headers={'AUTHORIZATION': auth})
-    assert re.status_code == 201
\ No newline at end of file
+    assert re.status_code == 201
+
+
+def test_auth_checks_cached(mocker):
+    cursor = mocker.MagicMock(name='dummyCursor')
+    cursor.__iter__.side_effect = lambda: iter([('admin', 1, 'team-foo'), ('member', 1, 'team-foo'),
+                                                ('member', 2, 'team-bar')])
+    connect = mocker.MagicMock(name='dummyDB')
+    connect.cursor.return_value = cursor
+    db = mocker.MagicMock()
+    db.connect.return_value = connect
+    mocker.patch('oncall.auth.db', db)
+    mocker.patch.object(cache.auth, 'max_age', 30)
+    cache.auth.invalidate()
+
+    req = mocker.MagicMock(context={'user': 'foo'})
+    check_team_auth('team-foo', req)
+    check_calendar_auth('team-bar', req)
+    check_calendar_auth_by_id('2', req)
+    with pytest.raises(falcon.HTTPForbidden):
+        check_team_auth('team-bar', req)
+    assert not is_god('foo')
+    # All checks are answered from one query
+    assert cursor.execute.call_count == 1
+
+    cache.auth.invalidate()
+    check_team_auth('team-foo', req)
+    assert cursor.execute.call_count == 2
+    cache.auth.invalidate()
+
+
+def sign(key, window, method, path, body=''):
+    text = '%s %s %s %s' % (window, method, path, body)
+    return base64.urlsafe_b64encode(hmac.new(key, text.encode('utf-8'), hashlib.sha512).digest()).decode('utf-8')
+
+
+def test_match_client_digest(mocker):
+    mocker.patch('oncall.auth.time.time', return_value=1500000000)
+    path = '/api/v0/teams/foo bar'
+    assert match_client_digest(sign(b'abc', 300000000, 'GET', '/api/v0/teams/foo%20bar'),
+                               b'abc', 'GET', path, '') == ('current', True)
+    assert match_client_digest(sign(b'abc', 49999999, 'GET', path), b'abc', 'GET', path, '') == ('long_previous', False)
+    assert match_client_digest(sign(b'xyz', 300000000, 'GET', path), b'abc', 'GET', path, '') is None
+    assert match_client_digest('not base64!', b'abc', 'GET', path, '') is None
+
+    # The preferred variant is computed first, so a steady client costs one HMAC
+    new = mocker.spy(hmac, 'new')
+    assert match_client_digest(sign(b'abc', 299999999, 'GET', path), b'abc', 'GET', path, '',
+                               ('previous', False)) == ('previous', False)
+    assert new.call_count == 2
+
+
+def test_application_key_cached(mocker):
+    connect = mocker.MagicMock(name='dummyDB')
+    cursor = mocker.MagicMock(name='dummyCursor', rowcount=1)
+    cursor.fetchone.return_value = ['abc']
+    connect.cursor.return_value = cursor
+    db = mocker.MagicMock()
+    db.connect.return_value = connect
+    mocker.patch('oncall.auth.db', db)
+    mocker.patch.object(cache.app_keys, 'max_age', 30)
+    cache.app_keys.invalidate()
+
+    api = falcon.App(middleware=[ReqBodyMiddleware()])
+    api.add_route('/dummy_path', DummyAPI())
+    client = falcon.testing.TestClient(api)
+    hits = metrics.stats['app_auth_current_window']
+    for _ in range(3):
+        auth = 'hmac dummy:%s' % sign(b'abc', int(time.time()) // 5, 'GET', '/dummy_path')
+        assert client.simulate_get('/dummy_path', headers={'AUTHORIZATION': auth}).status_code == 200
+    assert cursor.execute.call_count == 1
+    assert metrics.stats['app_auth_current_window'] - hits == 3
+
+    # A rotated key is picked up on the first failed check
+    cursor.fetchone.return_value = ['def']
+    auth = 'hmac dummy:%s' % sign(b'def', int(time.time()) // 5, 'GET', '/dummy_path')
+    assert client.simulate_get('/dummy_path', headers={'AUTHORIZATION': auth}).status_code == 200
+    assert cursor.execute.call_count == 2
+    cache.app_keys.invalidate()
+
+
+def test_signed_csrf_token(mocker):
+    connect = mocker.MagicMock(name='dummyDB')
+    cursor = mocker.MagicMock(name='dummyCursor', rowcount=1)
+    cursor.fetchone.return_value = ['abc123']
+    connect.cursor.return_value = cursor
+    db = mocker.MagicMock()
+    db.connect.return_value = connect
+    mocker.patch('oncall.auth.db', db)
+    mocker.patch('oncall.auth.sso_auth_manager', None)
+    mocker.patch('oncall.auth.csrf_sign_key', b'123')
+
+    def request(token):
+        req = mocker.MagicMock(env={'beaker.session': {'_id': 'session-1', 'user': 'foo'}}, context={})
+        req.get_header.return_value = token
+        return req
+
+    token = signed_csrf_token('session-1')
+    assert token != signed_csrf_token('session-2')
+    _authenticate_user(request(token))
+    with pytest.raises(falcon.HTTPUnauthorized):
+        _authenticate_user(request(signed_csrf_token('session-2')))
+    assert cursor.execute.call_count == 0
+
+    # Tokens of legacy sessions are still checked against the session table
+    _authenticate_user(request('abc123'))
+    assert cursor.execute.call_count == 1
+    with pytest.raises(falcon.HTTPUnauthorized):
+        _authenticate_user(request('abc124'))
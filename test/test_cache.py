@@ -0,0 +1,97 @@
+import time
+
+from oncall import cache
+
+
+def test_cache_expires_at_boundary():
+    c = cache.Cache('test-expiry', max_age=60)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return 'body', time.time() + 0.05
+
+    assert c.load('team-foo', loader) == 'body'
+    assert c.load('team-foo', loader) == 'body'
+    assert len(calls) == 1 and c.hits == 1
+    time.sleep(0.06)
+    c.load('team-foo', loader)
+    assert len(calls) == 2
+
+    # max_age caps entries whose boundary is far off, and 0 disables caching
+    c.set('capped', 'body', float('inf'), c.generation())
+    assert c.entries['capped'][1] <= time.time() + 60
+    c.max_age = 0
+    c.load('team-foo', loader)
+    c.load('team-foo', loader)
+    assert len(calls) == 4
+
+
+def test_cache_invalidation_during_load():
+    c = cache.Cache('test-invalidate', max_age=60)
+    c.load('team-foo', lambda: ('old', float('inf')))
+    c.invalidate()
+    assert c.get('team-foo') is None
+
+    # A write committing while the loader runs must not leave the loaded value cached
+    def racing_loader():
+        c.invalidate()
+        return 'stale', float('inf')
+    assert c.load('team-foo', racing_loader) == 'stale'
+    assert c.load('team-foo', lambda: ('fresh', float('inf'))) == 'fresh'
+
+
+def test_shared_generations(tmpdir, mocker):
+    path = str(tmpdir.join('oncall-cache'))
+    worker_a = cache.SharedGenerations(path)
+    worker_b = cache.SharedGenerations(path)
+    mocker.patch('oncall.cache.generations', worker_a)
+    c = cache.Cache('oncall', max_age=60)
+    c.load('team-foo', lambda: ('body', float('inf')))
+    assert c.get('team-foo') == 'body'
+
+    # Invalidation from another process drops this process's entries
+    worker_b.bump('oncall')
+    assert worker_a.get('oncall') == 1
+    assert c.get('team-foo') is None
+
+
+def test_oncall_endpoints_read_through(mocker):
+    from oncall.api.v0 import team_oncall, service_oncall
+    mocker.patch('oncall.cache.oncall', cache.Cache('test-oncall', max_age=60))
+    get_team = mocker.patch('oncall.api.v0.team_oncall.get_team_oncall', return_value=('[]', float('inf')))
+    get_service = mocker.patch('oncall.api.v0.service_oncall.get_service_oncall',
+                               return_value=('[]', float('inf')))
+    resp = mocker.MagicMock()
+    for _ in range(3):
+        team_oncall.on_get(None, resp, 'team-foo', 'primary')
+        service_oncall.on_get(None, resp, 'service-foo')
+    assert resp.body == '[]'
+    assert get_team.call_count == 1 and get_service.call_count == 1
+    team_oncall.on_get(None, resp, 'team-foo')
+    assert get_team.call_count == 2
+
+
+def test_invalidate_teams(mocker):
+    mocker.patch('oncall.cache.oncall', cache.Cache('test-teams', max_age=60))
+    cursor = mocker.MagicMock()
+    cursor.__iter__.side_effect = [iter([('team-subscriber',)]), iter([('service-foo',)])]
+    mocker.patch('oncall.cache.db.connect').return_value.cursor.return_value = cursor
+    for team in ('team-foo', 'team-subscriber', 'team-bar'):
+        cache.oncall.load(('summary', team), lambda: (team, float('inf')), ['team:%s' % team])
+    for service in ('service-foo', 'service-bar'):
+        cache.oncall.load(('service', service), lambda: (service, float('inf')), ['service:%s' % service])
+
+    # A write to team-foo drops its entries, those of its subscribers and of the services they own
+    cache.invalidate_teams(['team-foo'])
+    assert cursor.execute.call_args_list[0][0][1] == (['team-foo'],)
+    assert cache.oncall.get(('summary', 'team-foo')) is None
+    assert cache.oncall.get(('summary', 'team-subscriber')) is None
+    assert cache.oncall.get(('service', 'service-foo')) is None
+    assert cache.oncall.get(('summary', 'team-bar')) == 'team-bar'
+    assert cache.oncall.get(('service', 'service-bar')) == 'service-bar'
+
+    # Unmapping a service invalidates it even though no team owns it anymore
+    cache.invalidate_teams([], ['service-bar'])
+    assert cache.oncall.get(('service', 'service-bar')) is None
+    assert cache.oncall.get(('summary', 'team-bar')) == 'team-bar'
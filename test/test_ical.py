@@ -0,0 +1,65 @@
+from icalendar import Calendar
+
+from oncall.api.v0 import ical
+
+
+def test_events_to_ical(mocker):
+    cursor = mocker.MagicMock()
+    cursor.__iter__.return_value = iter([
+        {'username': 'foo', 'full_name': 'Foo Icecream', 'contact_mode': 'email', 'destination': 'foo@example.com'},
+        {'username': 'foo', 'full_name': 'Foo Icecream', 'contact_mode': 'sms', 'destination': '+1 111-111-1111'},
+        {'username': 'bar', 'full_name': 'Bar Apple', 'contact_mode': None, 'destination': None},
+    ])
+    connection = mocker.MagicMock()
+    connection.cursor.return_value = cursor
+    mocker.patch('oncall.api.v0.ical.db.connect', return_value=connection)
+    mocker.patch('oncall.api.v0.ical.db.DictCursor', create=True)
+
+    events = [{'id': 1, 'start': 1500000000, 'end': 1500003600, 'team': 'team-foo', 'role': 'primary', 'user': 'foo',
+               'last_modified': 1600000000},
+              {'id': 2, 'start': 1500003600, 'end': 1500007200, 'team': 'team-foo', 'role': 'primary', 'user': 'bar',
+               'last_modified': 1600000000},
+              {'id': 3, 'start': 1500007200, 'end': 1500010800, 'team': 'team-foo', 'role': 'primary', 'user': 'foo',
+               'last_modified': 1600000000}]
+    feed = ical.events_to_ical(events, 'team-foo')
+
+    # Contacts for every user come from a single query
+    assert cursor.execute.call_count == 1
+    cal = Calendar.from_ical(feed)
+    assert [str(ev['uid']) for ev in cal.subcomponents] == ['event-1@oncall', 'event-2@oncall', 'event-3@oncall']
+    assert str(cal.subcomponents[0]['description']) == 'Foo Icecream\nemail: foo@example.com\nsms: +1 111-111-1111'
+    assert str(cal.subcomponents[1]['summary']) == 'team-foo primary shift: Bar Apple'
+    # DTSTAMP is the team's last modification, not the shift start
+    assert cal.subcomponents[0]['dtstamp'].dt.timestamp() == 1600000000
+
+    # Components are cached and the feed is byte-stable
+    cursor.__iter__.return_value = iter([
+        {'username': 'foo', 'full_name': 'Foo Icecream', 'contact_mode': 'sms', 'destination': '+1 111-111-1111'},
+        {'username': 'foo', 'full_name': 'Foo Icecream', 'contact_mode': 'email', 'destination': 'foo@example.com'},
+        {'username': 'bar', 'full_name': 'Bar Apple', 'contact_mode': None, 'destination': None},
+    ])
+    hits = ical.event_to_ical.cache_info().hits
+    assert ical.events_to_ical(events, 'team-foo') == feed
+    assert ical.event_to_ical.cache_info().hits == hits + 3
+
+
+def test_feed_stable_across_cold_caches(mocker):
+    connection = mocker.MagicMock()
+    connection.cursor.return_value.__iter__.side_effect = lambda: iter([
+        {'username': 'foo', 'full_name': 'Foo Icecream'}])
+    mocker.patch('oncall.api.v0.ical.db.connect', return_value=connection)
+    mocker.patch('oncall.api.v0.ical.db.DictCursor', create=True)
+    events = [{'id': 4, 'start': 1500000000, 'end': 1500003600, 'team': 'team-foo', 'role': 'primary', 'user': 'foo',
+               'last_modified': 1600000000}]
+
+    # Another worker, a restart or an LRU eviction serializes the same event to the same bytes
+    ical.event_to_ical.cache_clear()
+    first = ical.events_to_ical(events, 'team-foo', contact=False)
+    mocker.patch('time.time', return_value=1700000000)
+    ical.event_to_ical.cache_clear()
+    assert ical.events_to_ical(events, 'team-foo', contact=False) == first
+    assert b'DTSTAMP:20200913T122640Z' in first
+
+    # Editing the event bumps its team's last_modified, and with it the stamp
+    events[0].update({'end': 1500007200, 'last_modified': 1600000600})
+    assert b'DTSTAMP:20200913T123640Z' in ical.events_to_ical(events, 'team-foo', contact=False)
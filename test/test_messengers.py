@@ -0,0 +1,108 @@
+import time
+
+import gevent
+import pytest
+
+from oncall import messengers, metrics
+from oncall.messengers import GuardedMessenger, MessengerUnavailable, OncallMessengerException
+
+
+class FlakyMessenger(object):
+    supports = frozenset(['email'])
+
+    def __init__(self):
+        self.fail = True
+        self.delay = 0
+        self.sent = []
+
+    def send(self, message):
+        # Blocks the calling thread, like the requests based messengers
+        time.sleep(self.delay)
+        if self.fail:
+            raise Exception('backend down')
+        self.sent.append(message)
+
+
+def test_circuit_breaker(mocker):
+    now = mocker.patch('oncall.messengers.time.time', return_value=1476910800)
+    flaky = FlakyMessenger()
+    messenger = GuardedMessenger(flaky, {'type': 'flaky', 'failure_threshold': 2, 'cooldown': 60})
+    for _ in range(2):
+        with pytest.raises(Exception):
+            messenger.send({})
+    assert metrics.stats['messenger_flaky_breaker_open'] == 1
+
+    # Open circuits are skipped without calling the backend
+    flaky.fail = False
+    with pytest.raises(MessengerUnavailable):
+        messenger.send({})
+    assert flaky.sent == []
+
+    # After the cool-down one trial send closes the circuit again
+    now.return_value += 61
+    messenger.send({'id': 1})
+    assert flaky.sent == [{'id': 1}]
+    assert metrics.stats['messenger_flaky_breaker_open'] == 0
+
+
+def test_send_limits(mocker):
+    flaky = FlakyMessenger()
+    flaky.fail = False
+    messenger = GuardedMessenger(flaky, {'type': 'flaky', 'rate_limit': 1, 'burst': 2, 'wait_timeout': 0})
+    messenger.send({})
+    messenger.send({})
+    with pytest.raises(MessengerUnavailable):
+        messenger.send({})
+
+
+def test_blocking_send_timeout():
+    flaky = FlakyMessenger()
+    flaky.fail = False
+    flaky.delay = 0.5
+    messenger = GuardedMessenger(flaky, {'type': 'flaky', 'timeout': 0.05, 'max_concurrency': 1,
+                                         'wait_timeout': 0})
+    start = time.time()
+    with pytest.raises(OncallMessengerException):
+        messenger.send({})
+    assert time.time() - start < 0.4
+    assert messenger.breaker.failures == 1
+
+    # Other greenlets keep running while the send blocks its thread
+    ticks = gevent.spawn(lambda: [gevent.sleep(0.01) for _ in range(5)])
+    ticks.join(timeout=0.3)
+    assert ticks.ready()
+
+    # The abandoned send holds its slot until its thread finishes
+    with pytest.raises(MessengerUnavailable):
+        messenger.send({})
+    gevent.sleep(0.6)
+    assert messenger.semaphore.counter == 1
+    flaky.delay = 0
+    messenger.send({'id': 1})
+    assert flaky.sent == [{}, {'id': 1}]
+
+
+def test_send_message_falls_through(mocker):
+    broken, working = FlakyMessenger(), FlakyMessenger()
+    working.fail = False
+    mocker.patch.dict(messengers._active_messengers, {'email': [
+        GuardedMessenger(broken, {'type': 'broken', 'failure_threshold': 1}),
+        GuardedMessenger(working, {'type': 'working'})]})
+    messengers.send_message({'mode': 'email'})
+    messengers.send_message({'mode': 'email'})
+    assert len(working.sent) == 2
+    assert metrics.stats['messenger_broken_skipped_cnt'] >= 1
+
+
+def test_send_message_all_unavailable(mocker):
+    broken, limited = FlakyMessenger(), FlakyMessenger()
+    guarded = [GuardedMessenger(broken, {'type': 'broken', 'failure_threshold': 1}),
+               GuardedMessenger(limited, {'type': 'limited', 'rate_limit': 0.01, 'burst': 1, 'wait_timeout': 0})]
+    mocker.patch.dict(messengers._active_messengers, {'email': guarded})
+    with pytest.raises(OncallMessengerException) as e:
+        messengers.send_message({'mode': 'email'})
+    assert not isinstance(e.value, MessengerUnavailable)
+
+    # Circuit open on one messenger and rate limited on the other: no send was attempted
+    with pytest.raises(MessengerUnavailable):
+        messengers.send_message({'mode': 'email'})
@@ -14,15 +14,224 @@ def test_send_notification(mocker):
         assert msg['subject'] == 'bar'
         assert msg['body'] == 'foo'
 
-    from oncall.bin.notifier import send_queue, format_and_send_message
+    from oncall.bin.notifier import format_and_send_message
     mocker.patch('oncall.bin.notifier.send_message').side_effect = check_message
     mock_mark_sent = mocker.patch('oncall.bin.notifier.mark_message_as_sent')
 
-    while send_queue.qsize() > 0:
-        send_queue.get()
     send_time = 1476910800  # 14:00:00 on Oct 16, 2016
-    send_queue.put({'user': 'username', 'mode': 'email', 'context': json_dumps({'foo': 'bar', 'baz': 'foo'}),
-                    'send_time': send_time, 'subject': '%(foo)s', 'body': '%(baz)s'})
-    format_and_send_message()
-    assert send_queue.qsize() == 0
+    format_and_send_message({'user': 'username', 'mode': 'email',
+                             'context': json_dumps({'foo': 'bar', 'baz': 'foo'}),
+                             'send_time': send_time, 'subject': '%(foo)s', 'body': '%(baz)s'})
     mock_mark_sent.assert_called_once()
+
+
+def test_poll_claims_batch(mocker):
+    from oncall.bin import notifier
+    connection = mocker.MagicMock()
+    cursor = connection.cursor.return_value
+    cursor.rowcount = 1
+    cursor.__iter__.return_value = iter([{'id': 1, 'user': 'username', 'claimed_until': 2000000000}])
+    mocker.patch('oncall.bin.notifier.db.connect', return_value=connection)
+    mocker.patch('oncall.bin.notifier.db.DictCursor', create=True)
+    mocker.patch.multiple(notifier, claim_batch_size=10, shard_index=2, shard_count=4)
+
+    while notifier.send_queue.qsize() > 0:
+        notifier.send_queue.get()
+    notifier.send_queue.put({'id': 0})
+    assert notifier.poll()
+
+    (claim_query, claim_args), (select_query, select_args) = [c[0] for c in cursor.execute.call_args_list]
+    claim, lease, shard_count, shard_index, limit = claim_args
+    assert (shard_count, shard_index, limit) == (4, 2, 9)
+    assert select_args == claim
+    connection.commit.assert_called_once()
+    assert notifier.send_queue.qsize() == 2
+
+    # Each poll claims under a new token, so rows still in flight are not queued twice
+    notifier.poll()
+    assert cursor.execute.call_args_list[2][0][1][0] != claim
+    while notifier.send_queue.qsize() > 0:
+        notifier.send_queue.get()
+
+
+def test_expired_lease_not_sent(mocker):
+    from oncall.bin.notifier import format_and_send_message
+    send = mocker.patch('oncall.bin.notifier.send_message')
+    mocker.patch('oncall.bin.notifier.mark_message_as_sent')
+
+    format_and_send_message({'id': 1, 'user': 'username', 'mode': 'email', 'context': json_dumps({}),
+                             'subject': 'foo', 'body': 'bar', 'claimed_until': 1476910800})
+    send.assert_not_called()
+
+
+def test_acks_batched(mocker):
+    from oncall.bin import notifier
+    connection = mocker.MagicMock()
+    cursor = connection.cursor.return_value
+    connect = mocker.patch('oncall.bin.notifier.db.connect', return_value=connection)
+    mocker.patch.object(notifier, 'ack_batch_size', 3)
+
+    notifier.mark_message_as_sent({'id': 1})
+    notifier.mark_message_as_unsent({'id': 2})
+    connect.assert_not_called()
+    notifier.mark_message_as_sent({'id': 3})
+    connect.assert_called_once()
+    cursor.execute.assert_any_call(mocker.ANY, (1, [1, 3]))
+    cursor.execute.assert_any_call(mocker.ANY, (0, [2]))
+    connection.commit.assert_called_once()
+
+    # Failed flushes keep the ids for the next one
+    cursor.execute.side_effect = Exception('DB down')
+    notifier.mark_message_as_sent({'id': 4})
+    notifier.flush_acks()
+    assert notifier.acks == {True: [4], False: []}
+    cursor.execute.side_effect = None
+    notifier.flush_acks()
+    cursor.execute.assert_called_with(mocker.ANY, (1, [4]))
+    assert notifier.acks == {True: [], False: []}
+    notifier.flush_acks()
+    assert connect.call_count == 3
+
+
+def test_unavailable_message_deferred(mocker):
+    from oncall.bin import notifier
+    from oncall.messengers import MessengerUnavailable
+    now = 1476910800
+    mocker.patch('oncall.bin.notifier.time.time', return_value=now)
+    mocker.patch('oncall.bin.notifier.send_message', side_effect=MessengerUnavailable('rate limited'))
+    mark_unsent = mocker.patch('oncall.bin.notifier.mark_message_as_unsent')
+    connection = mocker.MagicMock()
+    cursor = connection.cursor.return_value
+    mocker.patch('oncall.bin.notifier.db.connect', return_value=connection)
+    mocker.patch.multiple(notifier, due_times=[], retry_delay=30)
+
+    notifier.format_and_send_message({'id': 5, 'user': 'username', 'mode': 'email', 'context': json_dumps({}),
+                                      'subject': 'foo', 'body': 'bar', 'claimed_until': now + 600})
+    mark_unsent.assert_not_called()
+    assert notifier.deferred == {now + 30: [5]}
+    assert notifier.due_times == [(now + 31, 5)]
+
+    # The flush shortens the lease to the same deadline instead of deactivating the message
+    row = {'claimed_until': now + 600}
+    db_now = [now]
+
+    def execute(query, args):
+        if query.startswith('UPDATE `notification_queue` SET `claimed_until`'):
+            row['claimed_until'] = args[0]
+        elif 'SET `claimed_by`' in query:
+            # The claim only takes rows whose lease ran out: `claimed_until` < UNIX_TIMESTAMP()
+            cursor.rowcount = int(row['claimed_until'] < db_now[0])
+    cursor.execute.side_effect = execute
+    cursor.__iter__.return_value = iter([])
+    mocker.patch('oncall.bin.notifier.db.DictCursor', create=True)
+    mocker.patch.object(notifier, 'claim_batch_size', 10)
+    notifier.flush_acks()
+    assert row['claimed_until'] == now + 30
+    assert notifier.deferred == {}
+
+    # The heap entry comes due once the shortened lease has run out, so the claim takes the row
+    next_due = notifier.claim_due(now + 1)
+    assert next_due == now + 31
+    db_now[0] = next_due
+    claimed = notifier.metrics.stats['message_claimed_cnt']
+    assert notifier.claim_due(next_due) is None
+    assert notifier.metrics.stats['message_claimed_cnt'] == claimed + 1
+
+
+def test_stop_workers(mocker):
+    from gevent import sleep, spawn
+    from oncall.bin import notifier
+    mocker.patch('oncall.bin.notifier.send_message', side_effect=lambda msg: sleep(0.05))
+    mark_sent = mocker.patch('oncall.bin.notifier.mark_message_as_sent')
+    defer = mocker.patch('oncall.bin.notifier.defer_message')
+    mocker.patch.object(notifier, 'shutdown_timeout', 1)
+
+    def message(msg_id):
+        return {'id': msg_id, 'user': 'username', 'mode': 'email', 'context': json_dumps({}),
+                'subject': 'foo', 'body': 'bar'}
+
+    while notifier.send_queue.qsize() > 0:
+        notifier.send_queue.get()
+    workers = [spawn(notifier.worker) for _ in range(2)]
+    for msg_id in range(4):
+        notifier.send_queue.put(message(msg_id))
+
+    # Claimed messages are all sent before the workers exit
+    notifier.stop_workers(workers)
+    assert all(task.successful() for task in workers)
+    assert sorted(c[0][0]['id'] for c in mark_sent.call_args_list) == [0, 1, 2, 3]
+    defer.assert_not_called()
+
+    # Past the shutdown timeout, hung sends are stopped and queued messages released
+    mark_sent.reset_mock()
+    mocker.patch('oncall.bin.notifier.send_message', side_effect=lambda msg: sleep(10))
+    mocker.patch.object(notifier, 'shutdown_timeout', 0.05)
+    workers = [spawn(notifier.worker)]
+    for msg_id in range(3):
+        notifier.send_queue.put(message(msg_id))
+    sleep(0)
+    notifier.stop_workers(workers)
+    assert workers[0].dead
+    mark_sent.assert_not_called()
+    assert [c[0][0]['id'] for c in defer.call_args_list] == [1, 2]
+    assert notifier.send_queue.qsize() == 0
+
+
+def test_due_time_heap(mocker):
+    from oncall.bin import notifier
+    now = 1476910800
+    mocker.patch('oncall.bin.notifier.time.time', return_value=now)
+    connection = mocker.MagicMock()
+    cursor = connection.cursor.return_value
+    mocker.patch('oncall.bin.notifier.db.connect', return_value=connection)
+
+    cursor.fetchone.return_value = (10,)
+    cursor.__iter__.return_value = iter([(now + 120, 9), (now - 5, 4), (now + 30, 7)])
+    notifier.load_due_times()
+    assert notifier.last_seen_id == 10
+    assert notifier.due_times[0] == (now - 5, 4)
+
+    # New rows outside the shard or the look-ahead window only advance the last seen id
+    cursor.__iter__.return_value = iter([(now + 10, 11, 1), (now + 10, 12, 0), (now + 3600, 13, 1)])
+    notifier.load_new_due_times()
+    assert cursor.execute.call_args[0][1][-1] == 10
+    assert notifier.last_seen_id == 13
+    assert len(notifier.due_times) == 4
+
+    assert notifier.pop_due_times(now)
+    assert not notifier.pop_due_times(now)
+    assert notifier.pop_due_times(now + 30)
+    assert notifier.due_times == [(now + 120, 9)]
+
+
+def test_archive_batch(mocker):
+    from oncall.notifier.queue_archiver import archive_batch
+    cursor = mocker.MagicMock()
+    cursor.__iter__.return_value = iter([(3,), (5,)])
+    assert archive_batch(cursor, 1476910800, 2) == 2
+    select, insert, delete = [c[0] for c in cursor.execute.call_args_list]
+    assert select[1] == (1476910800, 2)
+    assert 'INSERT INTO `notification_queue_archive`' in insert[0]
+    assert insert[1] == delete[1] == ([3, 5],)
+
+    cursor.reset_mock()
+    cursor.__iter__.return_value = iter([])
+    assert archive_batch(cursor, 1476910800, 2) == 0
+    assert cursor.execute.call_count == 1
+
+
+def test_claim_due_retries(mocker):
+    from oncall.bin import notifier
+    now = 1476910800
+    mocker.patch.object(notifier, 'due_times', [(now - 10, 1), (now, 2), (now + 30, 3)])
+    poll = mocker.patch('oncall.bin.notifier.poll', return_value=False)
+
+    # A skipped or truncated claim keeps the due entries and retries shortly
+    assert notifier.claim_due(now) == now + notifier.claim_retry_interval
+    assert len(notifier.due_times) == 3
+
+    poll.return_value = True
+    assert notifier.claim_due(now + 1) == now + 30
+    assert notifier.due_times == [(now + 30, 3)]
+    assert notifier.claim_due(now + 2) == now + 30
+    assert poll.call_count == 2
@@ -0,0 +1,36 @@
+from oncall.query import QueryBuilder
+from oncall.api.v0 import users
+
+
+def test_query_builder_caches_shapes():
+    builder = QueryBuilder({'name': '`user`.`name` = %s',
+                            'name__contains': '`user`.`name` LIKE CONCAT("%%", %s, "%%")',
+                            'active': '`user`.`active` = %s'})
+
+    query, params = builder.build('`id`', '`user`', {'active': 1, 'name': 'foo', 'bogus': 'x'})
+    assert query == 'SELECT `id` FROM `user` WHERE `user`.`active` = %s AND `user`.`name` = %s'
+    assert params == [1, 'foo']
+
+    # Same shape with different values reuses the compiled statement
+    query_2, params_2 = builder.build('`id`', '`user`', {'name': "bar' OR 1=1", 'active': 0})
+    assert query_2 is query
+    assert params_2 == [0, "bar' OR 1=1"]
+    assert builder.compile.cache_info().hits == 1
+
+    query, params = builder.build('`id`', '`user`', {'name__contains': 'oo'}, ['`user`.`id` > %s'],
+                                  ' ORDER BY `id` LIMIT %s')
+    assert query == ('SELECT `id` FROM `user` WHERE `user`.`name` LIKE CONCAT("%%", %s, "%%") '
+                     'AND `user`.`id` > %s ORDER BY `id` LIMIT %s')
+    assert params == ['oo']
+    assert builder.build('`id`', '`user`', {})[0] == 'SELECT `id` FROM `user`'
+
+
+def test_get_user_data_binds_params(mocker):
+    connection = mocker.MagicMock()
+    cursor = mocker.MagicMock()
+    cursor.fetchall.return_value = []
+    users.get_user_data(['name'], {'name': "foo' --"}, dbinfo=(connection, cursor))
+    query, params = cursor.execute.call_args[0]
+    assert "foo' --" not in query
+    assert params == ["foo' --"]
+    connection.escape.assert_not_called()
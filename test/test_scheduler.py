@@ -2,6 +2,7 @@
 # See LICENSE in the project root for license information.
 
 import datetime
+import json
 import time
 import calendar
 import oncall.scheduler.default
@@ -273,3 +274,237 @@ def test_find_least_active_available_user_conflicts(mocker):
     assert scheduler.find_next_user_id(MOCK_SCHEDULE, future_events, None, table_name='event') is None
 
     mock_active_user_by_team.assert_not_called()
+
+
+def test_team_groups_follow_subscriptions(mocker):
+    from oncall.bin import scheduler as scheduler_bin
+    mocker.patch.dict(scheduler_bin.schedulers, {'default': oncall.scheduler.default.Scheduler()}, clear=True)
+    cursor = mocker.MagicMock()
+    cursor.__iter__.return_value = [{'team_id': 1, 'subscription_id': 3},
+                                    {'team_id': 4, 'subscription_id': 3},
+                                    {'team_id': 2, 'subscription_id': 99}]
+    teams = [{'id': i} for i in range(1, 6)]
+    groups = scheduler_bin.get_team_groups(teams, cursor)
+
+    assert sorted([team['id'] for team in group] for group in groups) == [[1, 3, 4], [2], [5]]
+    # No cross-team schedulers loaded, so roster users aren't queried
+    cursor.execute.assert_called_once()
+
+
+def test_event_index_decisions():
+    from oncall.scheduler.event_index import EventIndex
+    vacation, primary, secondary = 5, 1, 2
+    index = EventIndex(1, [(7, primary)], vacation)
+    index.rosters[3] = {123, 456, 789, 999}
+    index.ends[(1, primary, 123)].append(100)
+    index.ends[(1, primary, 456)].append(50)
+    index.add_event(123, 1, primary, 400, 500)
+    index.add_event(456, 8, primary, 440, 460)     # unrelated team, not a conflict
+    index.add_event(789, 7, primary, 560, 700)     # subscription conflict
+    index.add_event(999, 8, vacation, 650, 660)    # vacation conflict on any team
+
+    future_events = [{'start': 440, 'end': 570}, {'start': 600, 'end': 700}]
+    assert index.get_busy_user_ids({123, 456, 789, 999}, future_events) == {123, 789, 999}
+    assert index.get_busy_user_ids({123, 456, 789, 999}, future_events, all_teams=True) == {123, 456, 789, 999}
+    assert index.get_busy_user_ids({123}, [{'start': 500, 'end': 600}]) == set()
+
+    assert index.find_new_user_ids(3, 1, 440, primary) == {789, 999}
+    assert index.find_new_user_ids(3, 1, 440, secondary) == {123, 456, 789, 999}
+    assert index.find_least_active_user_id({123, 456}, 1, 440, primary) == 456
+    # Events ending after the start time are ignored
+    assert index.find_least_active_user_id({123, 456}, 1, 499, primary) == 456
+    index.add_events(456, 1, primary, [{'start': 300, 'end': 350}])
+    assert index.find_least_active_user_id({123, 456}, 1, 440, primary) == 123
+
+
+def test_find_next_user_from_index(mocker):
+    from oncall.scheduler.event_index import EventIndex
+    mock_busy = mocker.patch('oncall.scheduler.default.Scheduler.get_busy_user_by_event_range')
+    index = EventIndex(1, [], None)
+    index.rosters[3] = {123, 456}
+    index.ends[(1, 2, 123)].append(100)
+    index.ends[(1, 2, 456)].append(200)
+
+    scheduler = oncall.scheduler.default.Scheduler()
+    assert scheduler.find_next_user_id(MOCK_SCHEDULE, [{'start': 440, 'end': 570}], None, index=index) == 123
+    mock_busy.assert_not_called()
+
+
+def test_insert_events_batches_notifications(mocker):
+    cursor = mocker.MagicMock()
+    cursor.fetchone.return_value = {'name': 'foo'}
+    settings = [{'user_id': 1, 'mode_id': 1, 'type_id': 3, 'only_if_involved': 0, 'time_zone': None},
+                {'user_id': 1, 'mode_id': 1, 'type_id': 3, 'only_if_involved': 1, 'time_zone': None},
+                {'user_id': 2, 'mode_id': 2, 'type_id': 3, 'only_if_involved': 1, 'time_zone': 'US/Pacific'},
+                {'user_id': 9, 'mode_id': 1, 'type_id': 3, 'only_if_involved': 1, 'time_zone': None}]
+    mock_settings = mocker.patch('oncall.scheduler.default.get_notification_settings', return_value=settings)
+    events = [{'start': 0, 'end': 5}, {'start': 10, 'end': 15}]
+    scheduler = oncall.scheduler.default.Scheduler()
+    cache = {}
+    scheduler.insert_events(1, 4, 2, events, 2, cursor, notification_settings=cache)
+    scheduler.insert_events(1, 4, 2, events, 2, cursor, notification_settings=cache)
+    mock_settings.assert_called_once()
+
+    assert cursor.executemany.call_count == 2
+    event_args = cursor.executemany.call_args[0][1]
+    assert len(event_args) == 2
+    assert event_args[0][-1] == event_args[1][-1] is not None
+    inserts = [c for c in cursor.execute.call_args_list if 'notification_queue' in c[0][0]]
+    assert len(inserts) == 2
+    # Users 1 and 2 are notified of both events; user 9 isn't involved
+    assert inserts[0][0][1][::4] == [1, 1, 2, 2]
+
+
+def test_next_due_time(mocker):
+    mock_dt = datetime.datetime(year=2017, month=2, day=5, hour=0, tzinfo=timezone('US/Pacific'))
+    last_epoch = calendar.timegm(mock_dt.astimezone(utc).timetuple())
+    mocker.patch('oncall.scheduler.default.Scheduler.get_schedule_last_epoch').return_value = last_epoch
+    schedule_foo = {
+        'timezone': 'US/Pacific',
+        'auto_populate_threshold': 21,
+        'events': [{
+            'start': DAY + 10 * HOUR + 30 * MIN,
+            'duration': WEEK
+        }]
+    }
+    scheduler = oncall.scheduler.default.Scheduler()
+    due_time = scheduler.get_next_due_time(schedule_foo, last_epoch)
+
+    # No events are produced until the schedule is due, then the next epoch is
+    mocker.patch('time.time').return_value = due_time - 1
+    assert scheduler.calculate_future_events(schedule_foo, None)[0] == []
+    mocker.patch('time.time').return_value = due_time + 1
+    assert len(scheduler.calculate_future_events(schedule_foo, None)[0]) == 1
+
+    schedule_foo['auto_populate_threshold'] = 0
+    assert scheduler.get_next_due_time(schedule_foo, last_epoch) is None
+
+
+def test_plan_in_memory(mocker):
+    from oncall.scheduler.event_index import EventIndex
+    epochs = [[{'start': 100, 'end': 200}], [{'start': 200, 'end': 300}], [{'start': 300, 'end': 400}]]
+    scheduler = oncall.scheduler.default.Scheduler()
+    mocker.patch.object(scheduler, 'get_populate_start_epoch')
+    mocker.patch.object(scheduler, 'calculate_future_events').return_value = (epochs, 999)
+    # The second epoch is already covered by a manually created event
+    mocker.patch.object(scheduler, 'get_matching_events').return_value = {(200, 300)}
+    index = EventIndex(1, [], None)
+    index.rosters[3] = {123, 456}
+    index.ends[(1, 2, 123)].append(50)
+    index.ends[(1, 2, 456)].append(60)
+    mocker.patch.object(scheduler, 'load_event_index').return_value = index
+    cursor = mocker.MagicMock()
+
+    schedule = dict(MOCK_SCHEDULE, id=7)
+
+    replace_from, assignments, last_epoch = scheduler.plan(schedule, 100, cursor)
+    assert replace_from == 100
+    assert assignments == [(123, epochs[0]), (456, epochs[2])]
+    assert last_epoch == 999
+    cursor.execute.assert_not_called()
+
+
+def test_week_offsets_match_pytz():
+    from oncall.scheduler.default import utc_from_naive_timestamp, naive_timestamp
+    scheduler = oncall.scheduler.default.Scheduler()
+    # Weeks with DST transitions, including a half hour one and a skipped day
+    for tz_name, first_day in (('US/Pacific', datetime.datetime(2017, 3, 5)),
+                               ('US/Pacific', datetime.datetime(2017, 11, 1)),
+                               ('Australia/Lord_Howe', datetime.datetime(2017, 9, 27)),
+                               ('Pacific/Apia', datetime.datetime(2011, 12, 25)),
+                               ('UTC', datetime.datetime(2017, 3, 5))):
+        tz = timezone(tz_name)
+        for step in range(0, 2 * WEEK, 15 * MIN):
+            date = first_day + datetime.timedelta(seconds=step)
+            expected = calendar.timegm(tz.localize(date, is_dst=1).astimezone(utc).timetuple())
+            assert utc_from_naive_timestamp(naive_timestamp(date), tz_name) == expected
+            assert scheduler.utc_from_naive_date(date, {'timezone': tz_name}) == expected
+
+
+def test_scheduler_bench_fake_fleet():
+    from oncall.bin import scheduler_bench
+    for name in scheduler_bench.SCHEDULERS:
+        connection = scheduler_bench.FakeConnection()
+        fleet = scheduler_bench.load_fleet(connection, connection.cursor(), 20, 0, 'test')
+        result = scheduler_bench.run_scheduler(name, connection, fleet)
+        assert result['teams'] == 20
+        assert result['events'] > 0
+        assert result['queries'] > 0
+        assert len(result['slowest_teams']) == 5
+
+
+def test_busy_users_from_bounding_range():
+    from oncall.bin.scheduler import load_scheduler
+    from oncall.bin.scheduler_bench import FakeConnection
+    connection = FakeConnection()
+    cursor = connection.cursor()
+    cursor.execute("SELECT `id`, `name` FROM `role`")
+    roles = {row['name']: row['id'] for row in cursor}
+    cursor.execute('INSERT INTO `team_subscription` VALUES (1, 7, %s)', roles['primary'])
+    cursor.executemany('INSERT INTO `event` (`team_id`, `role_id`, `user_id`, `start`, `end`) VALUES (%s, %s, %s, %s, %s)',
+                       [(1, roles['primary'], 10, 100, 200),     # overlaps the first shift
+                        (1, roles['primary'], 11, 200, 300),     # in the gap between shifts
+                        (8, roles['primary'], 12, 350, 360),     # unrelated team
+                        (7, roles['primary'], 13, 390, 410),     # subscription
+                        (8, roles['vacation'], 14, 395, 500),    # vacation on any team
+                        (1, roles['primary'], 15, 400, 500)])    # starts as the last shift ends
+    events = [{'start': 150, 'end': 200}, {'start': 300, 'end': 400}]
+    user_ids = [10, 11, 12, 13, 14, 15]
+
+    scheduler = oncall.scheduler.default.Scheduler()
+    assert sorted(scheduler.get_busy_user_by_event_range(user_ids, 1, events, cursor)) == [10, 13, 14]
+    multi_team = load_scheduler('multi-team')
+    assert sorted(multi_team.get_busy_user_by_event_range(user_ids, 1, events, cursor)) == [10, 12, 13, 14]
+
+
+def test_load_teams_hydrates_schedules():
+    from oncall.bin import scheduler as scheduler_bin
+    from oncall.bin.scheduler_bench import FakeConnection, load_fleet
+    from oncall.db import CountingCursor
+    connection = FakeConnection()
+    fleet = load_fleet(connection, connection.cursor(), 10, 0, 'test')
+    cursor = CountingCursor(connection.cursor())
+
+    teams = scheduler_bin.load_teams([team['id'] for team, _ in fleet], (connection, cursor))
+    # Teams, subscriptions, schedules and roster orders
+    assert cursor.queries == 4
+    assert len(teams) == 10
+    for team, (_, schedules) in zip(sorted(teams, key=lambda t: t['id']), fleet):
+        assert sorted(s['id'] for s in team['schedules']) == sorted(s['id'] for s in schedules)
+        for schedule in team['schedules']:
+            assert schedule['events'] and schedule['scheduler']['name'] == 'default'
+            assert len(schedule['scheduler']['data']) >= 3
+    cursor.execute('SELECT COUNT(*) AS `count` FROM `team_subscription`')
+    assert sum(len(team['subscriptions']) for team in teams) == cursor.fetchone()['count']
+
+
+def test_cycle_traces_and_metrics(mocker, tmpdir):
+    from oncall import metrics
+    from oncall.bin import scheduler as scheduler_bin
+    from oncall.bin.scheduler_bench import FakeConnection, load_fleet
+    connection = FakeConnection()
+    fleet = load_fleet(connection, connection.cursor(), 5, 0, 'test')
+    mocker.patch('oncall.db.connect').return_value = connection
+    mocker.patch('oncall.db.DictCursor', None)
+    teams = scheduler_bin.load_teams([team['id'] for team, _ in fleet], (connection, connection.cursor()))
+    # Break one team to check failures are traced
+    teams[0]['schedules'][0]['scheduler']['name'] = 'round-robin'
+    mocker.patch.object(scheduler_bin.get_scheduler('round-robin'), 'schedule', side_effect=ValueError)
+
+    traces = scheduler_bin.schedule_team_group(teams)
+    assert [trace['team'] for trace in traces] == [team['name'] for team in teams]
+    assert [trace['failed'] for trace in traces] == [True, False, False, False, False]
+    assert all(trace['queries'] > 0 for trace in traces[1:])
+    assert all(trace['events'] > 0 for trace in traces[1:])
+
+    trace_file = str(tmpdir.join('trace.json'))
+    scheduler_bin.record_cycle(traces, time.time(), 7, 3, trace_file)
+    assert metrics.stats['teams_processed'] == 5
+    assert metrics.stats['teams_failed'] == 1
+    assert metrics.stats['schedules_skipped'] == 3
+    assert metrics.stats['events_created'] == sum(trace.get('events', 0) for trace in traces)
+    assert metrics.stats['scheduler_round_robin_time'] == 0
+    with open(trace_file) as f:
+        dumped = json.load(f)
+    assert [trace['team'] for trace in dumped['teams']] == \
+        [trace['team'] for trace in sorted(traces, key=lambda trace: trace['time'], reverse=True)]